@@ -7,8 +7,11 @@ from aws_cdk import (
     Stack,
     aws_apigateway as apigw,
     aws_ec2 as ec2,
+    aws_events as events,
+    aws_events_targets as events_targets,
     aws_lambda as lambda_,
     aws_ssm as ssm,
+    triggers,
 )
 from constructs import Construct
 from dotenv import load_dotenv
@@ -108,11 +111,37 @@ class PeepStack(Stack):
         proxy_lambda = lambda_.Function(self, 'ProxyLambda', **proxy_lambda_kwargs)
         proxy_lambda.node.add_dependency(private_subnet_us_east_1a)
 
+        # Applies the database migrations once per deployment, before the API Lambda gets the new code, so the API
+        # itself never touches the schema on cold starts
+        migrate_lambda_kwargs = {
+            **proxy_lambda_kwargs,
+            'handler': 'lambdas.db.main.migrate_handler',
+            'timeout': Duration.minutes(5),
+        }
+        migrate_trigger = triggers.TriggerFunction(self, 'MigrateTrigger', execute_before=[proxy_lambda],
+                                                   **migrate_lambda_kwargs)
+        migrate_trigger.node.add_dependency(private_subnet_us_east_1a)
+
+        # Repairs any drift of the users counters (followers, followees, peeps) once a day
+        reconcile_stats_lambda_kwargs = {
+            **proxy_lambda_kwargs,
+            'handler': 'lambdas.db.main.reconcile_stats_handler',
+            'timeout': Duration.minutes(15),
+        }
+        reconcile_stats_lambda = lambda_.Function(self, 'ReconcileStatsLambda', **reconcile_stats_lambda_kwargs)
+        reconcile_stats_lambda.node.add_dependency(private_subnet_us_east_1a)
+        events.Rule(self, 'ReconcileStatsSchedule', schedule=events.Schedule.rate(Duration.days(1)),
+                    targets=[events_targets.LambdaFunction(reconcile_stats_lambda)])
+
         db_user = ssm.StringParameter.from_string_parameter_name(self, 'DBUser', '/peep/live/db-user')
         db_user.grant_read(proxy_lambda)
+        db_user.grant_read(migrate_trigger)
+        db_user.grant_read(reconcile_stats_lambda)
         db_password = ssm.StringParameter.from_string_parameter_name(self, 'DBPassword',
                                                                      '/peep/live/db-password')
         db_password.grant_read(proxy_lambda)
+        db_password.grant_read(migrate_trigger)
+        db_password.grant_read(reconcile_stats_lambda)
 
         # Import the RDS instance
         rds_sg_id = Fn.import_value("RDSInstanceSecurityGroup")
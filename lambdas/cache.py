@@ -0,0 +1,150 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable
+
+logger = logging.getLogger()
+
+
+class TTLCache:
+    """
+    Small in-process cache: entries expire after `ttl` seconds, and once `maxsize` is reached the least recently used
+    entry is evicted. Each process (e.g: each Lambda instance) has its own copy, so the TTL is also the bound on how
+    stale an entry can get when it is invalidated on another process.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expires_at), ordered from least to most recently used
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        # Not needed on the event loop alone, but keeps the cache safe to share with worker threads
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        """
+        Store `value`, for `ttl` seconds if given (e.g: until a token expires) instead of the cache default.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """
+        Delete the entries for which `predicate(key, value)` is true. Walks the whole cache, so it's meant for
+        invalidations, which are much rarer than reads.
+        """
+        with self._lock:
+            for key in [key for key, (value, _) in self._entries.items() if predicate(key, value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# The caches shared with other processes go through one of these backends, chosen by cache_from_url. Both have the same
+# async interface, and their values must be JSON-serializable, so switching between them changes nothing else.
+class LocalCache:
+    """
+    Backend in the memory of this process, e.g: for a single server, or when each Lambda instance warming its own cache
+    is good enough.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Any:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: Any):
+        self.entries.set(key, value)
+
+    async def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self.entries.delete(key)
+
+    async def clear(self):
+        self.entries.clear()
+
+
+class RedisCache:
+    """
+    Backend shared by every process, on Redis or anything speaking its protocol (e.g: ElastiCache, Valkey). `client` is
+    a redis.asyncio client. The cache is an optimization, so Redis being down must not take the API with it: the errors
+    are logged, and a failed get is a miss.
+    """
+
+    def __init__(self, client, ttl: float, prefix: str = 'peep:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Any:
+        try:
+            value = await self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f'Could not read {key} from the cache: {e!r}')
+            return None
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any):
+        try:
+            await self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+        except Exception as e:
+            logger.warning(f'Could not write {key} to the cache: {e!r}')
+
+    async def delete(self, keys: Iterable[str]):
+        keys = [self.prefix + key for key in keys]
+        if not keys:
+            return
+        try:
+            # A single round trip for any number of keys
+            await self.client.delete(*keys)
+        except Exception as e:
+            # They are stale until they expire
+            logger.warning(f'Could not delete {len(keys)} keys from the cache: {e!r}')
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=f'{self.prefix}*'):
+            await self.client.delete(key)
+
+
+def cache_from_url(url: str | None, maxsize: int, ttl: float) -> LocalCache | RedisCache:
+    """
+    The backend of `url`: redis://host:port/db (or rediss:// with TLS) for Redis, and memory:// or nothing for this
+    process' memory. `maxsize` only bounds the local one, Redis evicts on its own (see its maxmemory-policy).
+    """
+    if not url or url.startswith('memory://'):
+        return LocalCache(maxsize=maxsize, ttl=ttl)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        # Imported here, so redis is only needed when the cache is on it
+        import redis.asyncio
+        return RedisCache(redis.asyncio.from_url(url), ttl=ttl)
+    raise ValueError(f'Unsupported cache URL {url!r}, must be redis://, rediss://, unix:// or memory://')
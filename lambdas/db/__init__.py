@@ -1,2 +1,2 @@
-from .main import get_db_session, get_db_url
-from .models import Base, Follows, Peep, User
+from .main import ASYNC_DB_DRIVER, get_db_session, get_db_url, get_read_db_session
+from .models import Base, Follows, Peep, TimelineEntry, User, UserStats
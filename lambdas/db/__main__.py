@@ -0,0 +1,22 @@
+import argparse
+
+from .main import get_engine, init_db
+from .stats import reconcile_all_stats
+
+
+# Deploy-time and maintenance tasks, e.g: `PEEP_ENV=local python -m lambdas.db migrate`
+def main():
+    parser = argparse.ArgumentParser(prog='python -m lambdas.db', description='Database maintenance tasks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate', help='Apply the pending migrations')
+    commands.add_parser('reconcile-stats', help='Recompute the users counters and fix the ones that drifted')
+
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        init_db()
+    elif args.command == 'reconcile-stats':
+        print(f'Fixed the stats of {reconcile_all_stats(get_engine())} users')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,27 @@
+import functools
 import logging
 import os
 
-import boto3
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import scoped_session, sessionmaker
+from fastapi import Request
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
-from .models import Base
+from lambdas.instrumentation import watch_queries
+from .migrations import migrate
+from .pool import PoolMetrics, engine_options, get_pool_preset
+from .replica import is_replica_lagging, wrote_recently
+from .stats import reconcile_all_stats
 
 DB_ENGINE = 'postgresql'
+# The API uses asyncpg, so database waits do not block the event loop. psycopg2 is still used by the synchronous
+# tooling: migrations and scripts
 DB_DRIVER = 'psycopg2'
+ASYNC_DB_DRIVER = 'asyncpg'
 
 
 class DBConfigException(Exception):
@@ -26,7 +35,7 @@ class DBConfigException(Exception):
 # Create a global engine and session factory
 # On the GitHub actions CI, the hostname of the service container for the database is the label. Since in our workflow
 # the service is named "postgres", the hostname here must also be "postgres"
-def get_db_url():
+def get_db_url(driver: str = DB_DRIVER, host: str | None = None, port: str | None = None):
     current_env = os.environ.get('PEEP_ENV')
     if not current_env:
         logger.error('PEEP_ENV environment variable is not set')
@@ -45,64 +54,162 @@ def get_db_url():
         user = os.environ.get('DB_USER')
         password = os.environ.get('DB_PASSWORD')
     else:
-        logger.info('Retrieving DB credentials from Parameter Store')
-        ssm = boto3.client('ssm')
-
-        response = ssm.get_parameter(Name=f'/peep/{current_env}/db-user')
-        user = response['Parameter']['Value']
-        logger.info('found user param')
-
-        response = ssm.get_parameter(Name=f'/peep/{current_env}/db-password')
-        password = response['Parameter']['Value']
-        logger.info('found password param')
-
-        logger.info('DB credentials retrieved successfully')
+        user, password = get_parameter_store_credentials(current_env)
 
     if not user or not password:
         logger.error('Could not retrieve DB credentials for user and password')
         raise DBConfigException(
             'DB_USER and DB_PASSWORD environment variables not set, or values not found in Parameter Store')
 
-    host = os.environ.get('DB_HOST')
-    port = os.environ.get('DB_PORT')
+    host = host or os.environ.get('DB_HOST')
+    port = port or os.environ.get('DB_PORT')
     db_name = os.environ.get('DB_NAME')
 
     logger.info('Connecting to database')
-    return f'{DB_ENGINE}+{DB_DRIVER}://{user}:{password}@{host}:{port}/{db_name}'
+    return f'{DB_ENGINE}+{driver}://{user}:{password}@{host}:{port}/{db_name}'
+
+
+def get_parameter_store_credentials(current_env: str) -> tuple[str | None, str | None]:
+    logger.info('Retrieving DB credentials from Parameter Store')
+    # Imported here because boto3 is one of the slowest imports of the cold start, and only the live env needs it
+    import boto3
+    ssm = boto3.client('ssm')
+
+    # Both parameters in a single round trip
+    user_param = f'/peep/{current_env}/db-user'
+    password_param = f'/peep/{current_env}/db-password'
+    response = ssm.get_parameters(Names=[user_param, password_param])
+    if response['InvalidParameters']:
+        logger.error(f'Parameters not found in Parameter Store: {response["InvalidParameters"]}')
+
+    values = {parameter['Name']: parameter['Value'] for parameter in response['Parameters']}
+    logger.info('DB credentials retrieved successfully')
+    return values.get(user_param), values.get(password_param)
+
+
+# The engines and the session factory are created on first use instead of on import, so a Lambda cold start does not
+# pay for the credentials lookup and the connection until a request actually needs the database, and importing
+# lambdas.db (e.g: from tests or scripts) does not require a database at all.
+# The pool of each engine is configured with the PEEP_DB_* environment variables, see lambdas/db/pool.py, and its queries
+# are counted into the metrics of the request running them, see lambdas/instrumentation.py
+pool_metrics = {'sync': PoolMetrics(), 'async': PoolMetrics(), 'read': PoolMetrics()}
+
+
+@functools.cache
+def get_engine():
+    engine = create_engine(get_db_url(), **engine_options(QueuePool, pool_metrics['sync']))
+    pool_metrics['sync'].watch(engine)
+    watch_queries(engine)
+    return engine
+
+
+@functools.cache
+def get_async_engine():
+    engine = create_async_engine(get_db_url(ASYNC_DB_DRIVER), **engine_options(AsyncAdaptedQueuePool,
+                                                                                pool_metrics['async']))
+    pool_metrics['async'].watch(engine.sync_engine)
+    watch_queries(engine.sync_engine)
+    return engine
+
+
+@functools.cache
+def get_async_read_engine():
+    """
+    Engine of the read replica at DB_READ_HOST (and DB_READ_PORT, by default the same as DB_PORT). Without a replica
+    it's the primary engine.
+    """
+    if not has_read_replica():
+        return get_async_engine()
+
+    db_url = get_db_url(ASYNC_DB_DRIVER, host=os.environ['DB_READ_HOST'], port=os.environ.get('DB_READ_PORT'))
+    engine = create_async_engine(db_url, **engine_options(AsyncAdaptedQueuePool, pool_metrics['read']))
+    pool_metrics['read'].watch(engine.sync_engine)
+    watch_queries(engine.sync_engine)
+    return engine
+
 
+def has_read_replica() -> bool:
+    return bool(os.environ.get('DB_READ_HOST'))
 
-# Create the SQLAlchemy engine
-engine = create_engine(get_db_url(), pool_pre_ping=True, echo=True)
 
-# Create a thread-safe scoped session factory
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+@functools.cache
+def get_session_factory():
+    # expire_on_commit=False because with AsyncSession, reading an expired attribute after a commit would need to
+    # implicitly await a query, which is not possible
+    return async_sessionmaker(autoflush=False, expire_on_commit=False, bind=get_async_engine())
 
 
-def install_extensions():
-    with SessionLocal() as session:
-        session.execute(text('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";'))
-        session.commit()
+@functools.cache
+def get_read_session_factory():
+    return async_sessionmaker(autoflush=False, expire_on_commit=False, bind=get_async_read_engine())
 
 
-def get_db_session():
+def get_pool_metrics() -> dict:
+    """
+    Metrics of the pools of the engines created so far by this process (e.g: the API only creates the async one).
+    """
+    engines = {}
+    if get_engine.cache_info().currsize:
+        engines['sync'] = pool_metrics['sync'].snapshot(get_engine().pool)
+    if get_async_engine.cache_info().currsize:
+        engines['async'] = pool_metrics['async'].snapshot(get_async_engine().pool)
+    if has_read_replica() and get_async_read_engine.cache_info().currsize:
+        engines['read'] = pool_metrics['read'].snapshot(get_async_read_engine().pool)
+    return {'preset': get_pool_preset(), 'engines': engines}
+
+
+async def get_db_session():
     """
     Dependency or utility function to provide a database session.
     Ensures that sessions are properly closed after use.
     """
-    db = SessionLocal()
-    try:
+    async with get_session_factory()() as db:
         yield db
-    finally:
-        db.close()
 
 
-# Initialize the database (useful for creating tables)
+async def get_read_db_session(request: Request):
+    """
+    Dependency for the endpoints that only read: a session on the read replica, unless there is none, it's lagging
+    behind, or the user in the path wrote recently (so they read their own writes). Then it's on the primary.
+    """
+    if await should_read_from_primary(request.path_params.get('user_id')):
+        session_factory = get_session_factory()
+    else:
+        session_factory = get_read_session_factory()
+
+    async with session_factory() as db:
+        yield db
+
+
+async def should_read_from_primary(user_id: str | None) -> bool:
+    if not has_read_replica():
+        return True
+    if user_id is not None and wrote_recently(user_id):
+        return True
+    return await is_replica_lagging(get_async_read_engine())
+
+
+# Initialize the database (useful for creating tables). This is a deploy-time step, it is not run on import: see
+# migrate_handler below and lambdas/db/__main__.py
 def init_db():
     """
-    Initialize the database by creating all tables defined in ORM models.
+    Initialize the database by applying the pending migrations.
     """
-    install_extensions()
-    Base.metadata.create_all(bind=engine)
+    migrate(get_engine())
 
 
-init_db()
+def migrate_handler(event, context):
+    """
+    Lambda entry point for the function that runs the migrations once per deployment (see cdk/cdk/cdk_stack.py).
+    """
+    init_db()
+    return {'message': 'Migrations applied successfully'}
+
+
+def reconcile_stats_handler(event, context):
+    """
+    Lambda entry point for the scheduled function that repairs the drift of the users counters (see
+    cdk/cdk/cdk_stack.py).
+    """
+    fixed = reconcile_all_stats(get_engine())
+    return {'message': 'Stats reconciled successfully', 'fixed': fixed}
@@ -0,0 +1,111 @@
+import importlib
+import logging
+import pkgutil
+from types import ModuleType
+
+from sqlalchemy import Connection, Engine, text
+
+from . import versions
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Arbitrary key for pg_advisory_lock, so two processes (e.g: concurrent deployments) never run migrations at once
+MIGRATIONS_LOCK_KEY = 7_312_015
+
+CREATE_MIGRATIONS_TABLE = text('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name varchar NOT NULL,
+        applied_at timestamp without time zone NOT NULL DEFAULT now()
+    )
+''')
+
+
+class MigrationException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+# Migrations are the modules in the versions package, named v<number>_<description>.py. Each one must define an
+# `upgrade(connection)` function, and can set `transactional = False` to run outside a transaction, which is
+# required for statements like CREATE INDEX CONCURRENTLY that avoid locking live tables for writes.
+def discover_migrations() -> list[tuple[int, str, ModuleType]]:
+    migrations = []
+    for module_info in pkgutil.iter_modules(versions.__path__):
+        version, _, description = module_info.name.partition('_')
+        if not version.startswith('v') or not version[1:].isdigit():
+            raise MigrationException(f'Invalid migration module name: {module_info.name}')
+        module = importlib.import_module(f'{versions.__name__}.{module_info.name}')
+        migrations.append((int(version[1:]), module_info.name, module))
+
+    migrations.sort(key=lambda migration: migration[0])
+    numbers = [number for number, _, _ in migrations]
+    if len(numbers) != len(set(numbers)):
+        raise MigrationException('Duplicated migration versions')
+
+    return migrations
+
+
+def migrate(engine: Engine):
+    """
+    Apply, in order, every migration not yet recorded in the schema_migrations table.
+    """
+    # Everything runs on the connection holding the lock, so it works with a pool of a single connection too (e.g: the
+    # "lambda" preset of the deploy-time function), instead of waiting for a second one that never comes
+    with engine.connect() as connection:
+        default_isolation_level = connection.default_isolation_level
+        set_isolation_level(connection, 'AUTOCOMMIT')
+        connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATIONS_LOCK_KEY})
+        try:
+            connection.execute(CREATE_MIGRATIONS_TABLE)
+            applied = set(connection.scalars(text('SELECT version FROM schema_migrations')))
+
+            for version, name, module in discover_migrations():
+                if version in applied:
+                    continue
+
+                logger.info(f'Applying migration {name}')
+                if getattr(module, 'transactional', True):
+                    set_isolation_level(connection, default_isolation_level)
+                    with connection.begin():
+                        module.upgrade(connection)
+                        record_migration(connection, version, name)
+                    set_isolation_level(connection, 'AUTOCOMMIT')
+                else:
+                    module.upgrade(connection)
+                    record_migration(connection, version, name)
+        finally:
+            # The lock belongs to the session, so it's released even after a failed (and rolled back) migration
+            set_isolation_level(connection, 'AUTOCOMMIT')
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATIONS_LOCK_KEY})
+
+
+def set_isolation_level(connection: Connection, isolation_level: str):
+    # SQLAlchemy begins a transaction on the first statement even in AUTOCOMMIT (where it does nothing on the database),
+    # and the isolation level can only change outside of one
+    if connection.in_transaction():
+        connection.commit()
+    connection.execution_options(isolation_level=isolation_level)
+
+
+def record_migration(connection: Connection, version: int, name: str):
+    connection.execute(text('INSERT INTO schema_migrations (version, name) VALUES (:version, :name)'),
+                       {'version': version, 'name': name})
+
+
+def create_index_concurrently(connection: Connection, name: str, definition: str):
+    """
+    Build an index without blocking writes to the table. Must run on a non-transactional migration.
+    """
+    # A failed concurrent build leaves an INVALID index behind, which IF NOT EXISTS would happily skip, so drop it first
+    is_valid = connection.scalar(
+        text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'), {'name': name}
+    )
+    if is_valid is False:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+
+    connection.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}'))
@@ -0,0 +1,39 @@
+from sqlalchemy import Connection, text
+
+# Schema as it was created by Base.metadata.create_all before migrations existed, hence the IF NOT EXISTS: on those
+# databases this migration only gets recorded.
+STATEMENTS = [
+    'CREATE EXTENSION IF NOT EXISTS "uuid-ossp"',
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id uuid PRIMARY KEY DEFAULT uuid_generate_v4(),
+        name varchar NOT NULL,
+        email varchar NOT NULL,
+        username varchar NOT NULL UNIQUE,
+        password varchar NOT NULL,
+        created_at timestamp without time zone NOT NULL DEFAULT now(),
+        updated_at timestamp without time zone NOT NULL DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS peeps (
+        id uuid PRIMARY KEY DEFAULT uuid_generate_v4(),
+        user_id uuid NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        content varchar NOT NULL,
+        created_at timestamp without time zone NOT NULL DEFAULT now(),
+        updated_at timestamp without time zone NOT NULL DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS follows (
+        follower_id uuid REFERENCES users (id) ON DELETE CASCADE,
+        followee_id uuid REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (follower_id, followee_id)
+    )
+    ''',
+]
+
+
+def upgrade(connection: Connection):
+    for statement in STATEMENTS:
+        connection.execute(text(statement))
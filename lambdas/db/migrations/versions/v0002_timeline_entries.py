@@ -0,0 +1,44 @@
+from sqlalchemy import Connection, text
+
+# The default FANOUT_FOLLOWER_THRESHOLD of lambdas/db/timeline.py when this migration was written. It's a copy, so this
+# migration keeps doing the same on a new database whatever the app's threshold becomes
+FANOUT_FOLLOWER_THRESHOLD = 10000
+
+STATEMENTS = [
+    # Since PostgreSQL 11, adding a column with a constant default does not rewrite the table
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS fanout_on_read boolean NOT NULL DEFAULT false',
+    '''
+    CREATE TABLE IF NOT EXISTS timeline_entries (
+        user_id uuid REFERENCES users (id) ON DELETE CASCADE,
+        peep_id uuid REFERENCES peeps (id) ON DELETE CASCADE,
+        author_id uuid NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        created_at timestamp without time zone NOT NULL,
+        PRIMARY KEY (user_id, peep_id)
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_id_created_at_peep_id
+        ON timeline_entries (user_id, created_at DESC, peep_id)
+    ''',
+    'CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_id_author_id ON timeline_entries (user_id, author_id)',
+    'CREATE INDEX IF NOT EXISTS ix_timeline_entries_peep_id ON timeline_entries (peep_id)',
+    # Backfill the timelines of the existing follows, skipping the authors that are too big to be fanned out on write
+    '''
+    UPDATE users SET fanout_on_read = true
+    WHERE id IN (SELECT followee_id FROM follows GROUP BY followee_id HAVING count(*) > :threshold)
+    ''',
+    '''
+    INSERT INTO timeline_entries (user_id, peep_id, author_id, created_at)
+    SELECT follows.follower_id, peeps.id, peeps.user_id, peeps.created_at
+    FROM follows
+    JOIN peeps ON peeps.user_id = follows.followee_id
+    JOIN users ON users.id = peeps.user_id
+    WHERE NOT users.fanout_on_read
+    ON CONFLICT DO NOTHING
+    ''',
+]
+
+
+def upgrade(connection: Connection):
+    for statement in STATEMENTS:
+        connection.execute(text(statement), {'threshold': FANOUT_FOLLOWER_THRESHOLD})
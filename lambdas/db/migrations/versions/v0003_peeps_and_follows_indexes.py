@@ -0,0 +1,12 @@
+from sqlalchemy import Connection
+
+from lambdas.db.migrations.main import create_index_concurrently
+
+transactional = False
+
+
+def upgrade(connection: Connection):
+    # Peeps of a user, newest first: fan-out on read, backfills on follow and the profile pages
+    create_index_concurrently(connection, 'ix_peeps_user_id_created_at_id', 'ON peeps (user_id, created_at DESC, id)')
+    # The primary key (follower_id, followee_id) only covers lookups by follower, this one covers followers of a user
+    create_index_concurrently(connection, 'ix_follows_followee_id_follower_id', 'ON follows (followee_id, follower_id)')
@@ -0,0 +1,6 @@
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    # Since PostgreSQL 11, adding a column with a constant default does not rewrite the table
+    connection.execute(text('ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version integer NOT NULL DEFAULT 0'))
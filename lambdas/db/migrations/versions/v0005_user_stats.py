@@ -0,0 +1,30 @@
+from sqlalchemy import Connection, text
+
+CREATE_USER_STATS_TABLE = '''
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id uuid PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+    followers_count integer NOT NULL DEFAULT 0,
+    followees_count integer NOT NULL DEFAULT 0,
+    peeps_count integer NOT NULL DEFAULT 0
+)
+'''
+
+# The counters of every user, like lambdas.db.stats.reconcile_stats computed them when this migration was written. It's
+# a copy, so this migration keeps doing the same on a new database whatever that function becomes
+BACKFILL_USER_STATS = '''
+INSERT INTO user_stats (user_id, followers_count, followees_count, peeps_count)
+SELECT users.id,
+       (SELECT count(*) FROM follows WHERE follows.followee_id = users.id),
+       (SELECT count(*) FROM follows WHERE follows.follower_id = users.id),
+       (SELECT count(*) FROM peeps WHERE peeps.user_id = users.id)
+FROM users
+ORDER BY users.id
+ON CONFLICT (user_id) DO UPDATE SET followers_count = excluded.followers_count,
+                                    followees_count = excluded.followees_count,
+                                    peeps_count = excluded.peeps_count
+'''
+
+
+def upgrade(connection: Connection):
+    connection.execute(text(CREATE_USER_STATS_TABLE))
+    connection.execute(text(BACKFILL_USER_STATS))
@@ -0,0 +1,18 @@
+from sqlalchemy import Connection, text
+
+from lambdas.db.migrations.main import create_index_concurrently
+
+transactional = False
+
+# The SEARCH_CONFIG of lambdas/db/models.py when this migration was written. It's a copy, so this migration keeps
+# creating the same column on a new database whatever the app's configuration becomes
+SEARCH_CONFIG = 'english'
+
+
+def upgrade(connection: Connection):
+    # Unlike a plain column, a stored generated column rewrites the table, which is locked meanwhile
+    connection.execute(text(
+        'ALTER TABLE peeps ADD COLUMN IF NOT EXISTS content_tsv tsvector '
+        f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', content)) STORED"
+    ))
+    create_index_concurrently(connection, 'ix_peeps_content_tsv', 'ON peeps USING gin (content_tsv)')
@@ -0,0 +1,12 @@
+from sqlalchemy import Connection
+
+from lambdas.db.migrations.main import create_index_concurrently
+
+transactional = False
+
+
+def upgrade(connection: Connection):
+    # text_pattern_ops compares character by character, so LIKE 'prefix%' can use the index whatever the collation is
+    create_index_concurrently(connection, 'ix_users_lower_username_pattern',
+                              'ON users (lower(username) text_pattern_ops)')
+    create_index_concurrently(connection, 'ix_users_lower_name_pattern', 'ON users (lower(name) text_pattern_ops)')
@@ -1,14 +1,18 @@
 from datetime import datetime
 from typing import List
 
-from sqlalchemy import ForeignKey, func
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Computed, ForeignKey, Index, false, func, text
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 # Base class for ORM models
 Base = declarative_base()
 
+# Text search configuration of the peeps: the same one must be used to build the documents and the queries, otherwise
+# the words are normalized differently (and the GIN index can't be used)
+SEARCH_CONFIG = 'english'
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -18,6 +22,11 @@ class User(Base):
     email: Mapped[str] = mapped_column(nullable=False)
     username: Mapped[str] = mapped_column(nullable=False, unique=True)
     password: Mapped[str] = mapped_column(nullable=False)
+    # Accounts with too many followers are not fanned out on write (see lambdas/db/timeline.py), their peeps are merged
+    # into the timelines at read time instead. Once set, this is never unset, so their peeps are never missing.
+    fanout_on_read: Mapped[bool] = mapped_column(nullable=False, default=False, server_default=false())
+    # Embedded in the access tokens: bumping it revokes all the tokens issued until then
+    token_version: Mapped[int] = mapped_column(nullable=False, default=0, server_default=text('0'))
     peeps: Mapped[List['Peep']] = relationship(back_populates='user', cascade='all, delete-orphan')
     created_at: Mapped[datetime] = mapped_column(server_default=func.now(), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), nullable=False, onupdate=func.now())
@@ -45,6 +54,11 @@ class Peep(Base):
     # This is a Python-level field to refer to the related object directly
     user: Mapped['User'] = relationship(back_populates='peeps')
     content: Mapped[str] = mapped_column(nullable=False)
+    # Full-text search document of the content, kept up to date by PostgreSQL itself (see lambdas/db/search.py).
+    # Deferred, so it's not loaded along with the peeps.
+    content_tsv: Mapped[str] = mapped_column(TSVECTOR,
+                                             Computed(f"to_tsvector('{SEARCH_CONFIG}', content)", persisted=True),
+                                             deferred=True)
     created_at: Mapped[datetime] = mapped_column(server_default=func.now(), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), nullable=False, onupdate=func.now())
 
@@ -56,3 +70,56 @@ class Follows(Base):
                                               primary_key=True)
     followee_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='cascade'),
                                               primary_key=True)
+
+
+# Keep these in sync with the migrations in lambdas/db/migrations/versions
+Index('ix_peeps_user_id_created_at_id', Peep.user_id, Peep.created_at.desc(), Peep.id)
+Index('ix_follows_followee_id_follower_id', Follows.followee_id, Follows.follower_id)
+Index('ix_peeps_content_tsv', Peep.content_tsv, postgresql_using='gin')
+# For the case-insensitive prefix searches (LIKE 'prefix%') of the users autocomplete
+Index('ix_users_lower_username_pattern', func.lower(User.username).label('lower_username'),
+      postgresql_ops={'lower_username': 'text_pattern_ops'})
+Index('ix_users_lower_name_pattern', func.lower(User.name).label('lower_name'),
+      postgresql_ops={'lower_name': 'text_pattern_ops'})
+
+
+class TimelineEntry(Base):
+    """
+    Materialized timeline: one row per (timeline owner, peep) for every peep of the users they follow, filled when the
+    peep is created (fan-out on write), so reading a timeline is a single index range scan over this table.
+    """
+    __tablename__ = 'timeline_entries'
+
+    # Owner of the timeline, i.e. the follower
+    user_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='cascade'),
+                                          primary_key=True)
+    # ON DELETE CASCADE removes the entries from every timeline when the peep is deleted
+    peep_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('peeps.id', ondelete='cascade'),
+                                          primary_key=True)
+    # Denormalized from the peep, so unfollowing can remove the followee's entries without joining peeps
+    author_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='cascade'),
+                                            nullable=False)
+    # Copied from the peep, so the timeline can be sorted and paginated without joining peeps
+    created_at: Mapped[datetime] = mapped_column(nullable=False)
+
+
+Index('ix_timeline_entries_user_id_created_at_peep_id',
+      TimelineEntry.user_id, TimelineEntry.created_at.desc(), TimelineEntry.peep_id)
+Index('ix_timeline_entries_user_id_author_id', TimelineEntry.user_id, TimelineEntry.author_id)
+Index('ix_timeline_entries_peep_id', TimelineEntry.peep_id)
+
+
+class UserStats(Base):
+    """
+    Counters of each user, kept up to date in the same transactions that follow, unfollow, create and remove peeps (see
+    lambdas/db/stats.py), so reading them is a primary key lookup instead of COUNT(*)s over follows and peeps. They are
+    in their own table so these frequent writes do not touch (or lock) the users rows.
+    A missing row means all zeros.
+    """
+    __tablename__ = 'user_stats'
+
+    user_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='cascade'),
+                                          primary_key=True)
+    followers_count: Mapped[int] = mapped_column(nullable=False, default=0, server_default=text('0'))
+    followees_count: Mapped[int] = mapped_column(nullable=False, default=0, server_default=text('0'))
+    peeps_count: Mapped[int] = mapped_column(nullable=False, default=0, server_default=text('0'))
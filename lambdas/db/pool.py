@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+from sqlalchemy import Engine, event
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+
+
+class PoolConfigException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+# Starting points for the connection pool, picked with PEEP_DB_POOL_PRESET (by default "lambda" on AWS Lambda and
+# "server" anywhere else), and then fine-tuned with the PEEP_DB_* variables of POOL_SETTINGS
+POOL_PRESETS = {
+    # A Lambda instance handles one request at a time and is frozen between invocations, so a single connection reused
+    # across invocations is all it needs. There is no ping on checkout (a round trip per request): the connection is
+    # recycled every 5 minutes instead, and a dropped one is replaced after the request that finds it fails.
+    'lambda': {'pool_size': 1, 'max_overflow': 0, 'pool_recycle': 300, 'pool_pre_ping': False},
+    # Behind RDS Proxy the proxy does the pooling, so each request opens (and closes) a cheap proxy connection
+    'lambda-proxy': {'poolclass': NullPool, 'pool_pre_ping': False},
+    # Long-running uvicorn servers: each worker process has its own pool, so the database sees up to
+    # workers * (pool_size + max_overflow) connections
+    'server': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 1800, 'pool_timeout': 30, 'pool_pre_ping': True},
+}
+
+
+def parse_bool(value: str) -> bool:
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Environment variable -> (create_engine option, parser)
+POOL_SETTINGS = {
+    'PEEP_DB_POOL_SIZE': ('pool_size', int),
+    'PEEP_DB_MAX_OVERFLOW': ('max_overflow', int),
+    'PEEP_DB_POOL_RECYCLE': ('pool_recycle', int),
+    'PEEP_DB_POOL_TIMEOUT': ('pool_timeout', float),
+    'PEEP_DB_POOL_PRE_PING': ('pool_pre_ping', parse_bool),
+}
+QUEUE_POOL_OPTIONS = {'pool_size', 'max_overflow', 'pool_timeout'}
+
+
+def get_pool_preset() -> str:
+    default_preset = 'lambda' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'server'
+    preset = os.environ.get('PEEP_DB_POOL_PRESET', default_preset)
+    if preset not in POOL_PRESETS:
+        raise PoolConfigException(f'Unknown PEEP_DB_POOL_PRESET {preset!r}, must be one of {", ".join(POOL_PRESETS)}')
+    return preset
+
+
+class PoolMetrics:
+    """
+    Counters of the connection pool of an engine, since the process started. A checkout "waits" when every
+    connection is checked out and no more can be opened, so it has to wait for another request to give one back: if
+    that happens often, the pool is too small (or the requests hold their connections for too long).
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def increment(self, counter: str, amount: float = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def watch(self, engine: Engine):
+        # The pool events are kept when the pool is recreated (e.g: on dispose), unlike anything set on the pool itself
+        event.listen(engine, 'checkout', lambda *args: self.increment('checkouts'))
+        event.listen(engine, 'connect', lambda *args: self.increment('connects'))
+        event.listen(engine, 'invalidate', lambda *args: self.increment('invalidations'))
+
+    def snapshot(self, pool: Pool) -> dict:
+        with self._lock:
+            metrics = {
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 6),
+            }
+        metrics['pool'] = type(pool).__name__
+        if isinstance(pool, QueuePool):
+            metrics.update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+        return metrics
+
+
+def metered_pool_class(pool_class: type[QueuePool], metrics: PoolMetrics, max_overflow: int) -> type[QueuePool]:
+    """
+    `pool_class` timing the checkouts that wait, with its public API only: connect() is what the engines call for every
+    checkout, and the pool is at capacity when no connection is idle and the overflow (at most `max_overflow`, the
+    same as the pool's, or -1 for no limit) is used up.
+    """
+    # The metrics are bound to the class (not the instance) because SQLAlchemy recreates the pool on dispose
+    class MeteredPool(pool_class):
+        def connect(self):
+            at_capacity = self.checkedin() == 0 and 0 <= max_overflow <= self.overflow()
+            if not at_capacity:
+                return super().connect()
+
+            start = time.perf_counter()
+            try:
+                return super().connect()
+            finally:
+                metrics.increment('waits')
+                metrics.increment('wait_seconds', time.perf_counter() - start)
+
+    MeteredPool.__name__ = f'Metered{pool_class.__name__}'
+    return MeteredPool
+
+
+def engine_options(queue_pool_class: type[QueuePool], metrics: PoolMetrics) -> dict:
+    """
+    Keyword arguments of create_engine/create_async_engine for the current preset and PEEP_DB_* variables.
+    `queue_pool_class` is the pool used by the presets that pool connections: QueuePool for a sync engine,
+    AsyncAdaptedQueuePool for an async one.
+    """
+    options = dict(POOL_PRESETS[get_pool_preset()])
+    for variable, (option, parse) in POOL_SETTINGS.items():
+        if os.environ.get(variable):
+            options[option] = parse(os.environ[variable])
+
+    if options.get('poolclass') is NullPool:
+        options = {option: value for option, value in options.items() if option not in QUEUE_POOL_OPTIONS}
+    else:
+        # 10 is the default of QueuePool
+        options['poolclass'] = metered_pool_class(queue_pool_class, metrics, options.get('max_overflow', 10))
+
+    # Logging every statement is for debugging only
+    options['echo'] = parse_bool(os.environ.get('PEEP_DB_ECHO', 'false'))
+    return options
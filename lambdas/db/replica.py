@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from lambdas.cache import TTLCache
+
+logger = logging.getLogger()
+
+# Reads go to the primary while the replica is further behind than this, in seconds
+MAX_REPLICA_LAG = float(os.environ.get('PEEP_DB_MAX_REPLICA_LAG', 1))
+# The lag is checked at most once per interval, not on every request
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('PEEP_DB_REPLICA_LAG_CHECK_INTERVAL', 5))
+# A replica that does not answer the check within this time is treated as lagging
+REPLICA_LAG_CHECK_TIMEOUT = float(os.environ.get('PEEP_DB_REPLICA_LAG_CHECK_TIMEOUT', 1))
+# After writing, a user reads from the primary for this long, so they see their own writes even if the replica lags
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('PEEP_DB_READ_YOUR_WRITES_WINDOW', 5))
+
+# A replica that replayed everything it received is up to date, however old its last replayed transaction is (on an
+# idle database that's normal). On a primary both functions return NULL, so the lag is 0.
+REPLICA_LAG_QUERY = text('''
+SELECT COALESCE(
+    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+         ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END,
+    0
+)
+''')
+
+replica_lag_cache = TTLCache(maxsize=1, ttl=REPLICA_LAG_CHECK_INTERVAL)
+# Users that wrote recently. Only this process knows about the writes it handled: on another process (e.g: another
+# Lambda instance) the user may still read from a lagging replica, but never for longer than MAX_REPLICA_LAG
+recent_writes = TTLCache(maxsize=int(os.environ.get('PEEP_DB_RECENT_WRITES_CACHE_SIZE', 10000)),
+                         ttl=READ_YOUR_WRITES_WINDOW)
+
+
+async def replica_lag(engine: AsyncEngine) -> float:
+    async with engine.connect() as connection:
+        return float(await connection.scalar(REPLICA_LAG_QUERY))
+
+
+async def is_replica_lagging(engine: AsyncEngine) -> bool:
+    lag = replica_lag_cache.get('lag')
+    if lag is None:
+        try:
+            lag = await asyncio.wait_for(replica_lag(engine), REPLICA_LAG_CHECK_TIMEOUT)
+        # Before Python 3.11 (the Lambda runtime is 3.10), asyncio.TimeoutError is not the builtin TimeoutError
+        except (asyncio.TimeoutError, OSError, SQLAlchemyError) as e:
+            # Unreachable, or too slow to answer: the primary can serve the reads meanwhile
+            logger.warning(f'Could not check the lag of the read replica: {e!r}')
+            lag = float('inf')
+        replica_lag_cache.set('lag', lag)
+
+    return lag > MAX_REPLICA_LAG
+
+
+def remember_writes(*user_ids: UUID | str):
+    for user_id in user_ids:
+        recent_writes.set(str(user_id).lower(), True)
+
+
+def wrote_recently(user_id: UUID | str) -> bool:
+    return recent_writes.get(str(user_id).lower(), False)
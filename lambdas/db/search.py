@@ -0,0 +1,73 @@
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import ColumnElement, Select, desc, func, select, tuple_, union
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import UnaryExpression
+
+from .models import SEARCH_CONFIG, Follows, Peep, User
+
+
+def search_query(terms: str, limit: int, cursor: tuple[float, datetime, UUID] | None = None,
+                 follower_id: UUID | None = None) -> Select:
+    """
+    Page of the peeps matching `terms`, best matches first. The matches are found through the GIN index on
+    peeps.content_tsv, so only they are ranked. With `follower_id`, only the peeps of the users they follow.
+    """
+    # websearch_to_tsquery accepts anything a user can type (quotes, OR, -word), it never fails on the syntax
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, terms)
+    rank = func.ts_rank(Peep.content_tsv, query)
+
+    statement = (
+        select(Peep.id,
+               Peep.user_id,
+               Peep.content,
+               rank.label('rank'),
+               Peep.created_at)
+        .where(Peep.content_tsv.bool_op('@@')(query))
+        .order_by(desc(rank), desc(Peep.created_at), desc(Peep.id))
+        .limit(limit)
+    )
+    if follower_id is not None:
+        statement = (
+            statement
+            .join(Follows, Follows.followee_id == Peep.user_id)
+            .where(Follows.follower_id == follower_id)
+        )
+    if cursor is not None:
+        statement = statement.where(tuple_(rank, Peep.created_at, Peep.id) < tuple_(*cursor))
+
+    return statement
+
+
+def user_search_query(prefix: str, limit: int) -> Select:
+    """
+    Users whose username or name starts with `prefix`, ignoring case, by lowercase username. Each LIKE 'prefix%' is a
+    range scan of its lower(...) text_pattern_ops index (the unique index on username can't be used for LIKE, nor
+    ignore the case), read in the order of the index so it stops after `limit` rows: a short prefix matches a large
+    share of the users, which an OR of both, or another order, would have to collect and sort first. Only the up to
+    2 * `limit` rows of both scans are sorted.
+    """
+    prefix = prefix.lower()
+    lower_username = func.lower(User.username)
+    lower_name = func.lower(User.name)
+    username_matches = (
+        select(User.id, User.username, User.name)
+        .where(lower_username.startswith(prefix, autoescape=True))
+        .order_by(pattern_order(lower_username))
+        .limit(limit)
+    )
+    name_matches = (
+        select(User.id, User.username, User.name)
+        .where(lower_name.startswith(prefix, autoescape=True))
+        .order_by(pattern_order(lower_name))
+        .limit(limit)
+    )
+    matches = union(username_matches, name_matches).subquery()
+    return select(matches).order_by(pattern_order(func.lower(matches.c.username))).limit(limit)
+
+
+def pattern_order(expression: ColumnElement) -> UnaryExpression:
+    # ORDER BY ... USING ~<~, the order of the text_pattern_ops indexes. A plain ORDER BY (or COLLATE "C") can't read
+    # them in order
+    return UnaryExpression(expression, modifier=operators.custom_op('USING ~<~'))
@@ -0,0 +1,112 @@
+from collections import defaultdict
+from typing import Iterable
+from uuid import UUID
+
+from sqlalchemy import Connection, Engine, Select, any_, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Follows, Peep, User, UserStats
+from .utils import integer_array, uuid_array
+
+STATS_COLUMNS = ['followers_count', 'followees_count', 'peeps_count']
+
+# Users repaired per transaction by reconcile_all_stats
+RECONCILE_BATCH_SIZE = 1000
+
+
+async def update_stats(db: AsyncSession, followers: Iterable[UUID] = (), followees: Iterable[UUID] = (),
+                       peeps: Iterable[UUID] = (), sign: int = 1):
+    """
+    Add one (or subtract it, with sign=-1) to the counter of each user id given, e.g: for a new follow the followee
+    gains a follower and the follower gains a followee. Must run in the same transaction as the change it counts.
+    It's a single statement for all the users, which locks their rows in id order, so concurrent updates cannot
+    deadlock.
+    """
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for index, user_ids in enumerate((followers, followees, peeps)):
+        for user_id in user_ids:
+            deltas[user_id][index] += sign
+    if not deltas:
+        return
+
+    user_ids = list(deltas)
+    rows = (
+        func.unnest(uuid_array(user_ids), *[integer_array([deltas[user_id][index] for user_id in user_ids])
+                                            for index in range(len(STATS_COLUMNS))])
+        .table_valued('user_id', *STATS_COLUMNS)
+        .render_derived(name='deltas')
+    )
+    statement = insert(UserStats).from_select(['user_id', *STATS_COLUMNS], select(rows).order_by(rows.c.user_id))
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[UserStats.user_id],
+        set_={name: getattr(UserStats, name) + statement.excluded[name] for name in STATS_COLUMNS},
+    ))
+
+
+async def remove_user_stats(user_id: UUID, db: AsyncSession):
+    """
+    Discount a user that is about to be deleted from the counters of the users they follow and are followed by (the
+    follows themselves are removed by the ON DELETE CASCADE). Done in SQL because celebrities can have millions of
+    followers.
+    """
+    followee_ids = select(Follows.followee_id).where(Follows.follower_id == user_id)
+    await db.execute(update(UserStats).where(UserStats.user_id.in_(followee_ids))
+                     .values(followers_count=UserStats.followers_count - 1))
+    follower_ids = select(Follows.follower_id).where(Follows.followee_id == user_id)
+    await db.execute(update(UserStats).where(UserStats.user_id.in_(follower_ids))
+                     .values(followees_count=UserStats.followees_count - 1))
+
+
+def stats_query(user_id: UUID) -> Select:
+    # Outer join, because users without a user_stats row have all their counters at zero
+    return (
+        select(*[func.coalesce(getattr(UserStats, name), 0).label(name) for name in STATS_COLUMNS])
+        .select_from(User)
+        .outerjoin(UserStats, UserStats.user_id == User.id)
+        .where(User.id == user_id)
+    )
+
+
+def reconcile_stats(connection: Connection, user_ids: list[UUID] | None = None) -> int:
+    """
+    Recompute the counters of `user_ids` (all the users by default) with COUNT(*)s, and fix the ones that drifted
+    (e.g: rows changed by hand, or by a bug). Returns how many users were fixed.
+    """
+    actual_stats = select(
+        User.id,
+        select(func.count()).where(Follows.followee_id == User.id).scalar_subquery(),
+        select(func.count()).where(Follows.follower_id == User.id).scalar_subquery(),
+        select(func.count()).where(Peep.user_id == User.id).scalar_subquery(),
+    ).order_by(User.id)
+    if user_ids is not None:
+        actual_stats = actual_stats.where(User.id == any_(uuid_array(user_ids)))
+
+    statement = insert(UserStats).from_select(['user_id', *STATS_COLUMNS], actual_stats)
+    statement = statement.on_conflict_do_update(
+        index_elements=[UserStats.user_id],
+        set_={name: statement.excluded[name] for name in STATS_COLUMNS},
+        # Only write the rows that are actually wrong
+        where=or_(*[getattr(UserStats, name) != statement.excluded[name] for name in STATS_COLUMNS]),
+    )
+    return len(connection.execute(statement.returning(UserStats.user_id)).all())
+
+
+def reconcile_all_stats(engine: Engine, batch_size: int = RECONCILE_BATCH_SIZE) -> int:
+    """
+    Periodic job (see lambdas.db.main.reconcile_stats_handler): reconcile the counters of every user, walking the users
+    in batches of `batch_size`, each one in its own short transaction.
+    """
+    fixed = 0
+    last_id = None
+    while True:
+        batch = select(User.id).order_by(User.id).limit(batch_size)
+        if last_id is not None:
+            batch = batch.where(User.id > last_id)
+
+        with engine.begin() as connection:
+            user_ids = connection.scalars(batch).all()
+            if not user_ids:
+                return fixed
+            fixed += reconcile_stats(connection, user_ids)
+        last_id = user_ids[-1]
@@ -0,0 +1,166 @@
+import os
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import Integer, Select, any_, bindparam, delete, desc, func, select, tuple_, union, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Follows, Peep, TimelineEntry, User, UserStats
+from .utils import uuid_array
+
+# Authors with more followers than this are not fanned out on write: copying each of their peeps into every follower's
+# timeline would make a single create too expensive, so their peeps are merged into the timelines at read time instead
+FANOUT_FOLLOWER_THRESHOLD = int(os.environ.get('PEEP_FANOUT_FOLLOWER_THRESHOLD', 10000))
+
+TIMELINE_ENTRY_COLUMNS = ['user_id', 'peep_id', 'author_id', 'created_at']
+
+
+async def fan_out_peeps(peep_ids: list[UUID], db: AsyncSession) -> set[UUID]:
+    """
+    Copy new peeps into the timeline of every follower of their authors, unless the author is fanned out on read.
+    Must run in the same transaction that creates the peeps, so the entries are visible as soon as the peeps are.
+    Returns the owners of the timelines that changed.
+    """
+    entries = (
+        select(Follows.follower_id, Peep.id, Peep.user_id, Peep.created_at)
+        .join(Peep, Peep.user_id == Follows.followee_id)
+        .join(User, User.id == Peep.user_id)
+        .where(Peep.id.in_(peep_ids), User.fanout_on_read.is_(False))
+    )
+    return set(await db.scalars(
+        insert(TimelineEntry).from_select(TIMELINE_ENTRY_COLUMNS, entries).on_conflict_do_nothing()
+        .returning(TimelineEntry.user_id)
+    ))
+
+
+async def remove_peep_entries(peep_id: UUID, db: AsyncSession) -> set[UUID]:
+    """
+    Remove a peep from every timeline, which ON DELETE CASCADE would do too, but this way we know whose timelines
+    changed. Returns their owners.
+    """
+    return set(await db.scalars(delete(TimelineEntry).where(TimelineEntry.peep_id == peep_id)
+                                .returning(TimelineEntry.user_id)))
+
+
+async def fanned_out_followers(author_id: UUID, db: AsyncSession) -> set[UUID]:
+    """
+    Owners of the timelines that have the peeps of `author_id`, e.g: to drop their cached timelines when the author is
+    deleted. None for an author fanned out on read, like fan_out_peeps.
+    """
+    return set(await db.scalars(
+        select(Follows.follower_id)
+        .join(User, User.id == Follows.followee_id)
+        .where(Follows.followee_id == author_id, User.fanout_on_read.is_(False))
+    ))
+
+
+async def backfill_follows(edges: list[tuple[UUID, UUID]], db: AsyncSession):
+    """
+    Copy the existing peeps of newly followed users into their followers' timelines, with the same two statements for
+    any number of (follower, followee) `edges`. This is also where authors get switched to fan-out on read, because
+    following is the only way to gain followers, so the followers counts must be updated before (see
+    lambdas/db/stats.py).
+    """
+    if not edges:
+        return
+
+    follower_ids, followee_ids = zip(*edges)
+    celebrity_ids = select(UserStats.user_id).where(UserStats.user_id == any_(uuid_array(set(followee_ids))),
+                                                    UserStats.followers_count > FANOUT_FOLLOWER_THRESHOLD)
+    await db.execute(
+        update(User)
+        .where(User.id.in_(celebrity_ids), User.fanout_on_read.is_(False))
+        .values(fanout_on_read=True)
+    )
+
+    new_follows = (
+        func.unnest(uuid_array(follower_ids), uuid_array(followee_ids))
+        .table_valued('follower_id', 'followee_id')
+        .render_derived(name='new_follows')
+    )
+    entries = (
+        select(new_follows.c.follower_id, Peep.id, Peep.user_id, Peep.created_at)
+        .join(Peep, Peep.user_id == new_follows.c.followee_id)
+        .join(User, User.id == Peep.user_id)
+        .where(User.fanout_on_read.is_(False))
+    )
+    await db.execute(insert(TimelineEntry).from_select(TIMELINE_ENTRY_COLUMNS, entries).on_conflict_do_nothing())
+
+
+async def remove_follow_entries(follower_id: UUID, followee_ids: list[UUID], db: AsyncSession):
+    await db.execute(delete(TimelineEntry).where(TimelineEntry.user_id == follower_id,
+                                                 TimelineEntry.author_id == any_(uuid_array(followee_ids))))
+
+
+def build_timeline_query(limited: bool, after_cursor: bool, keys_only: bool = False) -> Select:
+    """
+    The timeline of the :user_id parameter, newest first: the materialized entries plus the peeps of the followees that
+    are fanned out on read. When `limited`, each branch is an index range scan of up to :limit rows, so the merge stays
+    cheap, and `after_cursor` continues after (:cursor_created_at, :cursor_id). With `keys_only`, it's only the
+    (peep_id, created_at) of the rows, straight from the indexes, without loading the peeps.
+    """
+    user_id = bindparam('user_id')
+    limit = bindparam('limit', type_=Integer) if limited else None
+    entries = (
+        select(TimelineEntry.peep_id.label('peep_id'), TimelineEntry.created_at.label('created_at'))
+        .where(TimelineEntry.user_id == user_id)
+        .order_by(desc(TimelineEntry.created_at), desc(TimelineEntry.peep_id))
+        .limit(limit)
+    )
+    on_read_peeps = (
+        select(Peep.id.label('peep_id'), Peep.created_at.label('created_at'))
+        .join(Follows, Follows.followee_id == Peep.user_id)
+        .join(User, User.id == Follows.followee_id)
+        .where(Follows.follower_id == user_id, User.fanout_on_read.is_(True))
+        .order_by(desc(Peep.created_at), desc(Peep.id))
+        .limit(limit)
+    )
+    if after_cursor:
+        cursor = tuple_(bindparam('cursor_created_at', type_=Peep.created_at.type),
+                        bindparam('cursor_id', type_=Peep.id.type))
+        entries = entries.where(tuple_(TimelineEntry.created_at, TimelineEntry.peep_id) < cursor)
+        on_read_peeps = on_read_peeps.where(tuple_(Peep.created_at, Peep.id) < cursor)
+
+    # UNION (not UNION ALL) because authors switched to fan-out on read still have their older peeps materialized
+    page = union(entries, on_read_peeps).subquery()
+
+    if keys_only:
+        query = select(page.c.peep_id, page.c.created_at)
+    else:
+        query = select(Peep.id, Peep.content, Peep.created_at).join(page, page.c.peep_id == Peep.id)
+    return query.order_by(desc(page.c.created_at), desc(page.c.peep_id)).limit(limit)
+
+
+# The timeline is read on almost every request, so its statements are built once: only the parameters change between
+# requests. SQLAlchemy memoizes the cache key of a statement object, so reusing the same objects also skips computing
+# it, and goes straight to the compiled SQL (which asyncpg then runs as a cached prepared statement).
+TIMELINE_FIRST_PAGE = build_timeline_query(limited=True, after_cursor=False)
+TIMELINE_NEXT_PAGE = build_timeline_query(limited=True, after_cursor=True)
+FULL_TIMELINE = build_timeline_query(limited=False, after_cursor=False)
+TIMELINE_FIRST_PAGE_KEYS = build_timeline_query(limited=True, after_cursor=False, keys_only=True)
+TIMELINE_NEXT_PAGE_KEYS = build_timeline_query(limited=True, after_cursor=True, keys_only=True)
+
+# All the peeps of :user_id, newest first, walking the ix_peeps_user_id_created_at_id index
+USER_PEEPS = (
+    select(Peep.id, Peep.content, Peep.created_at)
+    .where(Peep.user_id == bindparam('user_id'))
+    .order_by(desc(Peep.created_at), desc(Peep.id))
+)
+
+
+def timeline_query(user_id: UUID, limit: int | None, cursor: tuple[datetime, UUID] | None = None,
+                   keys_only: bool = False) -> tuple[Select, dict]:
+    """
+    Statement and parameters of a page of the timeline of `user_id`. With no `limit` it's the whole timeline, e.g: for
+    the exports. With `keys_only`, only the (peep_id, created_at) of the page, e.g: to check if it changed.
+    """
+    if limit is None:
+        return FULL_TIMELINE, {'user_id': user_id}
+    if cursor is None:
+        query = TIMELINE_FIRST_PAGE_KEYS if keys_only else TIMELINE_FIRST_PAGE
+        return query, {'user_id': user_id, 'limit': limit}
+
+    cursor_created_at, cursor_id = cursor
+    query = TIMELINE_NEXT_PAGE_KEYS if keys_only else TIMELINE_NEXT_PAGE
+    return query, {'user_id': user_id, 'limit': limit, 'cursor_created_at': cursor_created_at, 'cursor_id': cursor_id}
@@ -0,0 +1,14 @@
+from uuid import UUID
+
+from sqlalchemy import BindParameter, Integer, literal
+from sqlalchemy.dialects.postgresql import ARRAY, UUID as PG_UUID
+
+
+def uuid_array(ids: list[UUID]) -> BindParameter:
+    # A single array parameter for `= ANY(...)` or unnest() (instead of IN with one parameter per id), so the statement
+    # is the same for any number of ids and asyncpg can reuse its prepared statement
+    return literal(list(ids), ARRAY(PG_UUID(as_uuid=True)))
+
+
+def integer_array(values: list[int]) -> BindParameter:
+    return literal(list(values), ARRAY(Integer))
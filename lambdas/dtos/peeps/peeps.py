@@ -1,6 +1,8 @@
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+
+from lambdas.routes.serialization import UTCDatetime
 
 
 class CreateRequestDTO(BaseModel):
@@ -12,6 +14,46 @@ class CreateResponseDTO(BaseModel):
     message: str
     peep: dict
 
+
+class BatchItemResultDTO(BaseModel):
+    # Position of the item in the request
+    index: int
+    status: int
+    message: str
+    peep: dict | None = None
+
+
+class BatchCreateResponseDTO(BaseModel):
+    message: str
+    results: list[BatchItemResultDTO]
+
+
+class PeepDTO(BaseModel):
+    # Read straight from the attributes of a Peep
+    model_config = ConfigDict(from_attributes=True)
+
+    id: UUID
+    user_id: UUID
+    content: str
+    created_at: UTCDatetime
+    updated_at: UTCDatetime
+
+
+class FindPeepResponseDTO(BaseModel):
+    peep: PeepDTO
+
+
+class PeepSearchResultDTO(BaseModel):
+    id: UUID
+    user_id: UUID
+    content: str
+    created_at: UTCDatetime
+
+
+class PeepSearchResponseDTO(BaseModel):
+    peeps: list[PeepSearchResultDTO]
+    next_cursor: str | None
+
 # TODO: cool but I don't like it that much
 # class CreatePeepResponseDTO:
 #     def __init__(self, message: str, data: Any):
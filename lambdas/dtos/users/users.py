@@ -1,6 +1,7 @@
+from datetime import datetime
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class CreateRequestDTO(BaseModel):
@@ -23,3 +24,64 @@ class UpdateRequestDTO(BaseModel):
 
 class FollowRequestDTO(BaseModel):
     followee_id: UUID
+
+
+# Max followees per bulk follow/unfollow request, so a single request does not hold a transaction for too long. Bigger
+# graphs go through the import endpoint, which commits in chunks.
+MAX_BULK_FOLLOWS = 1000
+
+
+class BulkFollowRequestDTO(BaseModel):
+    followee_ids: list[UUID] = Field(min_length=1, max_length=MAX_BULK_FOLLOWS)
+
+
+class BulkFollowResponseDTO(BaseModel):
+    message: str
+    # The followees that were not followed yet. The rest were already followed, or are not users (see not_found)
+    followed: list[UUID]
+    not_found: list[UUID]
+
+
+class BulkUnfollowResponseDTO(BaseModel):
+    message: str
+    unfollowed: list[UUID]
+
+
+class ImportFollowsResponseDTO(BaseModel):
+    message: str
+    imported: int
+    # Lines whose follows relation already existed
+    skipped: int
+    # Lines that are not a valid (follower_id, followee_id) pair of existing users
+    invalid: int
+
+
+class UserStatsDTO(BaseModel):
+    followers_count: int
+    followees_count: int
+    peeps_count: int
+
+
+class UserStatsResponseDTO(BaseModel):
+    stats: UserStatsDTO
+
+
+class UserSearchResultDTO(BaseModel):
+    id: UUID
+    username: str
+    name: str
+
+
+class UserSearchResponseDTO(BaseModel):
+    users: list[UserSearchResultDTO]
+
+
+class TimelinePeepDTO(BaseModel):
+    content: str
+    # Given as an ISO 8601 string in UTC (see UTCDatetime)
+    created_at: datetime
+
+
+class TimelineResponseDTO(BaseModel):
+    timeline: list[TimelinePeepDTO]
+    next_cursor: str | None
@@ -0,0 +1,133 @@
+import logging
+import os
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import Engine, event
+
+logger = logging.getLogger()
+
+# More queries than this in a single request is most likely an N+1: a query per item of a list, instead of one for all
+QUERY_BUDGET = int(os.environ.get('PEEP_QUERY_BUDGET', 20))
+
+
+class RequestMetrics:
+    """
+    What a single request spent its time on. Each request has its own, in a context variable: the database events and
+    the password hashing find it there, however deep in the call stack they run.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.bcrypt_seconds = 0.0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing, the durations are in milliseconds
+        metrics = [f'app;dur={self.elapsed() * 1000:.1f}',
+                   f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries, {self.rows} rows"']
+        if self.bcrypt_seconds:
+            metrics.append(f'bcrypt;dur={self.bcrypt_seconds * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+current_request_metrics: ContextVar[RequestMetrics | None] = ContextVar('current_request_metrics', default=None)
+
+
+def record_query(seconds: float, rows: int):
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.queries += 1
+        metrics.db_seconds += seconds
+        metrics.rows += max(rows, 0)
+
+
+def record_bcrypt(seconds: float):
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.bcrypt_seconds += seconds
+
+
+def watch_queries(engine: Engine):
+    """
+    Count the queries of `engine`, with their time and the rows they return, into the metrics of the request running
+    them. For an AsyncEngine, pass its sync_engine: the events run in a greenlet that shares the context of the
+    request's task.
+    """
+    # A connection runs a single statement at a time, so it only has to remember when the current one started
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info['query_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info.pop('query_started')
+        # Only the statements that return rows (SELECT, or a write with RETURNING) have a description: the rowcount of
+        # the others is the rows they wrote. It's -1 when unknown, e.g: for the server-side cursors of the exports
+        record_query(time.perf_counter() - started, cursor.rowcount if cursor.description is not None else 0)
+
+    # after_cursor_execute is not called for a statement that fails, but it took its time too
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        started = connection.info.pop('query_started', None) if connection is not None else None
+        if started is not None:
+            record_query(time.perf_counter() - started, 0)
+
+
+class InstrumentationMiddleware:
+    """
+    Measures every request: wall time, database queries, time and rows, and bcrypt time. They are sent back in a
+    Server-Timing header, and logged as a JSON object (each key in `extra` is a field of the Lambda JSON logs). A
+    streamed response is measured until its last chunk, but its header can only tell the time until the first one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        metrics = RequestMetrics()
+        token = current_request_metrics.set(metrics)
+        status_code = 500
+
+        async def send_with_server_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                headers = [*message.get('headers', []), (b'server-timing', metrics.server_timing().encode())]
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            current_request_metrics.reset(token)
+            log_request(scope, status_code, metrics)
+
+
+def log_request(scope, status_code: int, metrics: RequestMetrics):
+    # The route as declared (e.g: /users/{user_id}/timeline), so the requests of every user can be grouped together
+    route = getattr(scope.get('route'), 'path', scope['path'])
+    fields = {
+        'method': scope['method'],
+        'route': route,
+        'status': status_code,
+        'duration_ms': round(metrics.elapsed() * 1000, 2),
+        'db_queries': metrics.queries,
+        'db_ms': round(metrics.db_seconds * 1000, 2),
+        'db_rows': metrics.rows,
+        'bcrypt_ms': round(metrics.bcrypt_seconds * 1000, 2),
+    }
+    logger.info(f'{scope["method"]} {route} {status_code} in {fields["duration_ms"]} ms', extra=fields)
+
+    if metrics.queries > QUERY_BUDGET:
+        logger.warning(f'{scope["method"]} {route} ran {metrics.queries} queries, over the budget of {QUERY_BUDGET}: '
+                       f'probably an N+1', extra=fields)
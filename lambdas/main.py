@@ -1,9 +1,12 @@
 from fastapi import FastAPI
 from mangum import Mangum
 
-from .routes import peeps, users
+from .instrumentation import InstrumentationMiddleware
+from .profiling import profiled
+from .routes import metrics, peeps, users
 
 app = FastAPI()
+app.add_middleware(InstrumentationMiddleware)
 
 
 @app.get("/")
@@ -13,5 +16,7 @@ async def root():
 
 app.include_router(peeps.router)
 app.include_router(users.router)
+app.include_router(metrics.router)
 
-handler = Mangum(app)
+# Opt-in sampling profiler, see lambdas/profiling.py
+handler = profiled(Mangum(app))
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Any, Callable
+
+logger = logging.getLogger()
+
+# Share of the invocations that are profiled, from 0 (never, the default) to 1 (always)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PEEP_PROFILE_SAMPLE_RATE', 0))
+# A request with this value in the X-Peep-Profile header is always profiled. Without it set, the header is ignored
+PROFILE_TOKEN = os.environ.get('PEEP_PROFILE_TOKEN')
+PROFILE_HEADER = 'x-peep-profile'
+# Time between two samples, in seconds
+PROFILE_INTERVAL = float(os.environ.get('PEEP_PROFILE_INTERVAL_MS', 5)) / 1000
+# Where the profiles go: a local directory (on Lambda, only /tmp is writable), or s3://bucket/prefix
+PROFILE_SINK = os.environ.get('PEEP_PROFILE_SINK', '/tmp/peep-profiles')
+# collapsed (one "frame;frame;frame count" line per stack, for flamegraph.pl) or speedscope (https://speedscope.app)
+PROFILE_FORMAT = os.environ.get('PEEP_PROFILE_FORMAT', 'collapsed')
+
+# The event loop waiting for the database (or anything else) shows up as this frame
+IDLE_FRAME = '(idle)'
+IDLE_FUNCTIONS = {('selectors.py', 'select')}
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of a single thread: another thread looks at its stack every `interval` seconds and counts it.
+    Unlike cProfile, the profiled code runs at full speed, so it can be left on for a share of the production traffic.
+    It samples wall-clock time, so the time waiting for I/O is visible too, as IDLE_FRAME.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Counter[tuple[str, ...]] = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+
+    def __enter__(self):
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.samples[stack(frame)] += 1
+
+
+def stack(frame: FrameType) -> tuple[str, ...]:
+    # From the outermost call to the innermost one
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        file_name = os.path.basename(code.co_filename)
+        if not frames and (file_name, code.co_name) in IDLE_FUNCTIONS:
+            frames.append(IDLE_FRAME)
+        else:
+            frames.append(f'{code.co_name} ({file_name}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return tuple(reversed(frames))
+
+
+def to_collapsed(name: str, samples: Counter[tuple[str, ...]]) -> str:
+    # The request is the root frame of every stack, so the profiles can be merged by route later
+    return ''.join(f'{";".join((name, *frames))} {count}\n' for frames, count in samples.items())
+
+
+def to_speedscope(profiles: dict[str, Counter[tuple[str, ...]]], weight: float = 1, unit: str = 'none') -> str:
+    """
+    Speedscope file with a profile per name, each sample weighing `weight` `unit`s (e.g: milliseconds). See
+    https://github.com/jlfwong/speedscope/wiki/Importing-from-custom-sources, "sampled" profiles.
+    """
+    frame_indexes = {}
+    sampled_profiles = []
+    for name, samples in profiles.items():
+        sampled_stacks = []
+        for frames, count in samples.items():
+            indexes = [frame_indexes.setdefault(frame, len(frame_indexes)) for frame in frames]
+            sampled_stacks.extend([indexes] * count)
+        sampled_profiles.append({
+            'type': 'sampled',
+            'name': name,
+            'unit': unit,
+            'startValue': 0,
+            'endValue': len(sampled_stacks) * weight,
+            'samples': sampled_stacks,
+            'weights': [weight] * len(sampled_stacks),
+        })
+
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': [{'name': frame} for frame in frame_indexes]},
+        'profiles': sampled_profiles,
+    })
+
+
+def write_profile(name: str, samples: Counter[tuple[str, ...]], interval: float, sink: str, profile_format: str):
+    if profile_format == 'speedscope':
+        content, extension = to_speedscope({name: samples}, interval * 1000, 'milliseconds'), 'speedscope.json'
+    else:
+        content, extension = to_collapsed(name, samples), 'collapsed'
+    file_name = f'{time.time_ns()}-{random.getrandbits(32):08x}.{extension}'
+
+    if sink.startswith('s3://'):
+        # Imported here because boto3 is one of the slowest imports of the cold start
+        import boto3
+        bucket, _, prefix = sink.removeprefix('s3://').partition('/')
+        key = f'{prefix.rstrip("/")}/{file_name}' if prefix else file_name
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=content.encode())
+    else:
+        os.makedirs(sink, exist_ok=True)
+        with open(os.path.join(sink, file_name), 'w') as profile_file:
+            profile_file.write(content)
+
+
+def should_profile(event: dict) -> bool:
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if PROFILE_TOKEN and headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def request_name(event: dict) -> str:
+    # API Gateway REST (v1) and HTTP (v2) events
+    method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method', '?')
+    path = event.get('path') or event.get('rawPath', '?')
+    return f'{method} {path}'
+
+
+def profiled(handler: Callable[[dict, Any], Any]) -> Callable[[dict, Any], Any]:
+    """
+    Wraps a Lambda handler so a share of its invocations (PEEP_PROFILE_SAMPLE_RATE, or the ones with the
+    PEEP_PROFILE_TOKEN in their X-Peep-Profile header) is profiled and written to PEEP_PROFILE_SINK. Merge them by
+    route with scripts/merge_profiles.py.
+    """
+    def profiled_handler(event: dict, context: Any) -> Any:
+        if not should_profile(event):
+            return handler(event, context)
+
+        with SamplingProfiler(PROFILE_INTERVAL) as profiler:
+            response = handler(event, context)
+        try:
+            write_profile(request_name(event), profiler.samples, PROFILE_INTERVAL, PROFILE_SINK, PROFILE_FORMAT)
+        except Exception as e:
+            # Losing a profile is not worth failing the request for
+            logger.warning(f'Could not write the profile: {e!r}')
+        return response
+
+    return profiled_handler
@@ -2,21 +2,22 @@ import json
 import logging
 from datetime import timedelta
 from typing import Annotated
+from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from lambdas.db import User, get_db_session
 from lambdas.dtos.users import CreateRequestDTO
 from lambdas.routes.authentication.utils import (
-    check_password, create_access_token, get_current_user,
-    make_password,
+    CurrentUser, HashingOverloadedException, access_token_claims, check_password, create_access_token,
+    get_current_user, hashing_pool, make_password,
 )
+from lambdas.routes.users.utils import forget_user_search
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
@@ -24,6 +25,8 @@ logger.setLevel("INFO")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 # This value is required for the password flow of OAuth2, it must be 'bearer'
 TOKEN_TYPE = 'bearer'
+# Seconds the clients are asked to wait when password hashing is overloaded
+HASHING_RETRY_AFTER = '1'
 
 
 class Token(BaseModel):
@@ -35,8 +38,13 @@ router = APIRouter(prefix="/auth")
 
 
 @router.post('/signup')
-async def signup(user: CreateRequestDTO, db: Session = Depends(get_db_session)):
-    hashed_password = make_password(user.password)
+async def signup(user: CreateRequestDTO, db: AsyncSession = Depends(get_db_session)):
+    try:
+        hashed_password = await hashing_pool.run(make_password, user.password)
+    except HashingOverloadedException:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many requests, try again later',
+                            headers={'Retry-After': HASHING_RETRY_AFTER})
     if hashed_password is None:
         logger.info('Could not hash password')
         return {
@@ -48,18 +56,19 @@ async def signup(user: CreateRequestDTO, db: Session = Depends(get_db_session)):
     new_user = User(name=user.name, email=user.email, username=user.username, password=hashed_password)
     try:
         db.add(new_user)
-        db.commit()
+        await db.commit()
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(
             content={'message': 'Username already exists'},
             status_code=status.HTTP_400_BAD_REQUEST
         )
 
     logger.info('User created successfully')
+    forget_user_search(names=[user.username, user.name])
 
     # we refresh mostly because of the id field, which is autogenerated by the database
-    db.refresh(new_user, attribute_names=['id', 'name', 'email', 'username'])
+    await db.refresh(new_user, attribute_names=['id', 'name', 'email', 'username'])
     body = {
         'message': 'User created successfully',
         'user': {
@@ -75,8 +84,13 @@ async def signup(user: CreateRequestDTO, db: Session = Depends(get_db_session)):
 # Because of the OAuth2PasswordRequestForm dependency, the request body must be a Form. Due to OAuth2 spec, the
 # form must contain username and password fields, and they must be named like that, other names are not accepted.
 @router.post('/login')
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db_session)):
-    user = check_password(form_data.username, form_data.password, db)
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_db_session)):
+    try:
+        user = await check_password(form_data.username, form_data.password, db)
+    except HashingOverloadedException:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many requests, try again later',
+                            headers={'Retry-After': HASHING_RETRY_AFTER})
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -86,13 +100,13 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db:
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data=access_token_claims(user), expires_delta=access_token_expires
     )
     return Token(access_token=access_token, token_type=TOKEN_TYPE)
 
 
 class UserInfoDTO(BaseModel):
-    id: str
+    id: UUID
     name: str
     email: str
     username: str
@@ -100,7 +114,6 @@ class UserInfoDTO(BaseModel):
 
 # Just to test that the login actually worked
 @router.get('/me')
-async def get_me(user: User = Depends(get_current_user)) -> UserInfoDTO:
-    json_user = jsonable_encoder(user, exclude={'password'})
-    logger.info('User retrieved successfully', extra={'user': json_user})
-    return UserInfoDTO(id=str(user.id), name=user.name, email=user.email, username=user.username)
+async def get_me(user: CurrentUser = Depends(get_current_user)) -> UserInfoDTO:
+    logger.info('User retrieved successfully', extra={'user': user.model_dump(mode='json')})
+    return UserInfoDTO(id=user.id, name=user.name, email=user.email, username=user.username)
@@ -1,15 +1,24 @@
+import asyncio
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from typing import Annotated, Any, Callable
+from uuid import UUID
 
 import bcrypt
 import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jwt import InvalidTokenError
-from sqlalchemy.orm import Session
+from pydantic import BaseModel
+from sqlalchemy import bindparam, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from lambdas.db import User, get_db_session
+from lambdas.cache import TTLCache
+from lambdas.instrumentation import record_bcrypt
+from lambdas.db import User, get_db_session, get_read_db_session
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
@@ -17,19 +26,101 @@ logger.setLevel("INFO")
 JWT_SIGNING_KEY = 'ab594818b3aadd5c954486ff2951563e6e154848bc4449ca3626235c747bc701'
 JWT_SIGNING_ALGORITHM = 'HS256'
 
+# Work factor of the new hashes. When it changes, existing hashes are upgraded the next time their user logs in. The
+# tests use the minimum: they check the hashing works, not that it's slow
+BCRYPT_ROUNDS = int(os.environ.get('PEEP_BCRYPT_ROUNDS', 4 if os.environ.get('PEEP_ENV') == 'test' else 12))
+HASHING_MAX_WORKERS = int(os.environ.get('PEEP_HASHING_MAX_WORKERS', 4))
+# Hashing calls (running or queued) allowed at once. Past this, they fail right away instead of piling up
+HASHING_MAX_PENDING = int(os.environ.get('PEEP_HASHING_MAX_PENDING', 32))
+
 # tokenUrl is the relative URL from where to get the JWT token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Most authenticated requests come from the same few users with the same tokens, so decoding the token is cached. A
+# valid token stays valid until it expires, so tokens are cached until their `exp`. Every token is cached for the rest
+# of its own lifetime, hence no default ttl.
+token_cache = TTLCache(maxsize=int(os.environ.get('PEEP_TOKEN_CACHE_SIZE', 4096)), ttl=0)
+# Current token_version of each user, to check revocations without a query on every request
+token_version_cache = TTLCache(maxsize=int(os.environ.get('PEEP_TOKEN_VERSION_CACHE_SIZE', 1024)),
+                               ttl=float(os.environ.get('PEEP_TOKEN_VERSION_CACHE_TTL', 60)))
+
+# Every login looks up its user, so the statement is built once and the requests only bind the username
+FIND_USER_BY_USERNAME = select(User).where(User.username == bindparam('username'))
+
+
+class CurrentUser(BaseModel):
+    """
+    Identity of the authenticated user, built straight from the claims of its access token. Unlike the User model,
+    it's not bound to any session.
+    """
+    id: UUID
+    name: str
+    email: str
+    username: str
+
+
+class HashingOverloadedException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+class HashingPool:
+    """
+    Runs bcrypt off the event loop. Each hash takes hundreds of milliseconds of CPU on purpose, so running them inline
+    in the async routes would freeze every other request meanwhile. bcrypt releases the GIL, so threads are enough.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bcrypt')
+        self.max_pending = max_pending
+        # Only touched from the event loop thread, so it does not need a lock
+        self.pending = 0
+
+    async def run(self, func: Callable, *args) -> Any:
+        if self.pending >= self.max_pending:
+            raise HashingOverloadedException('Too many password hashing requests in progress')
+
+        self.pending += 1
+        try:
+            result, seconds = await asyncio.get_running_loop().run_in_executor(self.executor, timed, func, *args)
+        finally:
+            self.pending -= 1
+        # Only the time hashing, not the time waiting for a thread
+        record_bcrypt(seconds)
+        return result
 
-def check_password(username: str, password: str, db: Session = Depends(get_db_session)):
-    user = find_user(username, db)
+
+def timed(func: Callable, *args) -> tuple[Any, float]:
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+hashing_pool = HashingPool(HASHING_MAX_WORKERS, HASHING_MAX_PENDING)
+
+
+async def check_password(username: str, password: str, db: AsyncSession = Depends(get_db_session)):
+    user = await find_user(username, db)
     if user is None:
         return False
-    input_password_bytes = password.encode('utf-8')
-    stored_password_bytes = user.password.encode('utf-8')
-    if not bcrypt.checkpw(input_password_bytes, stored_password_bytes):
+    if not await hashing_pool.run(verify_password, password, user.password):
         return False
 
+    # This is the only time we have the plain password, so it's the only chance to upgrade an outdated hash
+    if password_needs_rehash(user.password):
+        try:
+            new_hash = await hashing_pool.run(make_password, password)
+        except HashingOverloadedException:
+            # Not worth failing the login for it, it will be retried on the next one
+            logger.info('Skipping password rehash, hashing pool is overloaded')
+            return user
+        if new_hash is not None:
+            user.password = new_hash
+            await db.commit()
+
     return user
 
 
@@ -44,54 +135,136 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 
-# Get the credentials from the token, also validating the token on the way
-def validate_token(token: str) -> str | None:
+def access_token_claims(user: User) -> dict:
+    """
+    Claims identifying `user` in its access tokens: enough to authenticate the requests without loading the user.
+    """
+    return {
+        'sub': user.username,
+        'uid': str(user.id),
+        'ver': user.token_version,
+        'name': user.name,
+        'email': user.email,
+    }
+
+
+# Decode the token, also validating it on the way
+def decode_token(token: str) -> dict | None:
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
         payload = jwt.decode(token, JWT_SIGNING_KEY, algorithms=[JWT_SIGNING_ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None or username == '':
-            return None
     except InvalidTokenError:
         return None
 
+    # Invalid tokens are not cached: there is no point in remembering them, and it would let anyone fill the cache
+    expires_at = payload.get('exp')
+    if expires_at is not None:
+        token_cache.set(token, payload, ttl=expires_at - time.time())
+    return payload
+
+
+# Get the credentials from the token, also validating the token on the way
+def validate_token(token: str) -> str | None:
+    payload = decode_token(token)
+    if payload is None:
+        return None
+
+    username: str = payload.get("sub")
+    if username is None or username == '':
+        return None
+
     return username
 
 
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
-                           db: Session = Depends(get_db_session)) -> User:
+                           db: AsyncSession = Depends(get_read_db_session)) -> CurrentUser:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    username = validate_token(token)
-    if username is None:
+    payload = decode_token(token)
+    if payload is None or not payload.get('sub'):
         raise credentials_exception
 
-    user = find_user(username, db)
-    if user is None:
+    try:
+        current_user = CurrentUser(id=payload['uid'], name=payload['name'], email=payload['email'],
+                                   username=payload['sub'])
+    except (KeyError, ValueError):
+        # e.g: tokens issued before the claims were added
         raise credentials_exception
-    return user
+
+    if not await is_token_version_current(current_user.id, payload.get('ver'), db):
+        raise credentials_exception
+    return current_user
 
 
-def find_user(username: str, db: Session = Depends(get_db_session)) -> User | None:
-    return db.query(User).filter(User.username == username).first()
+async def is_token_version_current(user_id: UUID, token_version: int | None, db: AsyncSession) -> bool:
+    """
+    Tokens are revoked by bumping the token_version of their user. The current version is cached, so this only queries
+    the database on a cache miss.
+    """
+    current_version = token_version_cache.get(user_id)
+    if current_version is None:
+        current_version = await db.scalar(select(User.token_version).where(User.id == user_id))
+        # This runs before the route, which may use a session of its own: the connection goes back to the pool (of a
+        # single connection on Lambda) instead of staying checked out until the end of the request
+        await db.commit()
+        if current_version is None:
+            # The user does not exist anymore
+            return False
+        token_version_cache.set(user_id, current_version)
+
+    return current_version == token_version
+
+
+def forget_user(user_id: UUID):
+    """
+    Drop the cached token_version of a user, e.g: because it was bumped or the user was deleted.
+    """
+    token_version_cache.delete(user_id)
+
+
+async def find_user(username: str, db: AsyncSession = Depends(get_db_session)) -> User | None:
+    return (await db.execute(FIND_USER_BY_USERNAME, {'username': username})).scalars().first()
 
 
 # Because of the dependency on oauth2_scheme, FastAPI makes sure that if this function is called, the token is present
 # in the Authorization Header. See: https://fastapi.tiangolo.com/tutorial/security/first-steps/#what-it-does
 # But decoding and making sure the token is actually valid is our job, but at least we don't have to check the headers manually.
-async def check_logged_in(token: Annotated[str, Depends(oauth2_scheme)]) -> bool:
-    if validate_token(token) is None:
+# A revoked token (see is_token_version_current) is not logged in either.
+async def check_logged_in(token: Annotated[str, Depends(oauth2_scheme)],
+                          db: AsyncSession = Depends(get_read_db_session)) -> bool:
+    payload = decode_token(token)
+    if payload is None or not payload.get('sub'):
+        return False
+
+    try:
+        user_id = UUID(payload['uid'])
+    except (KeyError, ValueError):
+        # e.g: tokens issued before the claims were added
         return False
 
-    return True
+    return await is_token_version_current(user_id, payload.get('ver'), db)
 
 
-def make_password(plain_password: str) -> str | None:
+# make_password and verify_password block for as long as bcrypt takes: in async code, call them through hashing_pool
+def make_password(plain_password: str, rounds: int | None = None) -> str | None:
     try:
-        hashed_password = bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt(rounds or BCRYPT_ROUNDS))
         return hashed_password.decode('utf-8')
     except (TypeError, ValueError) as e:
         logger.error(f'Error hashing password', exc_info=True, extra={'exception': e})
         return None
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+    return int(hashed_password.split('$')[2]) != BCRYPT_ROUNDS
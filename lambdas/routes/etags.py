@@ -0,0 +1,49 @@
+import hashlib
+import os
+from datetime import datetime
+from typing import Sequence
+
+from fastapi import Response, status
+
+# Seconds the clients (and the caches in between, e.g: CloudFront) can reuse a response without asking again. After
+# that they revalidate it with its ETag, which costs a 304 without a body when nothing changed
+TIMELINE_MAX_AGE = int(os.environ.get('PEEP_TIMELINE_MAX_AGE', 5))
+PEEP_MAX_AGE = int(os.environ.get('PEEP_PEEP_MAX_AGE', 60))
+
+
+# Weak ETags (W/"..."): two responses with the same tag have the same peeps, not necessarily the same bytes
+def weak_etag(*parts: str) -> str:
+    digest = hashlib.blake2b('\x1f'.join(parts).encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}"'
+
+
+def peep_etag(updated_at: datetime) -> str:
+    # The URL already has the peep id
+    return weak_etag(updated_at.isoformat())
+
+
+def timeline_etag(rows: Sequence[Sequence[str]]) -> str:
+    """
+    Tag of a page of the timeline, from the id (first) and created_at (last) of each of its rows, as strings. Pass the
+    extra row fetched to find out if there is a next page too, so the tag changes with the next cursor.
+    """
+    return weak_etag(*(f'{row[0]}@{row[-1]}' for row in rows))
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match uses the weak comparison: W/ is ignored (RFC 9110, section 13.1.2)
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag.removeprefix('W/') in {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+
+
+def cache_headers(etag: str, max_age: int) -> dict[str, str]:
+    # Any logged in user can read these, but a cache must not serve them to a request without a valid token: Vary keeps
+    # a copy per Authorization header, so each token only gets the copies it was authorized for
+    return {'ETag': etag, 'Cache-Control': f'public, max-age={max_age}', 'Vary': 'Authorization'}
+
+
+def not_modified(etag: str, max_age: int) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag, max_age))
@@ -0,0 +1 @@
+from .main import router
\ No newline at end of file
@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+
+from ..users.utils import timeline_cache
+from ...db.main import get_pool_metrics
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+# Not behind a login so the monitoring can scrape it, there are only counters here. Each process (e.g: each Lambda
+# instance, or uvicorn worker) has its own pools, so this is about the process that handles the request.
+@router.get('/db-pool')
+async def db_pool():
+    return get_pool_metrics()
+
+
+# Hit ratio of this process' lookups. With Redis, the entries are shared, but each process still counts its own lookups
+@router.get('/timeline-cache')
+async def timeline_cache_metrics():
+    return timeline_cache.metrics()
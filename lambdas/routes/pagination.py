@@ -0,0 +1,54 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from uuid import UUID
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursorException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+# Cursors are opaque to the clients: they are just the (created_at, id) of the last row of the previous page, encoded as
+# url-safe base64 JSON. Including the id makes the position unique even when several rows share the same created_at
+# (e.g: peeps inserted in the same transaction get the same now()).
+def encode_cursor(created_at: datetime, row_id: UUID) -> str:
+    return encode_payload({'c': created_at.isoformat(), 'i': str(row_id)})
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        payload = decode_payload(cursor)
+        return datetime.fromisoformat(payload['c']), UUID(payload['i'])
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError) as e:
+        raise InvalidCursorException('Invalid cursor') from e
+
+
+# Search results are sorted by rank first, so their cursors also carry the rank of the last row
+def encode_search_cursor(rank: float, created_at: datetime, row_id: UUID) -> str:
+    return encode_payload({'r': rank, 'c': created_at.isoformat(), 'i': str(row_id)})
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, datetime, UUID]:
+    try:
+        payload = decode_payload(cursor)
+        return float(payload['r']), datetime.fromisoformat(payload['c']), UUID(payload['i'])
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError) as e:
+        raise InvalidCursorException('Invalid cursor') from e
+
+
+def encode_payload(payload: dict) -> str:
+    encoded = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(encoded).decode('ascii').rstrip('=')
+
+
+def decode_payload(cursor: str) -> dict:
+    padding = '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(cursor + padding))
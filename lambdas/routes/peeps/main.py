@@ -1,17 +1,42 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Annotated
+from uuid import UUID, uuid4
+
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Query, Response, status
 from fastapi.responses import JSONResponse
+from sqlalchemy import bindparam, insert, select
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..authentication.utils import check_logged_in
-from ...db import Peep, get_db_session
-from ...dtos.peeps import CreateRequestDTO, CreateResponseDTO
+from ..authentication.utils import CurrentUser, check_logged_in, get_current_user
+from ..etags import PEEP_MAX_AGE, cache_headers, etag_matches, not_modified, peep_etag
+from ..pagination import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursorException, decode_search_cursor,
+                          encode_search_cursor)
+from ..users.utils import timeline_cache
+from ...db import Peep, User, get_db_session, get_read_db_session
+from ...db.main import has_read_replica
+from ...db.replica import remember_writes
+from ...db.search import search_query
+from ...db.stats import update_stats
+from ...db.timeline import fan_out_peeps, remove_peep_entries
+from ...dtos.peeps import (BatchCreateResponseDTO, CreateRequestDTO, CreateResponseDTO, FindPeepResponseDTO,
+                           PeepSearchResponseDTO)
 
 router = APIRouter(prefix="/peeps", tags=["peeps"])
 
+# Max peeps per batch, so a single request does not hold a transaction (and the Lambda) for too long
+MAX_BATCH_SIZE = 500
+
+# Longer search texts are rejected before reaching the database
+MAX_SEARCH_LENGTH = 200
+
+# Built once, so the requests only bind the id (see lambdas/db/timeline.py)
+FIND_PEEP = select(Peep).where(Peep.id == bindparam('peep_id'))
+# Enough to check a client's copy of a peep, without loading it
+PEEP_UPDATED_AT = select(Peep.updated_at).where(Peep.id == bindparam('peep_id'))
+
 
 @router.post('', response_model=CreateResponseDTO)
-async def create(peep: CreateRequestDTO, db: Session = Depends(get_db_session),
+async def create(peep: CreateRequestDTO, db: AsyncSession = Depends(get_db_session),
                  is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
@@ -19,10 +44,15 @@ async def create(peep: CreateRequestDTO, db: Session = Depends(get_db_session),
     new_peep = Peep(**peep.model_dump())
     try:
         db.add(new_peep)
-        db.commit()
-        db.refresh(new_peep, attribute_names=['id', 'content'])
+        await db.flush()
+        await update_stats(db, peeps=[new_peep.user_id])
+        follower_ids = await fan_out_peeps([new_peep.id], db)
+        await db.commit()
+        remember_writes(new_peep.user_id)
+        await timeline_cache.forget(follower_ids)
+        await db.refresh(new_peep, attribute_names=['id', 'content'])
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(status_code=400, content={'message': 'Invalid data'})
     return JSONResponse(
         status_code=status.HTTP_201_CREATED,
@@ -30,27 +60,129 @@ async def create(peep: CreateRequestDTO, db: Session = Depends(get_db_session),
     )
 
 
-@router.get('/{peep_id}')
-async def find_one(peep_id: str, db: Session = Depends(get_db_session), is_logged_in: bool = Depends(check_logged_in)):
+@router.post('/batch', response_model=BatchCreateResponseDTO)
+async def create_many(peeps: Annotated[list[CreateRequestDTO], Body(min_length=1, max_length=MAX_BATCH_SIZE)],
+                      db: AsyncSession = Depends(get_db_session), is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
 
-    peep = db.query(Peep).filter(Peep.id == peep_id).one_or_none()
+    invalid_item = {'status': status.HTTP_400_BAD_REQUEST, 'message': 'Invalid data'}
+    results = [{'index': index, **invalid_item} for index in range(len(peeps))]
+
+    # Check the users of the whole batch in one query, so a few invalid ones do not make the whole INSERT fail
+    user_ids = {peep.user_id for peep in peeps}
+    existing_user_ids = set(await db.scalars(select(User.id).where(User.id.in_(user_ids))))
+    valid_indexes = [index for index, peep in enumerate(peeps) if peep.user_id in existing_user_ids]
+
+    created_ids = {}
+    try:
+        async with db.begin_nested():
+            created_ids = dict(zip(valid_indexes, await insert_peeps([peeps[index] for index in valid_indexes], db)))
+    except IntegrityError:
+        # e.g: a user was deleted meanwhile. Retry them one by one to find out which ones are invalid
+        for index in valid_indexes:
+            try:
+                async with db.begin_nested():
+                    created_ids[index] = (await insert_peeps([peeps[index]], db))[0]
+            except IntegrityError:
+                pass
+
+    if created_ids:
+        await update_stats(db, peeps=[peeps[index].user_id for index in created_ids])
+        follower_ids = await fan_out_peeps(list(created_ids.values()), db)
+        await db.commit()
+        remember_writes(*{peeps[index].user_id for index in created_ids})
+        await timeline_cache.forget(follower_ids)
+
+    for index, peep_id in created_ids.items():
+        results[index] = {
+            'index': index,
+            'status': status.HTTP_201_CREATED,
+            'message': 'Peep created successfully',
+            'peep': {'id': str(peep_id), 'content': peeps[index].content},
+        }
+
+    if len(created_ids) == len(peeps):
+        return JSONResponse(status_code=status.HTTP_201_CREATED,
+                            content={'message': 'Peeps created successfully', 'results': results})
+    return JSONResponse(status_code=status.HTTP_207_MULTI_STATUS,
+                        content={'message': 'Some peeps could not be created', 'results': results})
+
+
+# Declared before /{peep_id}, otherwise "search" would be taken as a peep id
+@router.get('/search', response_model=PeepSearchResponseDTO)
+async def search(q: str = Query(min_length=1, max_length=MAX_SEARCH_LENGTH), following_only: bool = False,
+                 limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: str | None = None,
+                 db: AsyncSession = Depends(get_read_db_session), user: CurrentUser = Depends(get_current_user)):
+    position = None
+    if cursor is not None:
+        try:
+            position = decode_search_cursor(cursor)
+        except InvalidCursorException:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+
+    # Fetch one extra row, so we know if there is a next page without running a separate COUNT
+    query = search_query(q, limit + 1, position, follower_id=user.id if following_only else None)
+
+    rows = (await db.execute(query)).mappings().all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_row = rows[-1]
+        next_cursor = encode_search_cursor(last_row['rank'], last_row['created_at'], last_row['id'])
+
+    return {'peeps': rows, 'next_cursor': next_cursor}
+
+
+@router.get('/{peep_id}', response_model=FindPeepResponseDTO)
+async def find_one(peep_id: UUID, response: Response, read_db: AsyncSession = Depends(get_read_db_session),
+                   db: AsyncSession = Depends(get_db_session), is_logged_in: bool = Depends(check_logged_in),
+                   if_none_match: str | None = Header(default=None)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    if if_none_match is not None:
+        updated_at = await read_db.scalar(PEEP_UPDATED_AT, {'peep_id': peep_id})
+        if updated_at is not None and etag_matches(if_none_match, peep_etag(updated_at)):
+            return not_modified(peep_etag(updated_at), PEEP_MAX_AGE)
+
+    peep = (await read_db.execute(FIND_PEEP, {'peep_id': peep_id})).scalar_one_or_none()
+    if peep is None and has_read_replica():
+        # It may have just been created, and not replicated yet
+        peep = (await db.execute(FIND_PEEP, {'peep_id': peep_id})).scalar_one_or_none()
     if peep is None:
         raise HTTPException(status_code=404, detail='Peep not found')
 
+    response.headers.update(cache_headers(peep_etag(peep.updated_at), PEEP_MAX_AGE))
     return {'peep': peep}
 
 
 @router.delete('/{peep_id}')
-async def remove(peep_id: str, db: Session = Depends(get_db_session), is_logged_in: bool = Depends(check_logged_in)):
+async def remove(peep_id: UUID, db: AsyncSession = Depends(get_db_session),
+                 is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
 
-    peep = db.query(Peep).filter(Peep.id == peep_id).first()
+    peep = (await db.execute(FIND_PEEP, {'peep_id': peep_id})).scalars().first()
     if peep is None:
         raise HTTPException(status_code=404, detail='Peep not found')
 
-    db.delete(peep)
-    db.commit()
+    follower_ids = await remove_peep_entries(peep.id, db)
+    await db.delete(peep)
+    await update_stats(db, peeps=[peep.user_id], sign=-1)
+    await db.commit()
+    remember_writes(peep.user_id)
+    await timeline_cache.forget(follower_ids)
     return {'message': 'Peep successfully removed'}
+
+
+async def insert_peeps(peeps: list[CreateRequestDTO], db: AsyncSession) -> list[UUID]:
+    if not peeps:
+        return []
+
+    # The ids are generated here (the same random v4 UUIDs as uuid_generate_v4) so we know which id belongs to each
+    # peep, and the batch can be a single multi-row INSERT ... VALUES (...), (...) RETURNING
+    rows = [{'id': uuid4(), **peep.model_dump()} for peep in peeps]
+    inserted_ids = set(await db.scalars(insert(Peep).values(rows).returning(Peep.id)))
+    return [row['id'] for row in rows if row['id'] in inserted_ids]
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+from typing import Annotated, Any
+
+import orjson
+from pydantic import AfterValidator
+
+
+# The timestamps are stored in UTC, without a time zone, and sent as ISO 8601 in UTC, e.g: 2024-12-20T14:00:31.123456Z.
+# They stay datetimes until the response is serialized (by Pydantic, or orjson for the exports), in native code, instead
+# of being formatted one by one in Python, or by to_char in the database.
+def as_utc(timestamp: datetime) -> datetime:
+    return timestamp.replace(tzinfo=timezone.utc) if timestamp.tzinfo is None else timestamp
+
+
+# For the fields of the response models that get naive datetimes from the database. It runs Python for every value, and
+# Pydantic serializes a Python tzinfo slower than its own, so the timeline (up to a thousand peeps) does without it: it
+# passes ISO 8601 strings ending in Z, that Pydantic parses into its native UTC
+UTCDatetime = Annotated[datetime, AfterValidator(as_utc)]
+
+
+def dump_json_line(value: Any) -> bytes:
+    # Serializes the datetimes natively too, in the same format as UTCDatetime. orjson only knows uuid.UUID itself, not
+    # the subclass of asyncpg, so those go through str
+    return orjson.dumps(value, default=str, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE)
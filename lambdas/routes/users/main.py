@@ -1,24 +1,67 @@
 from datetime import datetime, timedelta
+from typing import AsyncIterator, Iterable
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy import desc, select
-from sqlalchemy.orm import Session
-from sqlalchemy.sql import func
+# Aliased because the route functions below are named update and delete
+from sqlalchemy import Select, any_, delete as delete_statement, func, select, update as update_statement
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from lambdas.routes.authentication.main import router as authentication_router
-from ..authentication.utils import check_logged_in
-from ...db import Follows, Peep, User, get_db_session
-from ...dtos.users import FollowRequestDTO, UpdateRequestDTO
+from ..authentication.utils import check_logged_in, forget_user
+from .utils import forget_user_search, timeline_cache, user_search_cache
+from ..etags import TIMELINE_MAX_AGE, cache_headers, etag_matches, not_modified, timeline_etag
+from ..pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursorException, decode_cursor, encode_cursor
+from ..serialization import dump_json_line
+from ...db import Follows, User, get_db_session, get_read_db_session
+from ...db.replica import remember_writes
+from ...db.search import user_search_query
+from ...db.stats import remove_user_stats, stats_query, update_stats
+from ...db.timeline import USER_PEEPS, backfill_follows, fanned_out_followers, remove_follow_entries, timeline_query
+from ...db.utils import uuid_array
+from ...dtos.users import (BulkFollowRequestDTO, BulkFollowResponseDTO, BulkUnfollowResponseDTO, FollowRequestDTO,
+                           ImportFollowsResponseDTO, TimelineResponseDTO, UpdateRequestDTO, UserSearchResponseDTO,
+                           UserStatsResponseDTO)
 
 router = APIRouter(prefix="/users", tags=["users"])
 router.include_router(authentication_router)
 
+# Lines of a follows import handled per transaction
+IMPORT_CHUNK_SIZE = 1000
+
+# Users returned by the autocomplete
+DEFAULT_USER_SEARCH_LIMIT = 10
+MAX_USER_SEARCH_LIMIT = 50
+MAX_USERNAME_PREFIX_LENGTH = 100
+
+# Rows fetched at a time from the database by the exports
+EXPORT_BATCH_SIZE = 1000
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+@router.get('/search', response_model=UserSearchResponseDTO)
+async def search(prefix: str = Query(min_length=1, max_length=MAX_USERNAME_PREFIX_LENGTH),
+                 limit: int = Query(default=DEFAULT_USER_SEARCH_LIMIT, ge=1, le=MAX_USER_SEARCH_LIMIT),
+                 db: AsyncSession = Depends(get_read_db_session), is_logged_in: bool = Depends(check_logged_in)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    key = (prefix.lower(), limit)
+    users = user_search_cache.get(key)
+    if users is None:
+        rows = (await db.execute(user_search_query(prefix, limit))).mappings().all()
+        users = [{'id': str(row['id']), 'username': row['username'], 'name': row['name']} for row in rows]
+        user_search_cache.set(key, users)
+
+    return {'users': users}
+
 
 @router.patch('/{user_id}')
-async def update(user_id: str, user: UpdateRequestDTO, db: Session = Depends(get_db_session),
+async def update(user_id: UUID, user: UpdateRequestDTO, db: AsyncSession = Depends(get_db_session),
                  is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
@@ -27,40 +70,60 @@ async def update(user_id: str, user: UpdateRequestDTO, db: Session = Depends(get
     if len(fields) == 0:
         raise HTTPException(status_code=400, detail='Body cannot be empty')
 
-    count = db.query(User).filter(User.id == user_id).update(fields)
-    if count == 0:
+    # The username (the sub claim) and the email identify the account, so changing them revokes the tokens issued until
+    # now. The name is only shown: the tokens issued before keep the previous one until they expire
+    revokes_tokens = bool(fields.keys() & {'username', 'email'})
+    values = {**fields, 'token_version': User.token_version + 1} if revokes_tokens else fields
+    result = await db.execute(update_statement(User).where(User.id == user_id).values(values))
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail='User not found')
-    db.commit()
+    await db.commit()
+    remember_writes(user_id)
+    if revokes_tokens:
+        forget_user(user_id)
+    forget_user_search(user_id, names=[fields.get('username'), fields.get('name')])
 
     return {'message': 'User successfully updated'}
 
 
 @router.delete('/{user_id}')
-async def delete(user_id: str, db: Session = Depends(get_db_session), is_logged_in: bool = Depends(check_logged_in)):
+async def delete(user_id: UUID, db: AsyncSession = Depends(get_db_session),
+                 is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
 
     # Deleting like this is better because it triggers the Python-level cascade constraints on deletion
     # See: https://stackoverflow.com/a/19245058
-    user = db.query(User).filter(User.id == user_id).first()
+    user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
     if user is None:
         raise HTTPException(status_code=404, detail='User not found')
 
-    db.delete(user)
-    db.commit()
+    # Before the follows are gone with the user
+    follower_ids = await fanned_out_followers(user_id, db)
+    await remove_user_stats(user_id, db)
+    await db.delete(user)
+    await db.commit()
+    forget_user(user_id)
+    forget_user_search(user_id)
+    await timeline_cache.forget([user_id, *follower_ids])
     return {'message': 'User successfully deleted'}
 
 
 @router.post('/{user_id}/follow')
-async def follow(user_id: UUID, who: FollowRequestDTO, db: Session = Depends(get_db_session),
+async def follow(user_id: UUID, who: FollowRequestDTO, db: AsyncSession = Depends(get_db_session),
                  is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
 
-    new_follow = Follows(follower_id=user_id, followee_id=who.followee_id)
-    db.add(new_follow)
-    db.commit()
-    db.refresh(new_follow)
+    # Following someone already followed is a no-op
+    try:
+        await insert_follows([(user_id, who.followee_id)], db)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail='User not found')
+    await db.commit()
+    remember_writes(user_id)
+    await timeline_cache.forget([user_id])
 
     return JSONResponse(
         status_code=status.HTTP_200_OK,
@@ -68,40 +131,185 @@ async def follow(user_id: UUID, who: FollowRequestDTO, db: Session = Depends(get
     )
 
 
+@router.post('/{user_id}/follow/bulk', response_model=BulkFollowResponseDTO)
+async def follow_many(user_id: UUID, who: BulkFollowRequestDTO, db: AsyncSession = Depends(get_db_session),
+                      is_logged_in: bool = Depends(check_logged_in)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    followee_ids = list(dict.fromkeys(who.followee_ids))
+    # Check all the users in one query, so a few unknown followees do not make the whole INSERT fail
+    existing_ids = await find_existing_users([user_id, *followee_ids], db)
+    if user_id not in existing_ids:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    try:
+        new_follows = await insert_follows([(user_id, followee_id) for followee_id in followee_ids
+                                            if followee_id in existing_ids], db)
+    except IntegrityError:
+        # e.g: a followee was deleted meanwhile
+        await db.rollback()
+        raise HTTPException(status_code=404, detail='User not found')
+    await db.commit()
+    remember_writes(user_id)
+    await timeline_cache.forget([user_id])
+
+    return {
+        'message': 'Users followed successfully',
+        'followed': [followee_id for _, followee_id in new_follows],
+        'not_found': [followee_id for followee_id in followee_ids if followee_id not in existing_ids],
+    }
+
+
 @router.post('/{user_id}/unfollow')
-async def unfollow(user_id: UUID, who: FollowRequestDTO, db: Session = Depends(get_db_session),
+async def unfollow(user_id: UUID, who: FollowRequestDTO, db: AsyncSession = Depends(get_db_session),
                    is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
 
-    follows = db.query(Follows).filter(Follows.follower_id == user_id, Follows.followee_id == who.followee_id).first()
-    if follows is None:
+    if not await delete_follows(user_id, [who.followee_id], db):
         raise HTTPException(status_code=404, detail='No follows relation found')
 
-    db.delete(follows)
-    db.commit()
+    await db.commit()
+    remember_writes(user_id)
+    await timeline_cache.forget([user_id])
     return {'message': 'User unfollowed successfully'}
 
 
-@router.get('/{user_id}/timeline')
-async def fetch_timeline(user_id: str, db: Session = Depends(get_db_session),
+@router.post('/{user_id}/unfollow/bulk', response_model=BulkUnfollowResponseDTO)
+async def unfollow_many(user_id: UUID, who: BulkFollowRequestDTO, db: AsyncSession = Depends(get_db_session),
+                        is_logged_in: bool = Depends(check_logged_in)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    unfollowed_ids = await delete_follows(user_id, list(set(who.followee_ids)), db)
+    await db.commit()
+    remember_writes(user_id)
+    await timeline_cache.forget([user_id])
+    return {'message': 'Users unfollowed successfully', 'unfollowed': unfollowed_ids}
+
+
+# The body is a CSV with a follower_id,followee_id pair per line (the header line is optional). It's read as a stream
+# and imported in chunks of IMPORT_CHUNK_SIZE lines, each in its own transaction, so the graph can be of any size.
+# Importing the same file again is a no-op, so a failed import can just be retried.
+@router.post('/follows/import', response_model=ImportFollowsResponseDTO,
+             openapi_extra={'requestBody': {'content': {'text/csv': {'schema': {'type': 'string'}}}, 'required': True}})
+async def import_follows(request: Request, db: AsyncSession = Depends(get_db_session),
                          is_logged_in: bool = Depends(check_logged_in)):
     if not is_logged_in:
         raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
 
-    # TODO: find a way to improve this. e.g: this could use token-based pagination
-    query = (
-        select(Peep.content,
-               func.to_char(Peep.created_at, 'YYYY-MM-DD"T"HH24:MI "UTC"OF').label('created_at'))
-        .join(Follows, Follows.followee_id == Peep.user_id)  # Join peeps on follows
-        .join(User, User.id == Follows.followee_id)  # Join users on follows
-        .filter(Follows.follower_id == user_id)
-        .order_by(desc(Peep.created_at))
-    )
+    counts = {'imported': 0, 'skipped': 0, 'invalid': 0}
+    edges = []
+    chunk = 1
+    async for line in read_lines(request):
+        # strip() also drops the \r of the files with CRLF line endings, e.g: from Excel or Python's csv module
+        if not line.strip() or line.strip().replace(' ', '') == 'follower_id,followee_id':
+            continue
+
+        try:
+            follower_id, followee_id = line.split(',')
+            edges.append((UUID(follower_id.strip()), UUID(followee_id.strip())))
+        except ValueError:
+            counts['invalid'] += 1
+            continue
+
+        if len(edges) == IMPORT_CHUNK_SIZE:
+            await import_follows_chunk(chunk, edges, counts, db)
+            edges = []
+            chunk += 1
 
-    timeline = db.execute(query).mappings().all()
+    if edges:
+        await import_follows_chunk(chunk, edges, counts, db)
 
-    return {'timeline': timeline}
+    return {'message': 'Follows imported successfully', **counts}
+
+
+@router.get('/{user_id}/stats', response_model=UserStatsResponseDTO)
+async def fetch_stats(user_id: UUID, db: AsyncSession = Depends(get_read_db_session),
+                      is_logged_in: bool = Depends(check_logged_in)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    stats = (await db.execute(stats_query(user_id))).mappings().first()
+    if stats is None:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    return {'stats': stats}
+
+
+@router.get('/{user_id}/timeline', response_model=TimelineResponseDTO)
+async def fetch_timeline(user_id: UUID, response: Response, db: AsyncSession = Depends(get_read_db_session),
+                         is_logged_in: bool = Depends(check_logged_in),
+                         limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         cursor: str | None = None, if_none_match: str | None = Header(default=None)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    # Keyset pagination: instead of an OFFSET (which makes the database walk over all the skipped rows), continue
+    # right after the last row the client saw, so every page costs the same no matter how deep the scroll goes
+    position = None
+    if cursor is not None:
+        try:
+            position = decode_cursor(cursor)
+        except InvalidCursorException:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+
+    # Fetch one extra row, so we know if there is a next page without running a separate COUNT
+    rows = await timeline_cache.page(user_id, limit + 1, position[1] if position is not None else None)
+    if rows is None and if_none_match is not None:
+        # Polling clients mostly have the page already: check it with the keys of its rows alone, from the indexes,
+        # before loading the peeps
+        query, parameters = timeline_query(user_id, limit + 1, position, keys_only=True)
+        keys = (await db.execute(query, parameters)).all()
+        etag = timeline_etag([(str(peep_id), created_at.isoformat()) for peep_id, created_at in keys])
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, TIMELINE_MAX_AGE)
+
+    if rows is None and position is None:
+        # Fetch enough rows to fill the cache (and one more, so it knows if the timeline goes on) in the same query
+        query, parameters = timeline_query(user_id, max(limit, timeline_cache.rows) + 1)
+        rows = [timeline_row(row) for row in (await db.execute(query, parameters)).mappings()]
+        await timeline_cache.store(user_id, rows)
+        rows = rows[:limit + 1]
+    elif rows is None:
+        query, parameters = timeline_query(user_id, limit + 1, position)
+        rows = [timeline_row(row) for row in (await db.execute(query, parameters)).mappings()]
+
+    etag = timeline_etag(rows)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, TIMELINE_MAX_AGE)
+    response.headers.update(cache_headers(etag, TIMELINE_MAX_AGE))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_id, _, last_created_at = rows[-1]
+        next_cursor = encode_cursor(datetime.fromisoformat(last_created_at), UUID(last_id))
+
+    # The created_at of the rows are ISO 8601 strings in UTC, without the time zone: TimelineResponseDTO parses them
+    # back into datetimes with the Z, natively
+    timeline = [{'content': content, 'created_at': created_at + 'Z'} for _, content, created_at in rows]
+
+    return {'timeline': timeline, 'next_cursor': next_cursor}
+
+
+@router.get('/{user_id}/timeline/export')
+async def export_timeline(user_id: UUID, db: AsyncSession = Depends(get_read_db_session),
+                          is_logged_in: bool = Depends(check_logged_in)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    return StreamingResponse(export_rows(*timeline_query(user_id, None), db), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.get('/{user_id}/peeps/export')
+async def export_peeps(user_id: UUID, db: AsyncSession = Depends(get_read_db_session),
+                       is_logged_in: bool = Depends(check_logged_in)):
+    if not is_logged_in:
+        raise HTTPException(status_code=401, detail='Not logged in', headers={'WWW-Authenticate': 'Bearer'})
+
+    return StreamingResponse(export_rows(USER_PEEPS, {'user_id': user_id}, db), media_type=NDJSON_MEDIA_TYPE)
 
 
 # TODO: not used now, I have to find a better way to paginate and so it's possible to load all the peeps
@@ -123,3 +331,101 @@ def extract_set_fields(body: BaseModel):
             fields[key] = value
 
     return fields
+
+
+def timeline_row(row) -> list:
+    # The rows of the timeline as they are cached, see TimelineCache
+    return [str(row['id']), row['content'], row['created_at'].isoformat()]
+
+
+async def find_existing_users(user_ids: Iterable[UUID], db: AsyncSession) -> set[UUID]:
+    return set(await db.scalars(select(User.id).where(User.id == any_(uuid_array(set(user_ids))))))
+
+
+async def insert_follows(edges: list[tuple[UUID, UUID]], db: AsyncSession) -> list[tuple[UUID, UUID]]:
+    """
+    Create the (follower, followee) relations in `edges` and backfill their timelines. The ones that already exist are
+    ignored (ON CONFLICT DO NOTHING), so only the new relations are returned.
+    """
+    if not edges:
+        return []
+
+    follower_ids, followee_ids = zip(*edges)
+    new_follows = (
+        func.unnest(uuid_array(follower_ids), uuid_array(followee_ids))
+        .table_valued('follower_id', 'followee_id')
+        .render_derived(name='new_follows')
+    )
+    inserted = (await db.execute(
+        insert(Follows)
+        .from_select(['follower_id', 'followee_id'], select(new_follows.c.follower_id, new_follows.c.followee_id))
+        .on_conflict_do_nothing()
+        .returning(Follows.follower_id, Follows.followee_id)
+    )).all()
+
+    inserted_edges = [tuple(row) for row in inserted]
+    await update_stats(db, followers=[followee_id for _, followee_id in inserted_edges],
+                       followees=[follower_id for follower_id, _ in inserted_edges])
+    await backfill_follows(inserted_edges, db)
+    return inserted_edges
+
+
+async def delete_follows(follower_id: UUID, followee_ids: list[UUID], db: AsyncSession) -> list[UUID]:
+    """
+    Remove the relations of `follower_id` with `followee_ids` and their peeps from the follower's timeline. Returns the
+    followees that were actually followed.
+    """
+    unfollowed_ids = list(await db.scalars(
+        delete_statement(Follows)
+        .where(Follows.follower_id == follower_id, Follows.followee_id == any_(uuid_array(followee_ids)))
+        .returning(Follows.followee_id)
+    ))
+    if unfollowed_ids:
+        await update_stats(db, followers=unfollowed_ids, followees=[follower_id] * len(unfollowed_ids), sign=-1)
+        await remove_follow_entries(follower_id, unfollowed_ids, db)
+    return unfollowed_ids
+
+
+async def import_follows_chunk(chunk: int, edges: list[tuple[UUID, UUID]], counts: dict[str, int],
+                               db: AsyncSession):
+    existing_ids = await find_existing_users({user_id for edge in edges for user_id in edge}, db)
+    valid_edges = [edge for edge in edges if edge[0] in existing_ids and edge[1] in existing_ids]
+    try:
+        new_follows = await insert_follows(valid_edges, db)
+        await db.commit()
+    except IntegrityError:
+        # e.g: a user deleted after find_existing_users. The chunks before this one are already committed
+        await db.rollback()
+        raise HTTPException(status_code=409,
+                            detail=f'Could not import chunk {chunk} of {IMPORT_CHUNK_SIZE} lines: a user was deleted or '
+                                   f'followed meanwhile. The {counts["imported"]} follows imported before it are kept, '
+                                   f'import the file again to resume')
+    await timeline_cache.forget(follower_id for follower_id, _ in new_follows)
+
+    counts['imported'] += len(new_follows)
+    counts['skipped'] += len(valid_edges) - len(new_follows)
+    counts['invalid'] += len(edges) - len(valid_edges)
+
+
+async def export_rows(query: Select, parameters: dict, db: AsyncSession) -> AsyncIterator[bytes]:
+    """
+    Peeps of `query` as NDJSON, one JSON object per line. With yield_per, the rows come from a server-side cursor
+    EXPORT_BATCH_SIZE at a time, and each batch is sent as soon as it's fetched, so the memory used is the same for any
+    number of rows.
+    """
+    # The session is still open here: FastAPI closes the dependencies with yield after the response is sent
+    result = await db.stream(query, parameters, execution_options={'yield_per': EXPORT_BATCH_SIZE})
+    async for rows in result.mappings().partitions():
+        yield b''.join(dump_json_line({'id': row['id'], 'content': row['content'], 'created_at': row['created_at']})
+                       for row in rows)
+
+
+async def read_lines(request: Request) -> AsyncIterator[str]:
+    # Split the body into lines as it arrives, so the whole file is never held in memory
+    buffer = b''
+    async for chunk in request.stream():
+        *lines, buffer = (buffer + chunk).split(b'\n')
+        for line in lines:
+            yield line.decode(errors='replace')
+    if buffer:
+        yield buffer.decode(errors='replace')
@@ -0,0 +1,106 @@
+import os
+from typing import Iterable
+from uuid import UUID
+
+from lambdas.cache import LocalCache, RedisCache, TTLCache, cache_from_url
+from ..pagination import DEFAULT_PAGE_SIZE
+
+# Results of the hot prefixes of GET /users/search, keyed by (prefix, limit). Mentions autocomplete sends a request per
+# keystroke, and many users type the same first letters
+user_search_cache = TTLCache(maxsize=int(os.environ.get('PEEP_USER_SEARCH_CACHE_SIZE', 1000)),
+                             ttl=float(os.environ.get('PEEP_USER_SEARCH_CACHE_TTL', 30)))
+
+
+# Pages of the timeline cached per user, counted in pages of the default size
+TIMELINE_CACHE_PAGES = int(os.environ.get('PEEP_TIMELINE_CACHE_PAGES', 3))
+
+
+class TimelineCache:
+    """
+    The newest rows of each timeline, read far more often than they change. A single entry per user holds its first
+    pages, as [id, content, created_at] rows: every page size, and the next pages within them, are served from it, and
+    a write only has one key to drop per timeline it changes. It counts its hits and misses, see /metrics.
+    """
+
+    def __init__(self, backend: LocalCache | RedisCache, rows: int):
+        self.backend = backend
+        self.rows = rows
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def page(self, user_id: UUID, limit: int, after_id: UUID | None = None) -> list[list] | None:
+        """
+        Up to `limit` rows of the timeline of `user_id`, starting after the row `after_id` (that of the cursor), or None
+        when they are not all in the cache.
+        """
+        entry = await self.backend.get(timeline_key(user_id))
+        page = None
+        if entry is not None:
+            rows = entry['rows']
+            start = 0
+            if after_id is not None:
+                after_id = str(after_id)
+                start = next((index + 1 for index, row in enumerate(rows) if row[0] == after_id), None)
+            if start is not None:
+                page = rows[start:start + limit]
+                if len(page) < limit and not entry['complete']:
+                    # The rest of the page is past the cached rows
+                    page = None
+
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    async def store(self, user_id: UUID, rows: list[list]):
+        """
+        Cache the first rows of the timeline of `user_id`. Pass one more row than `self.rows` when there is one, so it
+        knows that the timeline goes on.
+        """
+        await self.backend.set(timeline_key(user_id), {'rows': rows[:self.rows], 'complete': len(rows) <= self.rows})
+
+    async def forget(self, user_ids: Iterable[UUID]):
+        """
+        Drop the timelines of `user_ids`, after a write to them is committed. With the local backend, other processes
+        keep theirs for at most PEEP_TIMELINE_CACHE_TTL seconds.
+        """
+        keys = {timeline_key(user_id) for user_id in user_ids}
+        self.invalidations += len(keys)
+        await self.backend.delete(keys)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'backend': type(self.backend).__name__, 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None, 'invalidations': self.invalidations}
+
+
+def timeline_key(user_id: UUID) -> str:
+    return f'timeline:{str(user_id).lower()}'
+
+
+# On PEEP_CACHE_URL if set (e.g: redis://host:6379/0, shared by every Lambda instance), in memory otherwise. The new
+# peeps of authors fanned out on read are not in any timeline entry, so the cached timelines of their followers are not
+# dropped (there may be millions): they show up when those expire, after at most PEEP_TIMELINE_CACHE_TTL seconds.
+timeline_cache = TimelineCache(
+    cache_from_url(os.environ.get('PEEP_CACHE_URL'), maxsize=int(os.environ.get('PEEP_TIMELINE_CACHE_SIZE', 10000)),
+                   ttl=float(os.environ.get('PEEP_TIMELINE_CACHE_TTL', 30))),
+    rows=TIMELINE_CACHE_PAGES * DEFAULT_PAGE_SIZE,
+)
+
+
+def forget_user_search(user_id: UUID | None = None, names: Iterable[str | None] = ()):
+    """
+    Drop the cached results that include `user_id`, or that the new username or name in `names` would now match.
+    Only this process' cache is updated, on the others they are stale for at most PEEP_USER_SEARCH_CACHE_TTL seconds.
+    """
+    user_id = str(user_id) if user_id is not None else None
+    lowered_names = [name.lower() for name in names if name]
+
+    def is_stale(key: tuple[str, int], users: list[dict]) -> bool:
+        prefix, _ = key
+        return (any(name.startswith(prefix) for name in lowered_names)
+                or any(user['id'] == user_id for user in users))
+
+    user_search_cache.delete_where(is_stale)
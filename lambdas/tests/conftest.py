@@ -0,0 +1,84 @@
+import os
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import Connection, create_engine, text
+from sqlalchemy.pool import NullPool
+
+from lambdas.db import get_db_url
+from lambdas.db.migrations import migrate
+
+# Arbitrary key for pg_advisory_lock, so the pytest-xdist workers build the template database one at a time
+TEMPLATE_LOCK_KEY = 7_312_016
+# Name of the database the session was configured with, to restore it at the end
+base_database_key = pytest.StashKey[str]()
+
+
+# Every test session (and every pytest-xdist worker of a session) runs on its own database, cloned from a template that
+# has the migrations applied. Cloning is a file copy, much faster than building the schema again, and the workers never
+# see each other's data. The template is built by the first worker of each session, so it follows the migrations.
+def pytest_sessionstart(session: pytest.Session):
+    if is_xdist_controller(session.config):
+        # The controller only hands out the tests to the workers, it does not run any
+        return
+
+    base_name = os.environ['DB_NAME']
+    template_name = f'{base_name}_template'
+    database_name = f'{base_name}_{os.environ.get("PYTEST_XDIST_WORKER", "main")}'
+    # Shared by all the workers of a session, so the template is built once per session
+    session_id = os.environ.get('PYTEST_XDIST_TESTRUNUID', uuid4().hex)
+
+    engine = create_engine(get_db_url(), isolation_level='AUTOCOMMIT', poolclass=NullPool)
+    with engine.connect() as connection:
+        connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': TEMPLATE_LOCK_KEY})
+        try:
+            if template_session_id(connection, template_name) != session_id:
+                create_template(connection, template_name, session_id)
+            connection.execute(text(f'DROP DATABASE IF EXISTS "{database_name}"'))
+            connection.execute(text(f'CREATE DATABASE "{database_name}" TEMPLATE "{template_name}"'))
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': TEMPLATE_LOCK_KEY})
+    engine.dispose()
+
+    # get_db_url reads it on every call, so from now on everything connects to the clone
+    session.config.stash[base_database_key] = base_name
+    os.environ['DB_NAME'] = database_name
+
+
+def pytest_sessionfinish(session: pytest.Session):
+    base_name = session.config.stash.get(base_database_key, None)
+    if base_name is None:
+        return
+
+    database_name = os.environ['DB_NAME']
+    os.environ['DB_NAME'] = base_name
+    engine = create_engine(get_db_url(), isolation_level='AUTOCOMMIT', poolclass=NullPool)
+    with engine.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{database_name}"'))
+    engine.dispose()
+
+
+def is_xdist_controller(config: pytest.Config) -> bool:
+    return not hasattr(config, 'workerinput') and config.getoption('numprocesses', default=None) not in (None, 0)
+
+
+def template_session_id(connection: Connection, template_name: str) -> str | None:
+    query = text("SELECT shobj_description(oid, 'pg_database') FROM pg_database WHERE datname = :name")
+    return connection.scalar(query, {'name': template_name})
+
+
+def create_template(connection: Connection, template_name: str, session_id: str):
+    connection.execute(text(f'DROP DATABASE IF EXISTS "{template_name}"'))
+    connection.execute(text(f'CREATE DATABASE "{template_name}"'))
+
+    base_name = os.environ['DB_NAME']
+    os.environ['DB_NAME'] = template_name
+    try:
+        template_engine = create_engine(get_db_url(), poolclass=NullPool)
+        migrate(template_engine)
+        template_engine.dispose()
+    finally:
+        os.environ['DB_NAME'] = base_name
+
+    # Marks the template as built by this session
+    connection.execute(text(f'COMMENT ON DATABASE "{template_name}" IS \'{session_id}\''))
@@ -0,0 +1,28 @@
+import boto3
+
+from lambdas.db.main import get_parameter_store_credentials
+
+
+class FakeSSMClient:
+    def __init__(self):
+        self.calls = []
+
+    def get_parameters(self, Names):
+        self.calls.append(Names)
+        return {
+            'Parameters': [
+                {'Name': '/peep/live/db-user', 'Value': 'user'},
+                {'Name': '/peep/live/db-password', 'Value': 'password'},
+            ],
+            'InvalidParameters': [],
+        }
+
+
+def test_should_fetch_credentials_in_a_single_call(monkeypatch):
+    ssm = FakeSSMClient()
+    monkeypatch.setattr(boto3, 'client', lambda service: ssm)
+
+    user, password = get_parameter_store_credentials('live')
+
+    assert (user, password) == ('user', 'password')
+    assert ssm.calls == [['/peep/live/db-user', '/peep/live/db-password']]
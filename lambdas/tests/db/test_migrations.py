@@ -0,0 +1,64 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.pool import NullPool, QueuePool
+
+from lambdas.db import Base, get_db_url
+from lambdas.db.migrations import migrate
+from lambdas.db.migrations.main import discover_migrations
+from lambdas.db.pool import PoolMetrics, engine_options
+
+
+def test_migrations_are_discovered_in_order():
+    versions = [version for version, _, _ in discover_migrations()]
+    assert versions == sorted(versions)
+    assert versions[0] == 1
+
+
+def test_migrations_create_the_schema_of_the_models():
+    engine = create_engine(get_db_url())
+    # Running them twice also checks they are only applied once
+    migrate(engine)
+    migrate(engine)
+
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        assert columns == set(table.columns.keys()), table.name
+
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= indexes, table.name
+
+    engine.dispose()
+
+
+@pytest.fixture
+def empty_database(monkeypatch):
+    # A database without any migration applied, unlike the clone of the template the tests run on
+    admin_engine = create_engine(get_db_url(), isolation_level='AUTOCOMMIT', poolclass=NullPool)
+    database_name = f'{os.environ["DB_NAME"]}_empty'
+    with admin_engine.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{database_name}"'))
+        connection.execute(text(f'CREATE DATABASE "{database_name}"'))
+    monkeypatch.setenv('DB_NAME', database_name)
+
+    yield
+
+    with admin_engine.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{database_name}"'))
+    admin_engine.dispose()
+
+
+def test_migrations_run_with_a_single_connection_pool(monkeypatch, empty_database):
+    # The pool of the deploy-time Lambda function: a second connection would time out
+    monkeypatch.setenv('PEEP_DB_POOL_PRESET', 'lambda')
+    monkeypatch.setenv('PEEP_DB_POOL_TIMEOUT', '1')
+    engine = create_engine(get_db_url(), **engine_options(QueuePool, PoolMetrics()))
+
+    migrate(engine)
+
+    with engine.connect() as connection:
+        applied = list(connection.scalars(text('SELECT version FROM schema_migrations ORDER BY version')))
+    assert applied == [version for version, _, _ in discover_migrations()]
+    engine.dispose()
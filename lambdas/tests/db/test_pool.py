@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+from lambdas.db import get_db_url
+from lambdas.db.pool import PoolConfigException, PoolMetrics, engine_options
+
+
+def test_lambda_is_the_default_preset_on_lambda(monkeypatch):
+    monkeypatch.delenv('PEEP_DB_POOL_PRESET', raising=False)
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'ProxyLambda')
+
+    options = engine_options(QueuePool, PoolMetrics())
+
+    assert (options['pool_size'], options['max_overflow'], options['pool_pre_ping']) == (1, 0, False)
+    assert options['echo'] is False
+
+
+def test_environment_variables_override_the_preset(monkeypatch):
+    monkeypatch.setenv('PEEP_DB_POOL_PRESET', 'server')
+    monkeypatch.setenv('PEEP_DB_POOL_SIZE', '2')
+    monkeypatch.setenv('PEEP_DB_POOL_PRE_PING', 'false')
+    monkeypatch.setenv('PEEP_DB_ECHO', 'true')
+
+    options = engine_options(QueuePool, PoolMetrics())
+
+    assert (options['pool_size'], options['max_overflow'], options['pool_pre_ping']) == (2, 10, False)
+    assert options['echo'] is True
+    assert issubclass(options['poolclass'], QueuePool)
+
+
+def test_proxy_preset_does_not_pool(monkeypatch):
+    monkeypatch.setenv('PEEP_DB_POOL_PRESET', 'lambda-proxy')
+    monkeypatch.setenv('PEEP_DB_POOL_SIZE', '2')
+
+    options = engine_options(QueuePool, PoolMetrics())
+
+    assert options['poolclass'] is NullPool
+    assert 'pool_size' not in options
+
+
+def test_unknown_preset(monkeypatch):
+    monkeypatch.setenv('PEEP_DB_POOL_PRESET', 'huge')
+
+    with pytest.raises(PoolConfigException):
+        engine_options(QueuePool, PoolMetrics())
+
+
+def test_metrics_count_the_checkouts_that_wait(monkeypatch):
+    monkeypatch.setenv('PEEP_DB_POOL_PRESET', 'lambda')
+    metrics = PoolMetrics()
+    engine = create_engine(get_db_url(), **engine_options(QueuePool, metrics))
+    metrics.watch(engine)
+
+    first = engine.connect()
+    # The only connection is checked out, so this one has to wait until it's given back
+    threading.Timer(0.1, first.close).start()
+    start = time.perf_counter()
+    with engine.connect():
+        assert time.perf_counter() - start >= 0.1
+
+    snapshot = metrics.snapshot(engine.pool)
+    assert (snapshot['checkouts'], snapshot['connects'], snapshot['waits']) == (2, 1, 1)
+    assert snapshot['wait_seconds'] >= 0.1
+    assert (snapshot['size'], snapshot['checked_out']) == (1, 0)
+    engine.dispose()
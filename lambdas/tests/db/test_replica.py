@@ -0,0 +1,76 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from lambdas.db import ASYNC_DB_DRIVER, get_db_url, main, replica
+from lambdas.db.replica import is_replica_lagging, recent_writes, remember_writes, replica_lag, replica_lag_cache
+from lambdas.tests.routes.utils import anyio_backend
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    replica_lag_cache.clear()
+    recent_writes.clear()
+
+
+async def test_a_primary_has_no_lag():
+    # The stand-in for a replica: the test database is a primary, which is never behind
+    engine = create_async_engine(get_db_url(ASYNC_DB_DRIVER), poolclass=NullPool)
+
+    assert await replica_lag(engine) == 0
+    assert not await is_replica_lagging(engine)
+    await engine.dispose()
+
+
+async def test_an_unreachable_replica_is_lagging():
+    engine = create_async_engine(get_db_url(ASYNC_DB_DRIVER, host='127.0.0.1', port='1'), poolclass=NullPool)
+
+    assert await is_replica_lagging(engine)
+    await engine.dispose()
+
+
+async def test_a_replica_too_slow_to_answer_is_lagging(monkeypatch: pytest.MonkeyPatch):
+    engine = create_async_engine(get_db_url(ASYNC_DB_DRIVER), poolclass=NullPool)
+    monkeypatch.setattr(replica, 'REPLICA_LAG_CHECK_TIMEOUT', 0.1)
+
+    async def slow_replica_lag(engine):
+        async with engine.connect() as connection:
+            return await connection.scalar(text('SELECT pg_sleep(1)'))
+
+    monkeypatch.setattr(replica, 'replica_lag', slow_replica_lag)
+
+    assert await is_replica_lagging(engine)
+    await engine.dispose()
+
+
+async def test_reads_go_to_the_primary_after_writing(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('DB_READ_HOST', 'replica')
+    monkeypatch.setattr(main, 'get_async_read_engine', lambda: None)
+    replica_lag_cache.set('lag', 0)
+    writer_id, reader_id = uuid4(), uuid4()
+
+    remember_writes(writer_id)
+
+    assert await main.should_read_from_primary(str(writer_id).upper())
+    assert not await main.should_read_from_primary(str(reader_id))
+    assert not await main.should_read_from_primary(None)
+
+
+async def test_reads_go_to_the_primary_while_the_replica_lags(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('DB_READ_HOST', 'replica')
+    monkeypatch.setattr(main, 'get_async_read_engine', lambda: None)
+    replica_lag_cache.set('lag', 30)
+
+    assert await main.should_read_from_primary(None)
+
+
+async def test_reads_go_to_the_primary_without_replica(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delenv('DB_READ_HOST', raising=False)
+
+    assert await main.should_read_from_primary(None)
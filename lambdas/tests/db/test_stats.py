@@ -0,0 +1,49 @@
+import pytest
+from sqlalchemy import create_engine, delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.pool import NullPool
+
+from lambdas.db import User, UserStats, get_db_url, main
+from lambdas.db.stats import reconcile_stats, stats_query
+from lambdas.tests.routes.utils import anyio_backend, session_fixture
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_reconcile_stats_fixes_the_drift(session_fixture: AsyncSession):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+    connection = await session_fixture.connection()
+
+    # The fixture users have no stats yet, so this is the backfill
+    await connection.run_sync(reconcile_stats)
+    stats = (await session_fixture.execute(stats_query(user_id))).mappings().one()
+    assert stats == {'followers_count': 0, 'followees_count': 0, 'peeps_count': 4}
+
+    await session_fixture.execute(update(UserStats).where(UserStats.user_id == user_id).values(peeps_count=10))
+    assert await connection.run_sync(reconcile_stats) == 1
+    assert await session_fixture.scalar(select(UserStats.peeps_count).where(UserStats.user_id == user_id)) == 4
+
+    # Nothing drifted anymore
+    assert await connection.run_sync(reconcile_stats) == 0
+
+
+def test_reconcile_stats_handler(monkeypatch: pytest.MonkeyPatch):
+    # The handler runs its own transactions, so this user is committed, and deleted at the end
+    engine = create_engine(get_db_url(), poolclass=NullPool)
+    monkeypatch.setattr(main, 'get_engine', lambda: engine)
+    with engine.begin() as connection:
+        user_id = connection.scalar(insert(User).values(name='Drift', email='drift@example.com', username='drift',
+                                                        password='password').returning(User.id))
+        connection.execute(insert(UserStats).values(user_id=user_id, followers_count=0, followees_count=0,
+                                                    peeps_count=3))
+
+    try:
+        response = main.reconcile_stats_handler({}, None)
+
+        assert response == {'message': 'Stats reconciled successfully', 'fixed': 1}
+        with engine.connect() as connection:
+            assert connection.scalar(select(UserStats.peeps_count).where(UserStats.user_id == user_id)) == 0
+    finally:
+        with engine.begin() as connection:
+            connection.execute(delete(User).where(User.id == user_id))
+        engine.dispose()
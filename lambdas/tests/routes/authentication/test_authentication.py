@@ -0,0 +1,25 @@
+import pytest
+from fastapi import status
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from lambdas.tests.routes.utils import anyio_backend, client, session_fixture
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_login_and_get_me(client: AsyncClient, session_fixture: AsyncSession):
+    response = await client.post('/users/auth/login', data={'username': 'leolas1', 'password': 'password1'})
+    assert response.status_code == status.HTTP_200_OK
+    token = response.json()['access_token']
+
+    response = await client.get('/users/auth/me', headers={'Authorization': f'Bearer {token}'})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['username'] == 'leolas1'
+
+
+async def test_login_with_wrong_password(client: AsyncClient, session_fixture: AsyncSession):
+    response = await client.post('/users/auth/login', data={'username': 'leolas1', 'password': 'wrong'})
+
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -1,10 +1,19 @@
+import asyncio
+import threading
 from datetime import datetime, timezone, timedelta
 
 import jwt
 import pytest
+from fastapi import HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from lambdas.db import User
+from lambdas.routes.authentication import utils
 from lambdas.routes.authentication.utils import validate_token, create_access_token, JWT_SIGNING_KEY, \
-    JWT_SIGNING_ALGORITHM
+    JWT_SIGNING_ALGORITHM, HashingOverloadedException, HashingPool, check_password, forget_user, get_current_user, \
+    make_password, password_needs_rehash, token_cache, token_version_cache, access_token_claims
+from lambdas.tests.routes.utils import anyio_backend, session_fixture
 
 
 def test_should_return_none_for_invalid_token():
@@ -54,3 +63,92 @@ def test_should_create_token_with_30_minutes_expiry():
     difference = expected_exp - actual_exp
     tolerance = timedelta(seconds=1)
     assert difference < tolerance
+
+
+def test_should_hash_with_the_configured_rounds(monkeypatch):
+    monkeypatch.setattr(utils, 'BCRYPT_ROUNDS', 4)
+
+    hashed_password = make_password('password')
+
+    assert hashed_password.startswith('$2b$04$')
+    assert not password_needs_rehash(hashed_password)
+    assert password_needs_rehash(make_password('password', rounds=5))
+
+
+@pytest.mark.anyio
+async def test_hashing_pool_should_reject_calls_over_the_pending_limit():
+    pool = HashingPool(max_workers=1, max_pending=1)
+    release = threading.Event()
+
+    # Start the first call, so it takes the only pending slot
+    task = asyncio.ensure_future(pool.run(release.wait))
+    await asyncio.sleep(0)
+
+    with pytest.raises(HashingOverloadedException):
+        await pool.run(make_password, 'password')
+
+    release.set()
+    assert await task is True
+    assert pool.pending == 0
+
+
+@pytest.mark.anyio
+async def test_should_rehash_password_on_login_when_rounds_change(session_fixture: AsyncSession, monkeypatch):
+    monkeypatch.setattr(utils, 'BCRYPT_ROUNDS', 5)
+    old_hash = await session_fixture.scalar(select(User.password).where(User.username == 'leolas1'))
+    assert password_needs_rehash(old_hash)
+
+    user = await check_password('leolas1', 'password1', session_fixture)
+
+    assert user
+    new_hash = await session_fixture.scalar(select(User.password).where(User.username == 'leolas1'))
+    assert new_hash.startswith('$2b$05$')
+    assert await check_password('leolas1', 'password1', session_fixture)
+
+
+def test_should_cache_valid_tokens_until_they_expire():
+    token = create_access_token({'sub': 'cached username'})
+    assert validate_token(token) == 'cached username'
+    assert token_cache.get(token)['sub'] == 'cached username'
+
+    expired_token = create_access_token({'sub': 'cached username'}, expires_delta=timedelta(minutes=-1))
+    assert validate_token(expired_token) is None
+    assert token_cache.get(expired_token) is None
+    token_cache.clear()
+
+
+@pytest.mark.anyio
+async def test_should_build_current_user_from_token_claims(session_fixture: AsyncSession):
+    user = await session_fixture.scalar(select(User).where(User.username == 'leolas1'))
+    token = create_access_token(access_token_claims(user))
+
+    current_user = await get_current_user(token, session_fixture)
+    assert (current_user.id, current_user.username, current_user.name) == (user.id, 'leolas1', 'leo1')
+
+    # The token version is cached now, so the database is not needed anymore
+    assert await get_current_user(token, None) == current_user
+    forget_user(user.id)
+    token_cache.clear()
+
+
+@pytest.mark.anyio
+async def test_should_reject_revoked_tokens(session_fixture: AsyncSession):
+    user = await session_fixture.scalar(select(User).where(User.username == 'leolas1'))
+    token = create_access_token(access_token_claims(user))
+    user.token_version += 1
+    await session_fixture.flush()
+
+    with pytest.raises(HTTPException) as error:
+        await get_current_user(token, session_fixture)
+    assert error.value.status_code == status.HTTP_401_UNAUTHORIZED
+    token_cache.clear()
+    token_version_cache.clear()
+
+
+@pytest.mark.anyio
+async def test_should_reject_tokens_without_user_claims(session_fixture: AsyncSession):
+    token = create_access_token({'sub': 'leolas1'})
+
+    with pytest.raises(HTTPException):
+        await get_current_user(token, session_fixture)
+    token_cache.clear()
@@ -0,0 +1,34 @@
+import pytest
+from fastapi import status
+from httpx import AsyncClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from lambdas.db import User
+from lambdas.tests.routes.utils import anyio_backend, client, session_fixture
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_db_pool_metrics(client: AsyncClient, session_fixture: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('PEEP_DB_POOL_PRESET', 'server')
+
+    response = await client.get('/metrics/db-pool')
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['preset'] == 'server'
+    assert 'engines' in response.json()
+
+
+async def test_timeline_cache_metrics(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+    await client.get(f'/users/{user_id}/timeline')
+    await client.get(f'/users/{user_id}/timeline')
+
+    response = await client.get('/metrics/timeline-cache')
+
+    assert response.status_code == status.HTTP_200_OK
+    metrics = response.json()
+    assert metrics['backend'] == 'LocalCache'
+    assert metrics['hits'] >= 1 and metrics['misses'] >= 1
+    assert 0 < metrics['hit_ratio'] < 1
@@ -1,15 +1,23 @@
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
 from fastapi import status
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from httpx import AsyncClient
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from lambdas.db import Peep, User
-from lambdas.tests.routes.utils import client, session_fixture
+from lambdas.tests.routes.users.utils import follow_user
+from lambdas.tests.routes.utils import anyio_backend, auth_headers, client, session_fixture
+
+pytestmark = pytest.mark.anyio
 
 
-def test_create_peep(client: TestClient, session_fixture: Session):
-    test_id = session_fixture.query(Peep).with_entities(User.id).first().id
+async def test_create_peep(client: AsyncClient, session_fixture: AsyncSession):
+    test_id = (await session_fixture.execute(select(User.id))).first().id
     body = {'content': 'test peep', 'user_id': str(test_id)}
-    response = client.post(
+    response = await client.post(
         "/peeps/",
         json=body
     )
@@ -22,25 +30,120 @@ def test_create_peep(client: TestClient, session_fixture: Session):
 
     # check new peep on db
     peep_id = response_json['peep']['id']
-    new_peep = session_fixture.query(Peep).filter_by(id=peep_id).one_or_none()
+    new_peep = (await session_fixture.execute(select(Peep).filter_by(id=peep_id))).scalar_one_or_none()
 
     assert new_peep is not None
 
 
-def test_find_one(client: TestClient, session_fixture: Session):
+async def test_find_one(client: AsyncClient, session_fixture: AsyncSession):
     # Get any first peep to call the API with its id
-    first_peep = session_fixture.query(Peep).with_entities(Peep.id).first()
+    first_peep = (await session_fixture.execute(select(Peep.id))).first()
 
-    response = client.get(f'/peeps/{first_peep.id}')
+    response = await client.get(f'/peeps/{first_peep.id}')
     assert response.status_code == status.HTTP_200_OK
 
 
-def test_delete_peep(client: TestClient, session_fixture: Session):
-    first_peep = session_fixture.query(Peep).with_entities(Peep.id).first()
+async def test_find_one_answers_not_modified_until_the_peep_changes(client: AsyncClient,
+                                                                    session_fixture: AsyncSession):
+    first_peep = (await session_fixture.execute(select(Peep.id))).first()
+    response = await client.get(f'/peeps/{first_peep.id}')
+    etag = response.headers['etag']
+    assert etag.startswith('W/"')
+    assert response.headers['vary'] == 'Authorization'
+    assert 'max-age' in response.headers['cache-control']
 
-    response = client.delete(f'/peeps/{first_peep.id}')
+    response = await client.get(f'/peeps/{first_peep.id}', headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b''
+    assert response.headers['etag'] == etag
 
+    # now() is the same for the whole transaction of the test, so the update has to set a different time itself
+    await session_fixture.execute(update(Peep).where(Peep.id == first_peep.id)
+                                  .values(updated_at=datetime(2030, 1, 1)))
+    response = await client.get(f'/peeps/{first_peep.id}', headers={'If-None-Match': etag})
     assert response.status_code == status.HTTP_200_OK
+    assert response.headers['etag'] != etag
+
+
+async def test_delete_peep(client: AsyncClient, session_fixture: AsyncSession):
+    first_peep = (await session_fixture.execute(select(Peep.id))).first()
+
+    response = await client.delete(f'/peeps/{first_peep.id}')
 
-    deleted_peep = session_fixture.query(Peep).where(Peep.id == first_peep.id).one_or_none()
+    assert response.status_code == status.HTTP_200_OK
+
+    deleted_peep = (await session_fixture.execute(select(Peep).where(Peep.id == first_peep.id))).scalar_one_or_none()
     assert deleted_peep is None
+
+
+async def test_create_peeps_in_batch(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = (await session_fixture.execute(select(User.id))).first().id
+    body = [{'content': f'batch peep {number}', 'user_id': str(user_id)} for number in range(3)]
+
+    response = await client.post('/peeps/batch', json=body)
+
+    assert response.status_code == status.HTTP_201_CREATED
+    results = response.json()['results']
+    assert [result['status'] for result in results] == [status.HTTP_201_CREATED] * 3
+    assert [result['peep']['content'] for result in results] == ['batch peep 0', 'batch peep 1', 'batch peep 2']
+
+    peep_ids = [result['peep']['id'] for result in results]
+    contents = (await session_fixture.scalars(select(Peep.content).where(Peep.id.in_(peep_ids)))).all()
+    assert sorted(contents) == ['batch peep 0', 'batch peep 1', 'batch peep 2']
+
+
+async def test_create_peeps_in_batch_reports_invalid_items(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = (await session_fixture.execute(select(User.id))).first().id
+    body = [
+        {'content': 'valid peep', 'user_id': str(user_id)},
+        {'content': 'peep of unknown user', 'user_id': str(uuid4())},
+    ]
+
+    response = await client.post('/peeps/batch', json=body)
+
+    assert response.status_code == status.HTTP_207_MULTI_STATUS
+    results = response.json()['results']
+    assert results[0]['status'] == status.HTTP_201_CREATED
+    assert results[1] == {'index': 1, 'status': status.HTTP_400_BAD_REQUEST, 'message': 'Invalid data'}
+
+
+async def test_search_peeps(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas3'))
+    for content in ('I love cats', 'cats, cats and more cats', 'dogs are fine too'):
+        response = await client.post('/peeps', json={'content': content, 'user_id': str(user_id)})
+        assert response.status_code == status.HTTP_201_CREATED
+    headers = await auth_headers(client, 'leolas1', 'password1')
+
+    # "cat" matches "cats" too, and the peep that says it the most comes first
+    response = await client.get('/peeps/search', params={'q': 'cat', 'limit': 1}, headers=headers)
+
+    assert response.status_code == status.HTTP_200_OK
+    response_json = response.json()
+    assert [peep['content'] for peep in response_json['peeps']] == ['cats, cats and more cats']
+    assert response_json['next_cursor'] is not None
+
+    response = await client.get('/peeps/search', params={'q': 'cat', 'cursor': response_json['next_cursor']},
+                                headers=headers)
+
+    response_json = response.json()
+    assert [peep['content'] for peep in response_json['peeps']] == ['I love cats']
+    assert response_json['next_cursor'] is None
+
+
+async def test_search_peeps_of_followees(client: AsyncClient, session_fixture: AsyncSession):
+    users = {row.username: row.id for row in (await session_fixture.execute(select(User.username, User.id))).all()}
+    await follow_user(client, users['leolas1'], users['leolas2'])
+    headers = await auth_headers(client, 'leolas1', 'password1')
+
+    response = await client.get('/peeps/search', params={'q': 'test peep', 'following_only': True}, headers=headers)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert {peep['user_id'] for peep in response.json()['peeps']} == {str(users['leolas2'])}
+
+
+async def test_search_peeps_rejects_invalid_cursor(client: AsyncClient, session_fixture: AsyncSession):
+    headers = await auth_headers(client, 'leolas1', 'password1')
+
+    response = await client.get('/peeps/search', params={'q': 'peep', 'cursor': 'nope'}, headers=headers)
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
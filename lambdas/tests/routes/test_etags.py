@@ -0,0 +1,21 @@
+from lambdas.routes.etags import etag_matches, timeline_etag, weak_etag
+
+
+def test_etag_matches():
+    etag = weak_etag('a')
+
+    assert etag_matches(etag, etag)
+    # Weak comparison: the W/ prefix does not matter
+    assert etag_matches(etag.removeprefix('W/'), etag)
+    assert etag_matches(f'W/"other", {etag}', etag)
+    assert etag_matches('*', etag)
+    assert not etag_matches(weak_etag('b'), etag)
+    assert not etag_matches(None, etag)
+
+
+def test_timeline_etag_follows_the_rows():
+    rows = [['id1', 'content', '2024-12-20T14:00:00'], ['id2', 'content', '2024-12-20T13:00:00']]
+
+    # Cached rows and keys of the same page
+    assert timeline_etag(rows) == timeline_etag([(row[0], row[-1]) for row in rows])
+    assert timeline_etag(rows) != timeline_etag(rows[:1])
@@ -0,0 +1,22 @@
+from datetime import datetime, timezone
+from uuid import UUID
+
+from pydantic import TypeAdapter
+
+from lambdas.routes.serialization import UTCDatetime, dump_json_line
+
+
+def test_utc_datetime():
+    adapter = TypeAdapter(UTCDatetime)
+
+    created_at = adapter.validate_python(datetime(2024, 12, 20, 14, 0, 31, 123456))
+    assert adapter.dump_json(created_at) == b'"2024-12-20T14:00:31.123456Z"'
+    assert adapter.dump_json(adapter.validate_python('2024-01-02T03:04:00')) == b'"2024-01-02T03:04:00Z"'
+    assert adapter.validate_python(datetime(2024, 1, 2, 3, 4)).tzinfo == timezone.utc
+
+
+def test_dump_json_line_matches_the_response_models():
+    row = {'id': UUID(int=1), 'created_at': datetime(2024, 12, 20, 14, 0, 31, 123456)}
+
+    assert dump_json_line(row) == (b'{"id":"00000000-0000-0000-0000-000000000001",'
+                                   b'"created_at":"2024-12-20T14:00:31.123456Z"}\n')
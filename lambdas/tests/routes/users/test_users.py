@@ -1,17 +1,30 @@
+import json
+from uuid import uuid4
+
+import pytest
 from fastapi import status
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from httpx import AsyncClient
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from lambdas.db import User
+from lambdas.cache import RedisCache
+from lambdas.db import Follows, TimelineEntry, User, timeline
+from lambdas.main import app
+from lambdas.routes.authentication.utils import check_logged_in, token_version_cache
+from lambdas.routes.users import main as users_main
+from lambdas.routes.users.utils import timeline_cache
 from lambdas.tests.routes.users.utils import follow_user
-from lambdas.tests.routes.utils import client, session_fixture
+from lambdas.tests.routes.utils import FakeRedis, anyio_backend, auth_headers, client, session_fixture
+
+pytestmark = pytest.mark.anyio
 
 
 # Here's the important detail to notice: we can require fixtures in other fixtures and also in the test functions.
 # See: https://sqlmodel.tiangolo.com/tutorial/fastapi/tests/#why-two-fixtures
-def test_create_user(client: TestClient, session_fixture: Session):
+async def test_create_user(client: AsyncClient, session_fixture: AsyncSession):
     body = {'name': 'user1', "email": "user1@email.com", 'username': 'user1', "password": "abc123"}
-    response = client.post(
+    response = await client.post(
         "/users/auth/signup/",
         json=body
     )
@@ -20,63 +33,79 @@ def test_create_user(client: TestClient, session_fixture: Session):
     assert response.content is not None
 
 
-def test_update_user(client: TestClient, session_fixture: Session):
-    first_user = session_fixture.query(User).with_entities(User.id).first()
+async def test_update_user(client: AsyncClient, session_fixture: AsyncSession):
+    first_user = (await session_fixture.execute(select(User.id))).first()
 
     body = {'name': 'new name'}
-    response = client.patch(
+    response = await client.patch(
         f'/users/{first_user.id}',
         json=body
     )
 
-    updated_user = session_fixture.query(User).with_entities(User.name).where(User.id == first_user.id).one()
+    updated_user = (await session_fixture.execute(select(User.name).where(User.id == first_user.id))).one()
     assert response.status_code == status.HTTP_200_OK
     assert updated_user.name == 'new name'
 
 
-def test_delete_user(client: TestClient, session_fixture: Session):
-    first_user = session_fixture.query(User).with_entities(User.id).first()
+async def test_update_user_revokes_tokens(client: AsyncClient, session_fixture: AsyncSession):
+    first_user = (await session_fixture.execute(select(User.id, User.token_version))).first()
+    token_version_cache.set(first_user.id, first_user.token_version)
 
-    response = client.delete(f'/users/{first_user.id}')
+    response = await client.patch(f'/users/{first_user.id}', json={'email': 'new@email.com'})
 
     assert response.status_code == status.HTTP_200_OK
+    assert token_version_cache.get(first_user.id) is None
+    new_version = await session_fixture.scalar(select(User.token_version).where(User.id == first_user.id))
+    assert new_version == first_user.token_version + 1
+
+    # A new name does not revoke them
+    await client.patch(f'/users/{first_user.id}', json={'name': 'new name'})
+    assert await session_fixture.scalar(select(User.token_version).where(User.id == first_user.id)) == new_version
+
+
+async def test_delete_user(client: AsyncClient, session_fixture: AsyncSession):
+    first_user = (await session_fixture.execute(select(User.id))).first()
 
-    deleted_user = session_fixture.query(User).where(User.id == first_user.id).one_or_none()
+    response = await client.delete(f'/users/{first_user.id}')
+
+    assert response.status_code == status.HTTP_200_OK
+
+    deleted_user = (await session_fixture.execute(select(User).where(User.id == first_user.id))).scalar_one_or_none()
     assert deleted_user is None
 
 
-def test_follow(client: TestClient, session_fixture: Session):
-    follower = session_fixture.query(User).where(User.username == 'leolas1').with_entities(User.id).first()
-    followee = session_fixture.query(User).where(User.username == 'leolas2').with_entities(User.id).first()
+async def test_follow(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
 
-    follow_user(client, follower.id, followee.id)
+    await follow_user(client, follower.id, followee.id)
 
 
-def test_unfollow(client: TestClient, session_fixture: Session):
-    follower = session_fixture.query(User).where(User.username == 'leolas1').with_entities(User.id).first()
-    followee = session_fixture.query(User).where(User.username == 'leolas2').with_entities(User.id).first()
+async def test_unfollow(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
 
     # First follow
-    follow_user(client, follower.id, followee.id)
+    await follow_user(client, follower.id, followee.id)
 
     # Then unfollow
     body = {'followee_id': str(followee.id)}
-    response = client.post(
+    response = await client.post(
         f'/users/{follower.id}/unfollow',
         json=body
     )
     assert response.status_code == status.HTTP_200_OK
 
 
-def test_fetch_timeline(client: TestClient, session_fixture: Session):
-    follower = session_fixture.query(User).where(User.username == 'leolas1').with_entities(User.id).first()
-    followee = session_fixture.query(User).where(User.username == 'leolas2').with_entities(User.id).first()
+async def test_fetch_timeline(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
 
     # First follow
-    follow_user(client, follower.id, followee.id)
+    await follow_user(client, follower.id, followee.id)
 
     # Now test the actual timeline feature
-    response = client.get(f'users/{follower.id}/timeline')
+    response = await client.get(f'users/{follower.id}/timeline')
 
     assert response.status_code == status.HTTP_200_OK
     response_json = response.json()
@@ -85,3 +114,401 @@ def test_fetch_timeline(client: TestClient, session_fixture: Session):
 
     timeline = response_json['timeline']
     assert len(timeline) > 0
+
+
+async def test_fetch_timeline_paginates_with_cursor(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+
+    await follow_user(client, follower.id, followee.id)
+
+    # leolas2 has 2 peeps, so a page of 1 must point to a second page
+    response = await client.get(f'users/{follower.id}/timeline', params={'limit': 1})
+    assert response.status_code == status.HTTP_200_OK
+    first_page = response.json()
+    assert len(first_page['timeline']) == 1
+    assert first_page['next_cursor'] is not None
+
+    response = await client.get(f'users/{follower.id}/timeline',
+                                params={'limit': 1, 'cursor': first_page['next_cursor']})
+    assert response.status_code == status.HTTP_200_OK
+    second_page = response.json()
+    assert len(second_page['timeline']) == 1
+    assert second_page['timeline'] != first_page['timeline']
+    # That was the last page
+    assert second_page['next_cursor'] is None
+
+
+async def test_fetch_timeline_rejects_invalid_cursor(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+
+    response = await client.get(f'users/{follower.id}/timeline', params={'cursor': 'not-a-cursor'})
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+async def test_fetch_timeline_rejects_revoked_tokens(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+    # The real check, instead of the one of the client fixture that lets every request in
+    app.dependency_overrides.pop(check_logged_in)
+    headers = await auth_headers(client, 'leolas1', 'password1')
+    assert (await client.get(f'users/{user_id}/timeline', headers=headers)).status_code == status.HTTP_200_OK
+
+    # Renaming the user keeps the token valid
+    response = await client.patch(f'users/{user_id}', json={'name': 'new name'}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert (await client.get(f'users/{user_id}/timeline', headers=headers)).status_code == status.HTTP_200_OK
+
+    # Changing the email revokes it
+    response = await client.patch(f'users/{user_id}', json={'email': 'new@email.com'}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await client.get(f'users/{user_id}/timeline', headers=headers)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+async def test_timeline_includes_peeps_created_after_following(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas3'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas4'))).first()
+
+    await follow_user(client, follower.id, followee.id)
+    response = await client.post('/peeps/', json={'content': 'fresh peep', 'user_id': str(followee.id)})
+    assert response.status_code == status.HTTP_201_CREATED
+
+    response = await client.get(f'users/{follower.id}/timeline')
+
+    assert [peep['content'] for peep in response.json()['timeline']] == ['fresh peep']
+
+
+async def test_unfollow_removes_peeps_from_timeline(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+
+    await follow_user(client, follower.id, followee.id)
+    response = await client.post(f'/users/{follower.id}/unfollow', json={'followee_id': str(followee.id)})
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await client.get(f'users/{follower.id}/timeline')
+
+    assert response.json()['timeline'] == []
+
+
+async def test_timeline_merges_peeps_of_authors_fanned_out_on_read(client: AsyncClient, session_fixture: AsyncSession,
+                                                                   monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(timeline, 'FANOUT_FOLLOWER_THRESHOLD', 1)
+    celebrity = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+    follower1 = (await session_fixture.execute(select(User.id).where(User.username == 'leolas3'))).first()
+    follower2 = (await session_fixture.execute(select(User.id).where(User.username == 'leolas4'))).first()
+
+    await follow_user(client, follower1.id, celebrity.id)
+    # The second follower goes over the threshold, so leolas2 is no longer fanned out on write
+    await follow_user(client, follower2.id, celebrity.id)
+    assert await session_fixture.scalar(select(User.fanout_on_read).where(User.id == celebrity.id))
+
+    response = await client.post('/peeps/', json={'content': 'celebrity peep', 'user_id': str(celebrity.id)})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert await session_fixture.scalar(
+        select(func.count()).select_from(TimelineEntry).where(TimelineEntry.author_id == celebrity.id)
+    ) == 2
+
+    for follower in (follower1, follower2):
+        response = await client.get(f'users/{follower.id}/timeline')
+        contents = [peep['content'] for peep in response.json()['timeline']]
+        # follower1 got the older peeps materialized before the switch, and they must not show up twice
+        assert len(contents) == len(set(contents)) == 3
+        assert 'celebrity peep' in contents
+
+
+async def test_follow_twice_is_a_no_op(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+
+    await follow_user(client, follower.id, followee.id)
+    await follow_user(client, follower.id, followee.id)
+
+    assert await session_fixture.scalar(
+        select(func.count()).select_from(Follows).where(Follows.follower_id == follower.id)
+    ) == 1
+
+
+async def test_follow_unknown_user(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+
+    response = await client.post(f'/users/{follower.id}/follow', json={'followee_id': str(uuid4())})
+
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_follow_many(client: AsyncClient, session_fixture: AsyncSession):
+    users = {row.username: row.id for row in (await session_fixture.execute(select(User.username, User.id))).all()}
+    follower = users['leolas1']
+    await follow_user(client, follower, users['leolas2'])
+
+    unknown_id = uuid4()
+    body = {'followee_ids': [str(users['leolas2']), str(users['leolas3']), str(users['leolas4']), str(unknown_id)]}
+    response = await client.post(f'/users/{follower}/follow/bulk', json=body)
+
+    assert response.status_code == status.HTTP_200_OK
+    response_json = response.json()
+    # leolas2 was already followed
+    assert set(response_json['followed']) == {str(users['leolas3']), str(users['leolas4'])}
+    assert response_json['not_found'] == [str(unknown_id)]
+    assert await session_fixture.scalar(
+        select(func.count()).select_from(Follows).where(Follows.follower_id == follower)
+    ) == 3
+
+    response = await client.get(f'users/{follower}/timeline')
+    assert len(response.json()['timeline']) == 2
+
+
+async def test_unfollow_many(client: AsyncClient, session_fixture: AsyncSession):
+    users = {row.username: row.id for row in (await session_fixture.execute(select(User.username, User.id))).all()}
+    follower = users['leolas1']
+    body = {'followee_ids': [str(users['leolas2']), str(users['leolas3'])]}
+    response = await client.post(f'/users/{follower}/follow/bulk', json=body)
+    assert response.status_code == status.HTTP_200_OK
+
+    body = {'followee_ids': [str(users['leolas2']), str(users['leolas4'])]}
+    response = await client.post(f'/users/{follower}/unfollow/bulk', json=body)
+
+    assert response.status_code == status.HTTP_200_OK
+    # leolas4 was not followed
+    assert response.json()['unfollowed'] == [str(users['leolas2'])]
+    followees = (await session_fixture.scalars(select(Follows.followee_id).where(Follows.follower_id == follower))).all()
+    assert followees == [users['leolas3']]
+
+    response = await client.get(f'users/{follower}/timeline')
+    assert response.json()['timeline'] == []
+
+
+async def test_import_follows(client: AsyncClient, session_fixture: AsyncSession):
+    users = {row.username: row.id for row in (await session_fixture.execute(select(User.username, User.id))).all()}
+    await follow_user(client, users['leolas3'], users['leolas1'])
+
+    lines = [
+        'follower_id,followee_id',
+        f"{users['leolas3']},{users['leolas1']}",
+        f"{users['leolas3']},{users['leolas2']}",
+        f"{users['leolas4']},{users['leolas1']}",
+        f"{users['leolas4']},{uuid4()}",
+        'not,a uuid',
+        '',
+    ]
+    response = await client.post('/users/follows/import', content='\n'.join(lines),
+                                 headers={'Content-Type': 'text/csv'})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'message': 'Follows imported successfully', 'imported': 2, 'skipped': 1, 'invalid': 2}
+
+    response = await client.get(f"users/{users['leolas4']}/timeline")
+    assert len(response.json()['timeline']) == 4
+
+    # The same file with CRLF line endings: the header is still skipped, and the follows are already there
+    response = await client.post('/users/follows/import', content='\r\n'.join(lines),
+                                 headers={'Content-Type': 'text/csv'})
+    assert response.json() == {'message': 'Follows imported successfully', 'imported': 0, 'skipped': 3, 'invalid': 2}
+
+
+async def test_import_follows_reports_the_chunk_that_failed(client: AsyncClient, session_fixture: AsyncSession,
+                                                            monkeypatch: pytest.MonkeyPatch):
+    users = {row.username: row.id for row in (await session_fixture.execute(select(User.username, User.id))).all()}
+    monkeypatch.setattr(users_main, 'IMPORT_CHUNK_SIZE', 1)
+    insert_follows = users_main.insert_follows
+
+    async def insert_follows_until_the_second_chunk(edges, db):
+        if edges[0][0] == users['leolas4']:
+            # e.g: the followee was deleted after being checked
+            raise IntegrityError('INSERT INTO follows', {}, Exception('foreign key violation'))
+        return await insert_follows(edges, db)
+
+    monkeypatch.setattr(users_main, 'insert_follows', insert_follows_until_the_second_chunk)
+    lines = [f"{users['leolas3']},{users['leolas1']}", f"{users['leolas4']},{users['leolas1']}"]
+    response = await client.post('/users/follows/import', content='\n'.join(lines),
+                                 headers={'Content-Type': 'text/csv'})
+
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert 'chunk 2' in response.json()['detail']
+    # The first chunk was committed
+    follows = (await session_fixture.execute(select(Follows.follower_id, Follows.followee_id))).all()
+    assert follows == [(users['leolas3'], users['leolas1'])]
+
+
+async def test_fetch_stats(client: AsyncClient, session_fixture: AsyncSession):
+    users = {row.username: row.id for row in (await session_fixture.execute(select(User.username, User.id))).all()}
+    await follow_user(client, users['leolas1'], users['leolas2'])
+    await follow_user(client, users['leolas3'], users['leolas2'])
+    body = {'followee_ids': [str(users['leolas2']), str(users['leolas4'])]}
+    response = await client.post(f"/users/{users['leolas4']}/follow/bulk", json=body)
+    assert response.status_code == status.HTTP_200_OK
+    response = await client.post(f"/users/{users['leolas1']}/unfollow", json={'followee_id': str(users['leolas2'])})
+    assert response.status_code == status.HTTP_200_OK
+    response = await client.post('/peeps/', json={'content': 'new peep', 'user_id': str(users['leolas2'])})
+    assert response.status_code == status.HTTP_201_CREATED
+    # Deleting leolas3 also removes them from the followers of leolas2
+    response = await client.delete(f"/users/{users['leolas3']}")
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await client.get(f"/users/{users['leolas2']}/stats")
+
+    assert response.status_code == status.HTTP_200_OK
+    # The fixture peeps were not created through the API, so only the new one is counted until the stats are reconciled
+    assert response.json() == {'stats': {'followers_count': 1, 'followees_count': 0, 'peeps_count': 1}}
+
+    response = await client.get(f"/users/{users['leolas4']}/stats")
+    assert response.json() == {'stats': {'followers_count': 1, 'followees_count': 2, 'peeps_count': 0}}
+
+
+async def test_fetch_stats_of_unknown_user(client: AsyncClient, session_fixture: AsyncSession):
+    response = await client.get(f'/users/{uuid4()}/stats')
+
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_export_timeline(client: AsyncClient, session_fixture: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    # Fetch the rows one by one, so the export is sent in several chunks
+    monkeypatch.setattr(users_main, 'EXPORT_BATCH_SIZE', 1)
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+    await follow_user(client, follower.id, followee.id)
+
+    response = await client.get(f'/users/{follower.id}/timeline/export')
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    peeps = [json.loads(line) for line in response.text.splitlines()]
+    assert {peep['content'] for peep in peeps} == {'test peep 5 from leolas2', 'test peep 6 from leolas2'}
+    # Same peeps, in the same order, as the paginated timeline
+    timeline = (await client.get(f'/users/{follower.id}/timeline')).json()['timeline']
+    assert [{'content': peep['content'], 'created_at': peep['created_at']} for peep in peeps] == timeline
+
+
+async def test_export_peeps(client: AsyncClient, session_fixture: AsyncSession):
+    user = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+
+    response = await client.get(f'/users/{user.id}/peeps/export')
+
+    assert response.status_code == status.HTTP_200_OK
+    peeps = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(peep['content'] for peep in peeps) == ['test peep 1', 'test peep 2', 'test peep 3', 'test peep 4']
+
+
+async def test_search_users_by_prefix(client: AsyncClient, session_fixture: AsyncSession):
+    response = await client.get('/users/search', params={'prefix': 'LEOLAS', 'limit': 3})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert [user['username'] for user in response.json()['users']] == ['leolas1', 'leolas2', 'leolas3']
+
+    # The names match too
+    response = await client.get('/users/search', params={'prefix': 'leo4'})
+    assert [user['username'] for user in response.json()['users']] == ['leolas4']
+
+    # Users matching by both only once
+    response = await client.get('/users/search', params={'prefix': 'leo'})
+    assert [user['username'] for user in response.json()['users']] == ['leolas1', 'leolas2', 'leolas3', 'leolas4']
+
+    # The prefix is matched literally, not as a LIKE pattern
+    response = await client.get('/users/search', params={'prefix': '%'})
+    assert response.json()['users'] == []
+
+
+async def test_search_users_forgets_renamed_users(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+    response = await client.get('/users/search', params={'prefix': 'leolas1'})
+    assert len(response.json()['users']) == 1
+    response = await client.get('/users/search', params={'prefix': 'ren'})
+    assert response.json()['users'] == []
+
+    response = await client.patch(f'/users/{user_id}', json={'username': 'renamed'})
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await client.get('/users/search', params={'prefix': 'leolas1'})
+    assert response.json()['users'] == []
+    response = await client.get('/users/search', params={'prefix': 'ren'})
+    assert [user['username'] for user in response.json()['users']] == ['renamed']
+
+
+async def test_timeline_is_served_from_the_cache(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+    await follow_user(client, follower.id, followee.id)
+
+    first = await client.get(f'users/{follower.id}/timeline')
+    hits = timeline_cache.hits
+    second = await client.get(f'users/{follower.id}/timeline')
+
+    assert timeline_cache.hits == hits + 1
+    assert second.json() == first.json()
+    assert '0 queries' in second.headers['server-timing']
+
+
+async def test_timeline_cache_follows_the_writes(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas3'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas4'))).first()
+
+    async def contents() -> list[str]:
+        response = await client.get(f'users/{follower.id}/timeline')
+        return [peep['content'] for peep in response.json()['timeline']]
+
+    assert await contents() == []
+    await follow_user(client, follower.id, followee.id)
+    assert await contents() == []
+
+    response = await client.post('/peeps/', json={'content': 'cached peep', 'user_id': str(followee.id)})
+    assert await contents() == ['cached peep']
+
+    await client.delete(f"/peeps/{response.json()['peep']['id']}")
+    assert await contents() == []
+
+    await client.post('/peeps/', json={'content': 'peep of a deleted user', 'user_id': str(followee.id)})
+    assert await contents() == ['peep of a deleted user']
+    await client.delete(f'/users/{followee.id}')
+    assert await contents() == []
+
+
+async def test_timeline_pages_from_the_redis_cache(client: AsyncClient, session_fixture: AsyncSession,
+                                                  monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(timeline_cache, 'backend', RedisCache(FakeRedis(), ttl=60))
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas1'))).first()
+    await follow_user(client, follower.id, followee.id)
+
+    responses = []
+    cursor = None
+    while True:
+        params = {'limit': 3, **({'cursor': cursor} if cursor else {})}
+        responses.append(await client.get(f'users/{follower.id}/timeline', params=params))
+        cursor = responses[-1].json()['next_cursor']
+        if cursor is None:
+            break
+
+    pages = [response.json()['timeline'] for response in responses]
+    assert [len(page) for page in pages] == [3, 1]
+    # The first page filled the cache, the second one came from it
+    assert '0 queries' in responses[1].headers['server-timing']
+    assert pages[0] + pages[1] == (await client.get(f'users/{follower.id}/timeline')).json()['timeline']
+
+
+async def test_timeline_answers_not_modified_until_it_changes(client: AsyncClient, session_fixture: AsyncSession):
+    follower = (await session_fixture.execute(select(User.id).where(User.username == 'leolas3'))).first()
+    followee = (await session_fixture.execute(select(User.id).where(User.username == 'leolas2'))).first()
+    await follow_user(client, follower.id, followee.id)
+
+    response = await client.get(f'users/{follower.id}/timeline')
+    etag = response.headers['etag']
+
+    # From the cache, without any query
+    response = await client.get(f'users/{follower.id}/timeline', headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert '0 queries' in response.headers['server-timing']
+
+    # Without the cache, a single query over the keys of the page
+    await timeline_cache.backend.clear()
+    response = await client.get(f'users/{follower.id}/timeline', headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert '1 queries' in response.headers['server-timing']
+
+    await client.post('/peeps/', json={'content': 'new peep', 'user_id': str(followee.id)})
+    response = await client.get(f'users/{follower.id}/timeline', headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['etag'] != etag
+    assert 'new peep' in [peep['content'] for peep in response.json()['timeline']]
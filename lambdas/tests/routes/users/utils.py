@@ -1,10 +1,10 @@
 from fastapi import status
-from fastapi.testclient import TestClient
+from httpx import AsyncClient
 
 
-def follow_user(client: TestClient, follower_id: str, followee_id: str):
+async def follow_user(client: AsyncClient, follower_id: str, followee_id: str):
     body = {'followee_id': str(followee_id)}
-    response = client.post(
+    response = await client.post(
         f'/users/{follower_id}/follow',
         json=body
     )
@@ -1,63 +1,132 @@
-from typing import Generator
+import fnmatch
+import functools
+from typing import AsyncGenerator
 
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
 from sqlalchemy.sql.expression import Insert
-from starlette.testclient import TestClient
 
-from lambdas.db import Base, Peep, User, get_db_session, get_db_url
+from lambdas.db import ASYNC_DB_DRIVER, Peep, User, get_db_session, get_db_url, get_read_db_session
 from lambdas.main import app
-from lambdas.routes.authentication.utils import check_logged_in, make_password
+from lambdas.routes.authentication.utils import check_logged_in, make_password, token_cache, token_version_cache
+from lambdas.db.replica import recent_writes
+from lambdas.instrumentation import watch_queries
+from lambdas.routes.users.utils import timeline_cache, user_search_cache
 
 
-@pytest.fixture(name="session_fixture")
-def session_fixture() -> Generator:
-    db_url = get_db_url()
-    engine = create_engine(db_url, echo=True)
-    connection = engine.connect()
-    transaction = connection.begin()
+# The async fixtures and tests run on the anyio pytest plugin (installed with FastAPI), using asyncio as event loop
+@pytest.fixture(name='anyio_backend')
+def anyio_backend() -> str:
+    return 'asyncio'
+
+
+# One engine for the whole session, so its dialect is initialized only once. With NullPool each test still opens its own
+# connection, because asyncpg connections can't be shared between the event loops of the tests.
+@functools.cache
+def get_test_engine() -> AsyncEngine:
+    engine = create_async_engine(get_db_url(ASYNC_DB_DRIVER), poolclass=NullPool)
+    # Instrumented like the engines of the app
+    watch_queries(engine.sync_engine)
+    return engine
+
 
-    Base.metadata.create_all(bind=connection)
+# The same few passwords are hashed for every test, so they are hashed once
+@functools.cache
+def hashed_password(password: str) -> str:
+    return make_password(password)
 
-    TestingSessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=connection))
-    session = TestingSessionLocal()
 
-    test_users = [
-        {"name": "leo1", "email": "leo1@email.com", "username": "leolas1", "password": make_password("password1")},
-        {"name": "leo2", "email": "leo2@email.com", "username": "leolas2", "password": make_password("password2")},
-        {"name": "leo3", "email": "leo3@email.com", "username": "leolas3", "password": make_password("password3")},
-        {"name": "leo4", "email": "leo4@email.com", "username": "leolas4", "password": make_password("password4")},
-    ]
+@pytest.fixture(name="session_fixture")
+async def session_fixture() -> AsyncGenerator:
+    # The schema is already there: the test database is cloned from a migrated template, see lambdas/tests/conftest.py
+    async with get_test_engine().connect() as connection:
+        transaction = await connection.begin()
+
+        # With create_savepoint, the commits done by the routes only release a savepoint, so everything is still rolled
+        # back at the end of the test
+        session = AsyncSession(bind=connection, autoflush=False, expire_on_commit=False,
+                               join_transaction_mode='create_savepoint')
 
-    session.begin_nested()
-    user1 = session.scalars(Insert(User).returning(User), test_users).first()
-    user2 = session.query(User).filter(User.username == 'leolas2').first()
+        test_users = [
+            {"name": "leo1", "email": "leo1@email.com", "username": "leolas1",
+             "password": hashed_password("password1")},
+            {"name": "leo2", "email": "leo2@email.com", "username": "leolas2",
+             "password": hashed_password("password2")},
+            {"name": "leo3", "email": "leo3@email.com", "username": "leolas3",
+             "password": hashed_password("password3")},
+            {"name": "leo4", "email": "leo4@email.com", "username": "leolas4",
+             "password": hashed_password("password4")},
+        ]
 
-    test_peeps = [
-        Peep(content='test peep 1', user_id=user1.id),
-        Peep(content='test peep 2', user_id=user1.id),
-        Peep(content='test peep 3', user_id=user1.id),
-        Peep(content='test peep 4', user_id=user1.id),
-        Peep(content='test peep 5 from leolas2', user_id=user2.id),
-        Peep(content='test peep 6 from leolas2', user_id=user2.id),
-    ]
-    session.bulk_save_objects(test_peeps)
+        user1 = (await session.scalars(Insert(User).returning(User), test_users)).first()
+        user2 = (await session.scalars(select(User).where(User.username == 'leolas2'))).first()
 
-    with session:
-        yield session
+        test_peeps = [
+            Peep(content='test peep 1', user_id=user1.id),
+            Peep(content='test peep 2', user_id=user1.id),
+            Peep(content='test peep 3', user_id=user1.id),
+            Peep(content='test peep 4', user_id=user1.id),
+            Peep(content='test peep 5 from leolas2', user_id=user2.id),
+            Peep(content='test peep 6 from leolas2', user_id=user2.id),
+        ]
+        session.add_all(test_peeps)
+        await session.flush()
 
-    session.close()
-    transaction.rollback()
+        async with session:
+            yield session
+
+        await transaction.rollback()
 
 
 @pytest.fixture(name='client')
-def client(session_fixture: Session) -> Generator:
-    def override_get_db_session():
+async def client(session_fixture: AsyncSession) -> AsyncGenerator:
+    async def override_get_db_session():
         yield session_fixture
 
     app.dependency_overrides[get_db_session] = override_get_db_session
+    # A single database in the tests, the replica is the primary
+    app.dependency_overrides[get_read_db_session] = override_get_db_session
     app.dependency_overrides[check_logged_in] = lambda: True
-    with TestClient(app) as test_client:
+    # follow_redirects like the TestClient, e.g: POST /peeps/ is redirected to POST /peeps
+    async with AsyncClient(transport=ASGITransport(app=app), base_url='http://testserver',
+                           follow_redirects=True) as test_client:
         yield test_client
     app.dependency_overrides.clear()
+    # The users are rolled back after every test, so what the caches learnt about them is not valid anymore
+    token_cache.clear()
+    token_version_cache.clear()
+    user_search_cache.clear()
+    recent_writes.clear()
+    await timeline_cache.backend.clear()
+
+
+async def auth_headers(client: AsyncClient, username: str, password: str) -> dict:
+    response = await client.post('/users/auth/login', data={'username': username, 'password': password})
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+class FakeRedis:
+    """
+    Stand-in for a redis.asyncio client, with only the commands used by lambdas.cache.RedisCache. The expirations are
+    ignored: the tests never wait for them.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key: str) -> bytes | None:
+        return self.values.get(key)
+
+    async def set(self, key: str, value: str, px: int | None = None):
+        self.values[key] = value.encode()
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    async def scan_iter(self, match: str):
+        for key in list(self.values):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
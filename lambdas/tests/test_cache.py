@@ -0,0 +1,65 @@
+import pytest
+
+from lambdas.cache import LocalCache, RedisCache, TTLCache, cache_from_url
+from lambdas.tests.routes.utils import FakeRedis, anyio_backend
+
+
+def test_should_evict_least_recently_used_entry():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Reading 'a' makes 'b' the least recently used
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_should_expire_entries():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1, ttl=0)
+
+    assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def test_should_delete_matching_entries():
+    cache = TTLCache(maxsize=10, ttl=60)
+    for number in range(5):
+        cache.set(number, number)
+
+    cache.delete_where(lambda key, value: value % 2 == 0)
+
+    assert [cache.get(number) for number in range(5)] == [None, 1, None, 3, None]
+
+
+@pytest.mark.anyio
+async def test_should_share_json_values_through_redis():
+    client = FakeRedis()
+    cache, other_process_cache = RedisCache(client, ttl=60), RedisCache(client, ttl=60)
+
+    await cache.set('a', {'rows': [['id', 'content']], 'complete': True})
+
+    assert await other_process_cache.get('a') == {'rows': [['id', 'content']], 'complete': True}
+    await other_process_cache.delete(['a', 'b'])
+    assert await cache.get('a') is None
+
+
+class BrokenRedis(FakeRedis):
+    async def get(self, key: str) -> bytes | None:
+        raise ConnectionError('Redis is down')
+
+
+@pytest.mark.anyio
+async def test_should_miss_when_redis_is_down():
+    assert await RedisCache(BrokenRedis(), ttl=60).get('a') is None
+
+
+def test_should_pick_the_backend_from_the_url():
+    assert isinstance(cache_from_url(None, maxsize=10, ttl=60), LocalCache)
+    assert isinstance(cache_from_url('memory://', maxsize=10, ttl=60), LocalCache)
+    with pytest.raises(ValueError):
+        cache_from_url('memcached://localhost', maxsize=10, ttl=60)
@@ -0,0 +1,91 @@
+import logging
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.pool import NullPool
+
+from lambdas import instrumentation
+from lambdas.db import User, get_db_url
+from lambdas.instrumentation import RequestMetrics, current_request_metrics, record_query, watch_queries
+from lambdas.tests.routes.utils import anyio_backend, client, session_fixture
+
+pytestmark = pytest.mark.anyio
+
+
+def parse_server_timing(header: str) -> dict[str, str]:
+    # e.g: 'app;dur=12.3, db;dur=4.5;desc="3 queries, 7 rows"' -> {'app': 'dur=12.3', 'db': 'dur=4.5;desc=...'}
+    return dict(metric.strip().split(';', 1) for metric in header.split(', ') if ';' in metric)
+
+
+async def test_should_send_the_database_time_in_server_timing(client: AsyncClient, session_fixture: AsyncSession):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+
+    response = await client.get(f'/users/{user_id}/timeline')
+
+    timing = parse_server_timing(response.headers['server-timing'])
+    assert timing['app'].startswith('dur=')
+    assert timing['db'].startswith('dur=')
+    assert 'queries' in timing['db']
+    assert 'bcrypt' not in timing
+
+
+async def test_should_measure_bcrypt_on_login(client: AsyncClient, session_fixture: AsyncSession):
+    response = await client.post('/users/auth/login', data={'username': 'leolas1', 'password': 'password1'})
+
+    assert 'bcrypt' in parse_server_timing(response.headers['server-timing'])
+
+
+async def test_should_log_each_request(client: AsyncClient, session_fixture: AsyncSession,
+                                       caplog: pytest.LogCaptureFixture):
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+
+    with caplog.at_level(logging.INFO):
+        await client.get(f'/users/{user_id}/timeline')
+
+    record = next(record for record in caplog.records if getattr(record, 'route', None))
+    assert record.route == '/users/{user_id}/timeline'
+    assert record.method == 'GET'
+    assert record.status == 200
+    assert record.db_queries >= 1
+
+
+async def test_should_warn_over_the_query_budget(client: AsyncClient, session_fixture: AsyncSession,
+                                                 caplog: pytest.LogCaptureFixture, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(instrumentation, 'QUERY_BUDGET', 0)
+    user_id = await session_fixture.scalar(select(User.id).where(User.username == 'leolas1'))
+
+    with caplog.at_level(logging.WARNING):
+        await client.get(f'/users/{user_id}/timeline')
+
+    assert any('over the budget' in record.getMessage() for record in caplog.records)
+
+
+def test_queries_outside_a_request_are_not_recorded():
+    assert current_request_metrics.get() is None
+    record_query(0.1, 10)
+
+
+def test_should_count_the_rows_returned_and_the_failed_queries():
+    engine = create_engine(get_db_url(), poolclass=NullPool)
+    watch_queries(engine)
+    metrics = RequestMetrics()
+    token = current_request_metrics.set(metrics)
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT generate_series(1, 3)'))
+            connection.execute(text('CREATE TEMPORARY TABLE numbers AS SELECT generate_series(1, 5) AS number'))
+            # The rows written are not returned
+            connection.execute(text('UPDATE numbers SET number = number + 1'))
+            with pytest.raises(DBAPIError):
+                connection.execute(text('SELECT 1 / 0'))
+            connection.rollback()
+
+            assert 'query_started' not in connection.info
+    finally:
+        current_request_metrics.reset(token)
+        engine.dispose()
+
+    assert (metrics.queries, metrics.rows) == (4, 3)
@@ -0,0 +1,92 @@
+import json
+import time
+from collections import Counter
+
+import pytest
+
+from lambdas import profiling
+from lambdas.main import app
+from lambdas.profiling import SamplingProfiler, profiled, should_profile, to_collapsed, to_speedscope
+from scripts.merge_profiles import app_routes, merge, read_collapsed, read_speedscope, route_of
+
+SAMPLES = Counter({('handler (main.py:1)', 'timeline (main.py:10)'): 3, ('handler (main.py:1)', '(idle)'): 2})
+
+
+def event(path: str = '/peeps', headers: dict | None = None) -> dict:
+    return {'httpMethod': 'GET', 'path': path, 'headers': headers or {}}
+
+
+def busy_handler(event: dict, context) -> dict:
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+    return {'statusCode': 200}
+
+
+def test_should_sample_the_stack_of_the_profiled_thread():
+    with SamplingProfiler(0.001) as profiler:
+        busy_handler(event(), None)
+
+    assert profiler.samples
+    assert any('busy_handler' in frame for frames in profiler.samples for frame in frames)
+
+
+def test_should_read_back_the_collapsed_stacks():
+    assert read_collapsed(to_collapsed('GET /peeps', SAMPLES)) == [('GET /peeps', SAMPLES)]
+
+
+def test_should_read_back_the_speedscope_profiles():
+    document = to_speedscope({'GET /peeps': SAMPLES}, 5, 'milliseconds')
+
+    assert json.loads(document)['profiles'][0]['endValue'] == 25
+    assert read_speedscope(document) == [('GET /peeps', SAMPLES)]
+
+
+def test_should_profile_with_the_token_or_the_sample_rate(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', 'secret')
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 0)
+
+    assert should_profile(event(headers={'X-Peep-Profile': 'secret'}))
+    assert not should_profile(event(headers={'X-Peep-Profile': 'guess'}))
+    assert not should_profile(event())
+
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 1)
+    assert should_profile(event())
+
+
+def test_should_ignore_the_header_without_a_token(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', None)
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 0)
+
+    assert not should_profile(event(headers={'X-Peep-Profile': ''}))
+
+
+@pytest.mark.parametrize('profile_format', ['collapsed', 'speedscope'])
+def test_should_write_the_profiles_of_the_sampled_invocations(monkeypatch: pytest.MonkeyPatch, tmp_path,
+                                                              profile_format: str):
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 1)
+    monkeypatch.setattr(profiling, 'PROFILE_INTERVAL', 0.001)
+    monkeypatch.setattr(profiling, 'PROFILE_SINK', str(tmp_path))
+    monkeypatch.setattr(profiling, 'PROFILE_FORMAT', profile_format)
+    handler = profiled(busy_handler)
+
+    assert handler(event('/users/4f1d5d5e-8f5b-4b8e-9f63-3c3b6b7e0a11/timeline'), None) == {'statusCode': 200}
+    assert handler(event('/users/0b3b1c9e-7c2a-4c55-8a50-1f4e1a6d2b22/timeline'), None) == {'statusCode': 200}
+
+    assert len(list(tmp_path.iterdir())) == 2
+    profiles, requests = merge([tmp_path], app_routes(app))
+    assert requests == {'GET /users/{user_id}/timeline': 2}
+    assert any('busy_handler' in frame for frames in profiles['GET /users/{user_id}/timeline'] for frame in frames)
+
+
+def test_should_not_fail_the_request_when_the_profile_cannot_be_written(monkeypatch: pytest.MonkeyPatch, tmp_path):
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 1)
+    monkeypatch.setattr(profiling, 'PROFILE_SINK', str(tmp_path / 'not-a-directory'))
+    (tmp_path / 'not-a-directory').write_text('')
+
+    assert profiled(busy_handler)(event(), None) == {'statusCode': 200}
+
+
+def test_should_keep_the_path_of_unknown_routes():
+    assert route_of('GET /peeps/search', app_routes(app)) == 'GET /peeps/search'
+    assert route_of('GET /nowhere', app_routes(app)) == 'GET /nowhere'
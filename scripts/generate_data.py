@@ -0,0 +1,240 @@
+"""
+Fills the database with a large synthetic social network, to measure the timelines and the indexes at a realistic size.
+
+    PEEP_ENV=local DB_NAME=peep_load python -m scripts.generate_data --reset [--users 100000] [--peeps 1000000]
+
+The rows are loaded with COPY, in chunks, with the indexes and foreign keys dropped meanwhile, so millions of them
+take seconds and the memory used does not grow with the dataset. Materializing the timelines afterwards (one row per
+follower of the author of every peep) is by far the slowest step: skip it with --skip-timelines when not needed.
+
+Every user gets the same password hash, computed once (or given with --password-hash), instead of paying bcrypt per
+user. The followers follow a power law: a few users are followed by a large share of everyone, like on a real social
+network. The peeps are spread over the last --days, more of them recently and at the busy hours of the day.
+
+It DELETES EVERYTHING in the database with --reset, so never point it at anything but a disposable database.
+"""
+import argparse
+import io
+import itertools
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator
+
+from sqlalchemy import Connection, Engine, func, select, text
+
+from lambdas.db import User
+from lambdas.db.main import get_engine
+from lambdas.db.migrations import migrate
+from lambdas.db.stats import reconcile_stats
+from lambdas.db.timeline import FANOUT_FOLLOWER_THRESHOLD
+from lambdas.routes.authentication.utils import make_password
+
+DEFAULT_PASSWORD = 'synthetic-password'
+# Rows sent per COPY
+COPY_CHUNK_SIZE = 100_000
+BULK_LOADED_TABLES = ['users', 'follows', 'peeps', 'timeline_entries', 'user_stats']
+
+# Relative activity of each hour of the day (UTC): quiet at night, busiest in the evening
+HOURLY_ACTIVITY = [2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 6, 6, 7, 6, 6, 6, 7, 8, 9, 10, 10, 9, 6, 4]
+CUMULATIVE_HOURLY_ACTIVITY = list(itertools.accumulate(HOURLY_ACTIVITY))
+WORDS = ('the a coffee morning cat dog music weekend train late work code python postgres timeline peep friends '
+         'movie game rain sun city walk book dinner lunch today tomorrow news great terrible love hate new old '
+         'finally again really happy tired build deploy bug fix release team launch').split()
+
+# Makes the database derive the same timelines and counters the API maintains on every write
+TIMELINE_BACKFILL = [
+    '''
+    UPDATE users SET fanout_on_read = true
+    WHERE id IN (SELECT followee_id FROM follows GROUP BY followee_id HAVING count(*) > :threshold)
+    ''',
+    '''
+    INSERT INTO timeline_entries (user_id, peep_id, author_id, created_at)
+    SELECT follows.follower_id, peeps.id, peeps.user_id, peeps.created_at
+    FROM follows
+    JOIN peeps ON peeps.user_id = follows.followee_id
+    JOIN users ON users.id = peeps.user_id
+    WHERE NOT users.fanout_on_read
+    ON CONFLICT DO NOTHING
+    ''',
+]
+
+
+class SyntheticNetwork:
+    """
+    The users are numbered, and everything about a user (id, username, popularity) is derived from its number, so
+    nothing has to be kept in memory per user but its popularity. The ids share a random prefix per run.
+    """
+
+    def __init__(self, rng: random.Random, users: int, follows_per_user: int, popularity_exponent: float,
+                 peeps: int, days: int):
+        self.rng = rng
+        self.users = users
+        self.follows_per_user = follows_per_user
+        self.peeps = peeps
+        self.days = days
+        # Zipf: the user number n has a popularity of 1 / n^exponent. Cumulative, so each draw is a binary search
+        self.cumulative_popularity = list(itertools.accumulate(1 / (rank + 1) ** popularity_exponent
+                                                               for rank in range(users)))
+        self.user_id_prefix = self.random_id_prefix()
+        self.peep_id_prefix = self.random_id_prefix()
+        # created_at is stored in UTC, without a time zone
+        self.now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def random_id_prefix(self) -> str:
+        # The first 20 hex digits of a UUID, as a version 4 one; the last 12 are the row number
+        digits = f'{self.rng.getrandbits(80):020x}'
+        return f'{digits[:8]}-{digits[8:12]}-4{digits[13:16]}-8{digits[17:20]}-'
+
+    def user_id(self, index: int) -> str:
+        return f'{self.user_id_prefix}{index:012x}'
+
+    def random_timestamp(self) -> datetime:
+        # sqrt skews the days towards now, like the activity of a growing network
+        days_ago = int(self.days * (1 - self.rng.random() ** 0.5))
+        hour = self.rng.choices(range(24), cum_weights=CUMULATIVE_HOURLY_ACTIVITY)[0]
+        day = (self.now - timedelta(days=days_ago)).replace(hour=hour, minute=0, second=0, microsecond=0)
+        timestamp = day + timedelta(seconds=self.rng.uniform(0, 3600))
+        return min(timestamp, self.now)
+
+    def username(self, index: int) -> str:
+        return f'user{index}'
+
+    def user_rows(self, password_hash: str) -> Iterator[str]:
+        # Everyone signed up before the first peep
+        created_at = self.now - timedelta(days=self.days + 1)
+        for index in range(self.users):
+            yield (f'{self.user_id(index)}\tSynthetic User {index}\tuser{index}@example.com\t{self.username(index)}\t'
+                   f'{password_hash}\t{created_at}\t{created_at}\n')
+
+    def follow_rows(self) -> Iterator[str]:
+        user_numbers = range(self.users)
+        for follower in user_numbers:
+            # Geometric number of followees, most users follow a few and some follow many
+            count = min(int(self.rng.expovariate(1 / self.follows_per_user)), self.users - 1)
+            followees = set(self.rng.choices(user_numbers, cum_weights=self.cumulative_popularity, k=count))
+            followees.discard(follower)
+            follower_id = self.user_id(follower)
+            for followee in followees:
+                yield f'{follower_id}\t{self.user_id(followee)}\n'
+
+    def peep_rows(self) -> Iterator[str]:
+        # Only the followers follow a power law, not the peeps: the timeline entries grow with followers * peeps, and
+        # the celebrities posting more as well would make the dataset explode
+        for index in range(self.peeps):
+            author = self.rng.randrange(self.users)
+            content = ' '.join(self.rng.choices(WORDS, k=self.rng.randint(3, 25)))
+            created_at = self.random_timestamp()
+            yield f'{self.peep_id_prefix}{index:012x}\t{self.user_id(author)}\t{content}\t{created_at}\t{created_at}\n'
+
+
+def copy_rows(connection: Connection, table: str, columns: list[str], rows: Iterable[str]) -> int:
+    """
+    COPY the tab-separated `rows` into `table`, COPY_CHUNK_SIZE rows at a time. Returns the number of rows.
+    """
+    cursor = connection.connection.cursor()
+    statement = f'COPY {table} ({", ".join(columns)}) FROM STDIN'
+    copied = 0
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, COPY_CHUNK_SIZE)):
+        cursor.copy_expert(statement, io.StringIO(''.join(chunk)))
+        copied += len(chunk)
+    return copied
+
+
+@contextmanager
+def indexes_and_foreign_keys_dropped(connection: Connection, tables: list[str]):
+    """
+    Drop the secondary indexes and the foreign keys of `tables` meanwhile, and create them again on exit. Building an
+    index once is much cheaper than updating it on every row, and checking a foreign key is then a single join instead
+    of a trigger per row (see "Populating a Database" in the PostgreSQL docs). The definitions come from the catalog,
+    so they are restored exactly as the migrations left them.
+    """
+    # The unique indexes back constraints (and the primary keys are needed by the ON CONFLICT of the backfill)
+    indexes = connection.execute(text('''
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index
+        WHERE indrelid = ANY(CAST(:tables AS regclass[])) AND NOT indisunique
+    '''), {'tables': tables}).all()
+    foreign_keys = connection.execute(text('''
+        SELECT conrelid::regclass::text, quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE contype = 'f' AND conrelid = ANY(CAST(:tables AS regclass[]))
+    '''), {'tables': tables}).all()
+
+    for table, name, _ in foreign_keys:
+        connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT {name}'))
+    for name, _ in indexes:
+        connection.execute(text(f'DROP INDEX {name}'))
+
+    yield
+
+    connection.execute(text("SET LOCAL maintenance_work_mem = '512MB'"))
+    for _, definition in indexes:
+        connection.execute(text(definition))
+    for table, name, definition in foreign_keys:
+        connection.execute(text(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}'))
+
+
+def generate(engine: Engine, network: SyntheticNetwork, password_hash: str, reset: bool, timelines: bool = True):
+    migrate(engine)
+    started = time.perf_counter()
+
+    def step(message: str):
+        print(f'{time.perf_counter() - started:>8.1f} s  {message}')
+
+    with engine.begin() as connection:
+        if connection.scalar(select(func.count()).select_from(User)):
+            if not reset:
+                raise SystemExit('The database is not empty, pass --reset to delete everything first')
+            connection.execute(text('TRUNCATE users, peeps, follows, timeline_entries, user_stats'))
+
+        with indexes_and_foreign_keys_dropped(connection, BULK_LOADED_TABLES):
+            users = copy_rows(connection, 'users', ['id', 'name', 'email', 'username', 'password', 'created_at',
+                                                    'updated_at'], network.user_rows(password_hash))
+            step(f'{users} users')
+            follows = copy_rows(connection, 'follows', ['follower_id', 'followee_id'], network.follow_rows())
+            step(f'{follows} follows')
+            peeps = copy_rows(connection, 'peeps', ['id', 'user_id', 'content', 'created_at', 'updated_at'],
+                              network.peep_rows())
+            step(f'{peeps} peeps')
+
+            # The planner still sees the tables as empty: without statistics, the backfill below picks nested loops
+            # that take minutes instead of seconds
+            connection.execute(text('ANALYZE users, follows, peeps'))
+            if timelines:
+                for statement in TIMELINE_BACKFILL:
+                    connection.execute(text(statement), {'threshold': FANOUT_FOLLOWER_THRESHOLD})
+                step('timelines')
+        step('indexes and foreign keys')
+        # It counts the rows of each user through the indexes: without them, it would scan the tables once per user
+        reconcile_stats(connection)
+        step('users stats')
+
+        connection.execute(text(f'ANALYZE {", ".join(BULK_LOADED_TABLES)}'))
+        step('analyze')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--follows-per-user', type=int, default=20, help='Mean of the followees of each user')
+    parser.add_argument('--popularity-exponent', type=float, default=1.0,
+                        help='Exponent of the power law of the followers: higher, fewer users get most follows')
+    parser.add_argument('--peeps', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=90, help='The peeps are spread over this many days until now')
+    parser.add_argument('--password', default=DEFAULT_PASSWORD, help='Password of every user')
+    parser.add_argument('--password-hash', help='Hash of the password of every user, instead of hashing --password')
+    parser.add_argument('--skip-timelines', action='store_true',
+                        help='Do not fill timeline_entries, by far the slowest step, e.g: to only test the searches')
+    parser.add_argument('--reset', action='store_true', help='Delete all the data of the database first')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    network = SyntheticNetwork(random.Random(args.seed), args.users, args.follows_per_user, args.popularity_exponent,
+                               args.peeps, args.days)
+    generate(get_engine(), network, args.password_hash or make_password(args.password), args.reset,
+             timelines=not args.skip_timelines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Load test of the API: seeds the database with a synthetic social graph (see scripts/generate_data.py), then drives a
+mix of signup, login, create-peep, follow and timeline requests against it, and reports the latency percentiles and
+throughput of each route.
+
+    PEEP_ENV=local python -m scripts.load_test --reset [--users 1000] [--peeps 20000] [--requests 5000]
+
+By default the requests go to the app in this same process, through httpx's ASGI transport: no server is needed, so the
+numbers can be compared between a laptop and CI (on the same machine, with the same arguments). With --base-url they
+go to a running server instead, e.g: `uvicorn lambdas.main:app --workers 4`.
+
+Seeding needs an empty database, or --reset to empty it first: it DELETES EVERY USER, so never point it at anything but
+a disposable database. Everything random (the graph and the traffic) comes from --seed, so two runs with the same
+arguments send the same requests. Only the usernames of the signups also have an id of the run, so they never collide
+with the ones of a previous run (e.g: with --skip-seed).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from uuid import UUID, uuid4
+
+import httpx
+from sqlalchemy import func, select
+
+from lambdas.db import User
+from lambdas.db.main import get_engine
+from lambdas.routes.authentication.utils import make_password
+from scripts.generate_data import SyntheticNetwork, generate
+
+# Every seeded user has this password. It's hashed once, with the current BCRYPT_ROUNDS, and shared by all of them
+SEED_PASSWORD = 'load-test-password'
+# The seeded peeps are spread over this many days until now
+SEED_DAYS = 30
+# Users logged in before the traffic starts, whose tokens are used by the authenticated requests
+LOGGED_IN_USERS = 50
+
+# Share of the requests of each scenario, by default. The timeline is by far the most common request of a social app
+DEFAULT_MIX = {'timeline': 60, 'create-peep': 15, 'follow': 10, 'login': 10, 'signup': 5}
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    # e.g: "timeline=80,create-peep=20"
+    mix = {}
+    for item in value.split(','):
+        scenario, _, weight = item.partition('=')
+        if scenario.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Unknown scenario {scenario!r}, must be one of {", ".join(SCENARIOS)}')
+        mix[scenario.strip()] = int(weight)
+    return mix
+
+
+def seed(rng: random.Random, users: int, follows_per_user: int, popularity_exponent: float, peeps: int,
+         reset: bool) -> dict[UUID, str]:
+    """
+    Fill the database with scripts.generate_data, and return the username of each user.
+    """
+    network = SyntheticNetwork(rng, users, follows_per_user, popularity_exponent, peeps, SEED_DAYS)
+    generate(get_engine(), network, make_password(SEED_PASSWORD), reset)
+    return {UUID(network.user_id(index)): network.username(index) for index in range(users)}
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, usernames: dict[UUID, str]):
+        self.client = client
+        self.usernames = usernames
+        self.user_ids = list(usernames)
+        # user_id -> Authorization header
+        self.tokens = {}
+        # route -> latencies (in seconds) and errors
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # The only part of the requests that is not from --seed, see signup
+        self.run_id = uuid4().hex[:8]
+
+    async def log_in(self, user_ids: list[UUID]):
+        for user_id in user_ids:
+            response = await self.login(user_id)
+            response.raise_for_status()
+            self.tokens[user_id] = {'Authorization': f'Bearer {response.json()["access_token"]}'}
+
+    def login(self, user_id: UUID):
+        return self.client.post('/users/auth/login', data={'username': self.usernames[user_id],
+                                                           'password': SEED_PASSWORD})
+
+    def random_logged_in_user(self, rng: random.Random) -> tuple[UUID, dict]:
+        user_id = rng.choice(list(self.tokens))
+        return user_id, self.tokens[user_id]
+
+    # Each scenario returns the route (as declared, so all the user ids are grouped together) and the request to send
+    def signup(self, rng: random.Random):
+        username = f'signup-{self.run_id}-{rng.getrandbits(64):016x}'
+        return 'POST /users/auth/signup', self.client.post('/users/auth/signup', json={
+            'name': username, 'email': f'{username}@example.com', 'username': username, 'password': SEED_PASSWORD})
+
+    def random_login(self, rng: random.Random):
+        return 'POST /users/auth/login', self.login(rng.choice(self.user_ids))
+
+    def create_peep(self, rng: random.Random):
+        user_id, headers = self.random_logged_in_user(rng)
+        return 'POST /peeps', self.client.post('/peeps', headers=headers, json={
+            'content': f'Load test peep {rng.getrandbits(64):016x}', 'user_id': str(user_id)})
+
+    def follow(self, rng: random.Random):
+        user_id, headers = self.random_logged_in_user(rng)
+        followee_id = rng.choice(self.user_ids)
+        return 'POST /users/{user_id}/follow', self.client.post(f'/users/{user_id}/follow', headers=headers,
+                                                                json={'followee_id': str(followee_id)})
+
+    def timeline(self, rng: random.Random):
+        user_id, headers = self.random_logged_in_user(rng)
+        return 'GET /users/{user_id}/timeline', self.client.get(f'/users/{user_id}/timeline', headers=headers)
+
+    async def send(self, scenario: str, rng: random.Random, record: bool):
+        route, request = getattr(self, SCENARIOS[scenario])(rng)
+        started = time.perf_counter()
+        try:
+            response = await request
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            failed = True
+        elapsed = time.perf_counter() - started
+
+        if record:
+            self.latencies[route].append(elapsed)
+            self.errors[route] += failed
+
+    async def run(self, scenarios: list[tuple[str, random.Random]], concurrency: int, warmup: int) -> float:
+        queue = iter(enumerate(scenarios))
+
+        async def worker():
+            for index, (scenario, rng) in queue:
+                await self.send(scenario, rng, record=index >= warmup)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+
+# Scenario -> method of LoadTest that builds its request
+SCENARIOS = {'signup': 'signup', 'login': 'random_login', 'create-peep': 'create_peep', 'follow': 'follow',
+             'timeline': 'timeline'}
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    # Nearest rank: the smallest value with at least `percent`% of the values at or below it
+    rank = max(int(-(-len(sorted_values) * percent // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+def report(load_test: LoadTest, elapsed: float) -> dict:
+    results = {}
+    for route, latencies in sorted(load_test.latencies.items()):
+        latencies = sorted(latencies)
+        results[route] = {
+            'requests': len(latencies),
+            'errors': load_test.errors[route],
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'rps': round(len(latencies) / elapsed, 1),
+        }
+    total = sum(result['requests'] for result in results.values())
+
+    print(f'\n{"Route":<32} {"requests":>9} {"errors":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"req/s":>8}')
+    for route, result in results.items():
+        print(f'{route:<32} {result["requests"]:>9} {result["errors"]:>7} {result["p50_ms"]:>8.1f} '
+              f'{result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} {result["rps"]:>8.1f}')
+    print(f'\n{total} requests in {elapsed:.1f} s: {total / elapsed:.1f} req/s')
+
+    return {'elapsed_seconds': round(elapsed, 3), 'requests_per_second': round(total / elapsed, 1), 'routes': results}
+
+
+async def drive(args: argparse.Namespace, usernames: dict[UUID, str], rng: random.Random) -> dict:
+    if args.base_url:
+        transport, base_url = None, args.base_url
+    else:
+        # Imported here, so driving a remote server does not need the app's dependencies
+        from lambdas.main import app
+        transport, base_url = httpx.ASGITransport(app=app), 'http://load-test'
+
+    # Every request gets its own generator, seeded upfront: the workers interleave in a different order on every run,
+    # but each request is still the same
+    scenarios = [(scenario, random.Random(rng.getrandbits(64)))
+                 for scenario in rng.choices(list(args.mix), weights=list(args.mix.values()),
+                                             k=args.warmup + args.requests)]
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=60) as client:
+        load_test = LoadTest(client, usernames)
+        user_ids = list(usernames)
+        await load_test.log_in(rng.sample(user_ids, min(LOGGED_IN_USERS, len(user_ids))))
+        elapsed = await load_test.run(scenarios, args.concurrency, args.warmup)
+
+    return report(load_test, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--follows-per-user', type=int, default=50, help='Mean of the followees of each user')
+    parser.add_argument('--popularity-exponent', type=float, default=1.0,
+                        help='Exponent of the Zipf-like popularity of the users: higher, fewer users get most follows')
+    parser.add_argument('--peeps', type=int, default=20000)
+    parser.add_argument('--reset', action='store_true', help='Delete all the data of the database before seeding')
+    parser.add_argument('--skip-seed', action='store_true', help='Reuse the data seeded by a previous run')
+    parser.add_argument('--requests', type=int, default=5000, help='Requests measured')
+    parser.add_argument('--warmup', type=int, default=200, help='Requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=10, help='Requests in flight at once')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Weight of each scenario, e.g: timeline=80,create-peep=20')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--base-url', help='Send the requests to this server instead of the app in this process')
+    parser.add_argument('--output', help='Also write the results to this JSON file, e.g: to compare runs in CI')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.skip_seed:
+        with get_engine().connect() as connection:
+            usernames = dict(connection.execute(select(User.id, User.username).where(User.username.like('user%'))
+                                                .order_by(func.length(User.username), User.username)).all())
+    else:
+        usernames = seed(rng, args.users, args.follows_per_user, args.popularity_exponent, args.peeps, args.reset)
+
+    results = asyncio.run(drive(args, usernames, rng))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'arguments': {key: value for key, value in vars(args).items() if key != 'output'},
+                       **results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
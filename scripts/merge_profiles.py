@@ -0,0 +1,123 @@
+"""
+Merges the profiles written by lambdas/profiling.py into a flame graph per route, e.g: to see where the timeline spends
+its time over thousands of requests instead of a single one.
+
+    aws s3 sync s3://bucket/prefix profiles/   # When PEEP_PROFILE_SINK is a bucket
+    python -m scripts.merge_profiles profiles/ [--output flame-graphs/]
+
+The requests are grouped by their route as declared (e.g: GET /users/{user_id}/timeline), so the requests of every user
+add up together. For each route it writes a collapsed stacks file, to render with flamegraph.pl
+(https://github.com/brendangregg/FlameGraph), and all of them go in a single speedscope.json as well, one profile per
+route, to open at https://speedscope.app. The weight of every sample is 1: merged profiles of different intervals
+still add up, but in samples rather than milliseconds.
+"""
+import argparse
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from starlette.routing import compile_path
+
+from lambdas.profiling import to_collapsed, to_speedscope
+
+# The profiles of each route: route -> stack -> samples
+Profiles = dict[str, Counter[tuple[str, ...]]]
+
+
+def read_collapsed(content: str) -> list[tuple[str, Counter[tuple[str, ...]]]]:
+    # The root frame of each stack is the request
+    requests = defaultdict(Counter)
+    for line in content.splitlines():
+        if line.strip():
+            stack, _, count = line.rpartition(' ')
+            name, *frames = stack.split(';')
+            requests[name][tuple(frames)] += int(count)
+    return list(requests.items())
+
+
+def read_speedscope(content: str) -> list[tuple[str, Counter[tuple[str, ...]]]]:
+    document = json.loads(content)
+    frames = [frame['name'] for frame in document['shared']['frames']]
+    return [(profile['name'], Counter(tuple(frames[index] for index in sample) for sample in profile['samples']))
+            for profile in document['profiles']]
+
+
+def app_routes(app) -> list[tuple[str, str, re.Pattern]]:
+    # (method, route, regex of its paths), in the order they are declared, which is the order the router tries them in
+    return [(method.upper(), path, compile_path(path)[0])
+            for path, operations in app.openapi()['paths'].items() for method in operations]
+
+
+def route_of(request: str, routes: list[tuple[str, str, re.Pattern]]) -> str:
+    """
+    The route matching `request` ("METHOD /path"), like the router would pick it. The request itself when none does,
+    e.g: a 404.
+    """
+    method, _, path = request.partition(' ')
+    for route_method, route, regex in routes:
+        if route_method == method and regex.match(path):
+            return f'{method} {route}'
+    return request
+
+
+def merge(paths: list[Path], routes: list[tuple[str, str, re.Pattern]]) -> tuple[Profiles, Counter[str]]:
+    """
+    The samples of every profile in `paths` (files, or directories of them) added up by route, and how many requests of
+    each route they came from.
+    """
+    profiles = defaultdict(Counter)
+    requests = Counter()
+    files = [file for path in paths for file in (sorted(path.iterdir()) if path.is_dir() else [path])]
+    for file in files:
+        if file.name.endswith('.speedscope.json'):
+            read = read_speedscope
+        elif file.name.endswith('.collapsed'):
+            read = read_collapsed
+        else:
+            continue
+        for request, samples in read(file.read_text()):
+            route = route_of(request, routes)
+            profiles[route].update(samples)
+            requests[route] += 1
+    return profiles, requests
+
+
+def file_name(route: str) -> str:
+    # e.g: GET /users/{user_id}/timeline -> GET_users_user_id_timeline
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', type=Path, help='Profiles, or directories of them')
+    parser.add_argument('--output', type=Path, default=Path('flame-graphs'), help='Directory of the merged profiles')
+    parser.add_argument('--top', type=int, default=5, help='Functions printed per route, by their own samples')
+    args = parser.parse_args()
+
+    # Imported here, so the rest of the module can be used without the app's configuration
+    from lambdas.main import app
+    profiles, requests = merge(args.paths, app_routes(app))
+    if not profiles:
+        raise SystemExit('No profiles found')
+
+    os.makedirs(args.output, exist_ok=True)
+    for route, samples in sorted(profiles.items()):
+        (args.output / f'{file_name(route)}.collapsed').write_text(to_collapsed(route, samples))
+
+        # The innermost frame of each stack is the function running at that sample
+        own_samples = Counter()
+        for frames, count in samples.items():
+            own_samples[frames[-1] if frames else route] += count
+        total = sum(own_samples.values())
+        print(f'\n{route}: {requests[route]} requests, {total} samples')
+        for frame, count in own_samples.most_common(args.top):
+            print(f'{count / total:>7.1%}  {frame}')
+
+    (args.output / 'speedscope.json').write_text(to_speedscope(dict(sorted(profiles.items()))))
+    print(f'\nWritten to {args.output}/')
+
+
+if __name__ == '__main__':
+    main()
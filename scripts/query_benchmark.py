@@ -0,0 +1,64 @@
+"""
+CPU spent by the application to prepare the statements of the hot paths (logging in, reading a peep, reading the
+timeline), when the statement is built on every request versus built once at import. For the cost of serializing the
+responses, see scripts/serialization_benchmark.py.
+
+    PEEP_ENV=local python -m scripts.query_benchmark [--iterations 20000]
+
+No database is needed: this measures what happens before anything is sent to it. Preparing a statement means building
+it, computing its cache key and finding its compiled SQL in the cache, which is what a session does on every execute.
+Reusing the same statement object skips the first two, because SQLAlchemy memoizes the cache key on the object.
+"""
+import argparse
+import time
+import timeit
+from uuid import uuid4
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql.asyncpg import dialect as asyncpg_dialect
+
+from lambdas.db import Peep, User
+from lambdas.db.timeline import TIMELINE_NEXT_PAGE, build_timeline_query
+from lambdas.routes.authentication.utils import FIND_USER_BY_USERNAME
+from lambdas.routes.peeps.main import FIND_PEEP
+
+DIALECT = asyncpg_dialect()
+
+
+def prepare(statement, compiled_cache: dict):
+    # The same call Connection.execute makes before running a statement
+    return statement._compile_w_cache(DIALECT, compiled_cache=compiled_cache, column_keys=[])
+
+
+def cpu_us_per_call(func, iterations: int) -> float:
+    # process_time: only the CPU of this process counts, not the time it was descheduled
+    timer = timeit.Timer(func, timer=time.process_time)
+    return min(timer.repeat(repeat=5, number=iterations)) / iterations * 1_000_000
+
+
+def print_statements_report(iterations: int):
+    username, peep_id = 'leolas1', uuid4()
+    hot_paths = {
+        'find_user': (lambda: select(User).where(User.username == username), FIND_USER_BY_USERNAME),
+        'find_one (peep)': (lambda: select(Peep).where(Peep.id == peep_id), FIND_PEEP),
+        'timeline page': (lambda: build_timeline_query(limited=True, after_cursor=True), TIMELINE_NEXT_PAGE),
+    }
+
+    print(f'{"Statement":<20} {"built per request (us)":>24} {"built once (us)":>16} {"saved (us)":>12}')
+    for name, (build, cached_statement) in hot_paths.items():
+        compiled_cache = {}
+        per_request = cpu_us_per_call(lambda: prepare(build(), compiled_cache), iterations)
+        cached = cpu_us_per_call(lambda: prepare(cached_statement, compiled_cache), iterations)
+        print(f'{name:<20} {per_request:>24.1f} {cached:>16.1f} {per_request - cached:>12.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help='Calls per measurement')
+    args = parser.parse_args()
+
+    print_statements_report(args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+CPU spent turning the responses of the hot paths into JSON: a timeline of 1,000 peeps (ten pages of the largest size)
+and a single peep, the way they were serialized before (dicts and ORM objects through jsonable_encoder, then json.dumps)
+versus through their response models, which FastAPI validates and dumps to JSON bytes in Pydantic's native code.
+
+    PEEP_ENV=local python -m scripts.serialization_benchmark [--iterations 200] [--items 1000]
+
+No database is needed. It also measures jsonable_encoder followed by orjson, which is what a default ORJSONResponse
+would do: a custom response class turns off FastAPI's response model fast path, so it saves less than the models do.
+"""
+import argparse
+import json
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from lambdas.db import Peep
+from lambdas.dtos.peeps import FindPeepResponseDTO
+from lambdas.dtos.users import TimelineResponseDTO
+from lambdas.routes.users.main import timeline_row
+from scripts.query_benchmark import cpu_us_per_call
+
+
+def legacy_format(created_at: datetime) -> str:
+    # How the created_at were sent before, e.g: 2024-12-20T14:00 UTC+00
+    return created_at.isoformat(timespec='minutes') + ' UTC+00'
+
+
+def starlette_json(content) -> bytes:
+    # What JSONResponse.render does
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def print_timeline_report(items: int, iterations: int):
+    now = datetime(2024, 12, 20, 14, 0, 31, 123456)
+    # (content, created_at) as they come from the database, and [id, content, created_at] as they are cached
+    rows = [(f'peep number {index} of the timeline', now - timedelta(seconds=index * 37)) for index in range(items)]
+    database_rows = [{'id': uuid4(), 'content': content, 'created_at': created_at} for content, created_at in rows]
+    cached_rows = [timeline_row(row) for row in database_rows]
+    adapter = TypeAdapter(TimelineResponseDTO)
+
+    def before():
+        timeline = [{'content': content, 'created_at': legacy_format(created_at)} for content, created_at in rows]
+        return starlette_json(jsonable_encoder({'timeline': timeline, 'next_cursor': None}))
+
+    def orjson_response():
+        timeline = [{'content': content, 'created_at': created_at} for content, created_at in rows]
+        return orjson.dumps(jsonable_encoder({'timeline': timeline, 'next_cursor': None}))
+
+    def response_model(source_rows):
+        # Like fetch_timeline, which turns the rows from the database into the cached ones first
+        timeline = [{'content': row[1], 'created_at': row[2] + 'Z'} for row in source_rows]
+        value = adapter.validate_python({'timeline': timeline, 'next_cursor': None}, from_attributes=True)
+        return adapter.dump_json(value)
+
+    paths = {
+        'jsonable_encoder + json.dumps (before)': before,
+        'jsonable_encoder + orjson': orjson_response,
+        'response model, from the database': lambda: response_model([timeline_row(row) for row in database_rows]),
+        'response model, from the cache': lambda: response_model(cached_rows),
+    }
+    print(f'{"Timeline of " + str(items) + " peeps":<40} {"us":>10} {"bytes":>8}')
+    for name, serialize in paths.items():
+        print(f'{name:<40} {cpu_us_per_call(serialize, iterations):>10.1f} {len(serialize()):>8}')
+
+
+def print_peep_report(iterations: int):
+    now = datetime(2024, 12, 20, 14, 0, 31, 123456)
+    peep = Peep(id=uuid4(), user_id=uuid4(), content='a single peep', created_at=now, updated_at=now)
+    adapter = TypeAdapter(FindPeepResponseDTO)
+
+    paths = {
+        'ORM object + jsonable_encoder (before)': lambda: starlette_json(jsonable_encoder({'peep': peep})),
+        'response model': lambda: adapter.dump_json(adapter.validate_python({'peep': peep}, from_attributes=True)),
+    }
+    print(f'\n{"A peep (GET /peeps/{peep_id})":<40} {"us":>10}')
+    for name, serialize in paths.items():
+        print(f'{name:<40} {cpu_us_per_call(serialize, iterations):>10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200, help='Serializations per measurement')
+    parser.add_argument('--items', type=int, default=1000, help='Peeps in the timeline')
+    args = parser.parse_args()
+
+    print_timeline_report(args.items, args.iterations)
+    print_peep_report(args.iterations * 10)
+
+
+if __name__ == '__main__':
+    main()
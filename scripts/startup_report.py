@@ -0,0 +1,89 @@
+"""
+Breakdown of the cold start of the Lambda: how long importing lambdas.main takes, and where that time goes.
+
+    PEEP_ENV=local python -m scripts.startup_report [--top 20] [--connect]
+
+The imports are measured in a fresh interpreter with `python -X importtime`, so nothing is cached from this process.
+With --connect, the lazy database initialization that the first request pays for (credentials, async engine, first
+connection through a session) is measured as well.
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from sqlalchemy import text
+
+ENTRY_POINT = 'lambdas.main'
+
+
+def measure_imports(module: str) -> list[tuple[str, int, int]]:
+    # Every line on stderr looks like: "import time:  self [us] | cumulative | imported package"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix('import time:').split('|')
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    return imports
+
+
+def print_imports_report(imports: list[tuple[str, int, int]], top: int):
+    total_us = sum(self_us for _, self_us, _ in imports)
+    print(f'Importing {ENTRY_POINT}: {total_us / 1000:.1f} ms, {len(imports)} modules\n')
+
+    by_package = defaultdict(int)
+    for name, self_us, _ in imports:
+        by_package[name.split('.')[0]] += self_us
+
+    print(f'{"Top-level package":<40} {"ms":>8} {"%":>6}')
+    for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f'{package:<40} {self_us / 1000:>8.1f} {100 * self_us / total_us:>6.1f}')
+
+    print(f'\n{"Module (cumulative, including its imports)":<60} {"ms":>8}')
+    for name, _, cumulative_us in sorted(imports, key=lambda item: item[2], reverse=True)[:top]:
+        print(f'{name:<60} {cumulative_us / 1000:>8.1f}')
+
+
+async def measure_first_use() -> tuple[float, float]:
+    # The same factories as the first request of a cold start: the async engine of the API, with its pool settings,
+    # and a session of it
+    from lambdas.db.main import get_async_engine, get_session_factory
+
+    started = time.perf_counter()
+    engine = get_async_engine()
+    engine_done = time.perf_counter()
+    async with get_session_factory()() as db:
+        await db.execute(text('SELECT 1'))
+    query_done = time.perf_counter()
+    await engine.dispose()
+
+    return engine_done - started, query_done - engine_done
+
+
+def print_first_use_report():
+    engine_seconds, query_seconds = asyncio.run(measure_first_use())
+
+    print(f'\n{"First request database initialization":<48} {"ms":>8}')
+    print(f'{"Credentials and engine (get_async_engine)":<48} {engine_seconds * 1000:>8.1f}')
+    print(f'{"First session, connection and query":<48} {query_seconds * 1000:>8.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15, help='Number of packages and modules to show')
+    parser.add_argument('--connect', action='store_true', help='Also measure the lazy database initialization')
+    args = parser.parse_args()
+
+    print_imports_report(measure_imports(ENTRY_POINT), args.top)
+    if args.connect:
+        print_first_use_report()
+
+
+if __name__ == '__main__':
+    main()